@@ -14,7 +14,8 @@ config["General_Variables"] = {
     "Cross_section_abs_gas" : "0.02",
     "Abs_coeff_cloud" : "5",
     "Top_level" : "25",
-    "vertical_height_scale" : "7"
+    "vertical_height_scale" : "7",
+    "Cos_zenith_angle" : "1"
     }
 
 
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+#-----------------------------------------------------------------
+# Benchmarks of the Weighting functions and Transmittances model
+#-----------------------------------------------------------------
+#
+# Every stage of the chain (z_vector, normalized_density_profile,
+# optical_depth, TOA_transmittances, weighting_function) and the output
+# stages of WFT_Profile.py (txt files and plots) are timed for several
+# grid spacings and numbers of columns. For each case the best wall time
+# over some repetitions, the throughput (columns/s and levels/s) and the
+# peak memory allocated (tracemalloc) are stored in a .json and a .csv
+# file, so that the results of two versions of the code can be compared:
+#
+#        python3 WFT_Benchmark.py
+#        python3 WFT_Benchmark.py --compare OUTPUT/Benchmarks/old.json
+#
+#-----------------------------------------------------------------
+#
+
+import argparse
+import csv
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import WFT_Functions as fn
+
+# Parameters of the benchmarked columns (as in Configuration.ini)
+
+b = 5
+t = 10
+csg = 0.02
+coc = 5
+h = 7
+
+# Default grid spacings [km] and numbers of columns
+
+DZ_VALUES = (0.1, 0.01, 0.001, 0.0001)
+COLUMNS = (1, 10, 100, 1000)
+
+# Cases whose arrays would need more memory than this are skipped
+
+MEMORY_BUDGET = 2**30
+
+# Number of (n_columns, n_levels) float arrays alive at the same time
+# in the batched chain (rho_n, lod, loc, transmittances, weights, temporaries)
+
+ARRAYS_PER_COLUMN = 10
+
+def measure(function, repeat):
+
+    """ This function runs function() repeat times and measures the best
+        wall time and the peak memory allocated during one run.
+
+         OUTPUT:
+
+             result      : value returned by the last call of function
+
+             seconds     : best wall time of the runs
+
+             peak        : peak memory [bytes] allocated during one run
+
+    """
+
+    seconds = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, seconds, peak
+
+def chain_stages(dz, n_columns, dtype=np.float64):
+
+    """ This function returns the stages of the numerical chain as a list
+        of (name, function) pairs, every function using the results of the
+        previous ones. A single column is computed with the functions used
+        by WFT_Profile.py, more columns with the batched functions, in the
+        floating point type dtype.
+    """
+
+    state = {}
+
+    def grid():
+        state['z'] = fn.z_vector(fn.Z1, dz, fn.Z2, fn.Z2)
+        return state['z']
+
+    if n_columns == 1:
+        def density():
+            state['rho_n'] = fn.normalized_density_profile(state['z'], h, dtype)
+            return state['rho_n']
+
+        def depth():
+            state['od'] = fn.optical_depth(state['z'], dz, b, t, csg, coc, state['rho_n'])
+            return state['od']
+    else:
+        def density():
+            state['rho_n'] = fn.batch_normalized_density_profile(state['z'], np.full(n_columns, h), dtype)
+            return state['rho_n']
+
+        def depth():
+            state['od'] = fn.batch_optical_depth(state['z'], dz, b, t, csg, coc, state['rho_n'])
+            return state['od']
+
+    def transmittance():
+        state['t'] = fn.TOA_transmittances(*state['od'], state['z'])
+        return state['t']
+
+    def weighting():
+        state['w'] = fn.weighting_function(*state['t'], state['z'], dz)
+        return state['w']
+
+    stages = [('z_vector', grid),
+              ('normalized_density_profile', density),
+              ('optical_depth', depth),
+              ('TOA_transmittances', transmittance),
+              ('weighting_function', weighting)]
+
+    return stages, state
+
+def output_stages(state, plots, output_path):
+
+    """ This function returns the output stages of WFT_Profile.py (txt files
+        and, if requested, plots) for the single column chain in state.
+    """
+
+    import WFT_Profile as wp
+
+    profiles = {'z' : state['z'], 'clear_t' : state['t'][0], 'cloudy_t' : state['t'][1],
+                'weight_clear' : state['w'][0], 'weight_cloudy' : state['w'][1],
+                'zt' : len(state['z'])//2}
+
+    def text():
+        wp.clear_save_txt(profiles, output_path)
+        wp.cloudy_save_txt(profiles, output_path)
+
+    def plot():
+        wp.plot_profiles(profiles, output_path)
+
+    stages = [('text_output', text)]
+
+    if plots:
+        stages.append(('plot_output', plot))
+
+    return stages
+
+def run_benchmarks(dz_values=DZ_VALUES, columns=COLUMNS, repeat=3, plots=True,
+                   memory_budget=MEMORY_BUDGET, dtype=np.float64):
+
+    """ This function runs the benchmarks for every grid spacing and number
+        of columns. Cases needing more memory than memory_budget are skipped.
+
+         OUTPUT:
+
+             records     : list of dictionaries, one for each stage and case,
+                           with the fields stage, dz, n_levels, n_columns,
+                           dtype, seconds, columns_per_s, levels_per_s,
+                           peak_bytes
+
+    """
+
+    records = []
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for dz in dz_values:
+            records += _benchmark_grid(dz, columns, repeat, plots, memory_budget,
+                                       output_dir + '/', np.dtype(dtype))
+
+    return records
+
+def _benchmark_grid(dz, columns, repeat, plots, memory_budget, output_path, dtype):
+
+    """ Runs the benchmarks of one grid spacing (see run_benchmarks). """
+
+    records = []
+
+    n_levels = len(fn.z_vector(fn.Z1, dz, fn.Z2, fn.Z2))
+
+    for n_columns in columns:
+        if n_columns*n_levels*ARRAYS_PER_COLUMN*dtype.itemsize > memory_budget:
+            print(f'dz = {dz}, {n_columns} columns: skipped (memory budget)')
+            continue
+
+        stages, state = chain_stages(dz, n_columns, dtype)
+
+        if n_columns == 1:
+            # The output stages need the results of the chain
+            for _, function in stages:
+                function()
+            stages = stages + output_stages(state, plots, output_path)
+
+        for stage, function in stages:
+            _, seconds, peak = measure(function, repeat)
+
+            records.append({'stage' : stage, 'dz' : dz, 'n_levels' : n_levels,
+                            'n_columns' : n_columns, 'dtype' : dtype.name,
+                            'seconds' : seconds,
+                            'columns_per_s' : n_columns/seconds,
+                            'levels_per_s' : n_columns*n_levels/seconds,
+                            'peak_bytes' : peak})
+
+            print(f'{stage:28s} dz = {dz:<8g} columns = {n_columns:<6d} '
+                  f'{seconds*1e3:10.3f} ms {n_columns*n_levels/seconds:12.4g} levels/s '
+                  f'{peak/2**20:10.2f} MiB')
+
+    return records
+
+def save_results(records, output):
+
+    """ This function saves the benchmark records, with the versions of
+        Python and NumPy and the platform, in a .json file and the records
+        alone in a .csv file with the same name.
+    """
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+
+    results = {'python' : sys.version.split()[0], 'numpy' : np.__version__,
+               'platform' : platform.platform(), 'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'records' : records}
+
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=1)
+
+    with open(os.path.splitext(output)[0] + '.csv', 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(records[0]))
+        writer.writeheader()
+        writer.writerows(records)
+
+def compare(records, baseline):
+
+    """ This function prints, for every case present in both runs, the ratio
+        between the new and the baseline wall time (> 1 means slower).
+    """
+
+    with open(baseline) as file:
+        old = {(r['stage'], r['dz'], r['n_columns'], r.get('dtype', 'float64')) : r
+               for r in json.load(file)['records']}
+
+    for r in records:
+        key = (r['stage'], r['dz'], r['n_columns'], r['dtype'])
+        if key in old:
+            ratio = r['seconds']/old[key]['seconds']
+            print(f'{r["stage"]:28s} dz = {r["dz"]:<8g} columns = {r["n_columns"]:<6d} '
+                  f'time ratio {ratio:6.2f}')
+
+def main(argv=None):
+
+    """ Command line interface of the benchmarks. """
+
+    arguments = argparse.ArgumentParser(description = 'Benchmarks of the WFT model')
+    arguments.add_argument('--dz', nargs='+', type=float, default=DZ_VALUES,
+                           help = 'grid spacings [km]')
+    arguments.add_argument('--columns', nargs='+', type=int, default=COLUMNS,
+                           help = 'numbers of columns')
+    arguments.add_argument('--repeat', type=int, default=3,
+                           help = 'repetitions of every measure (the best is kept)')
+    arguments.add_argument('--no-plots', action='store_true',
+                           help = 'do not benchmark the plots')
+    arguments.add_argument('--memory-budget', type=float, default=MEMORY_BUDGET,
+                           help = 'largest memory [bytes] of a benchmarked case')
+    arguments.add_argument('--dtype', choices=('float64', 'float32'), default='float64',
+                           help = 'floating point type of the computation')
+    arguments.add_argument('--output', default=None,
+                           help = 'output .json file (default: OUTPUT/Benchmarks/benchmark_<date>.json)')
+    arguments.add_argument('--compare', default=None,
+                           help = '.json file of a previous run to compare with')
+    args = arguments.parse_args(argv)
+
+    output = args.output or time.strftime('OUTPUT/Benchmarks/benchmark_%Y%m%d_%H%M%S.json')
+
+    records = run_benchmarks(args.dz, args.columns, args.repeat, not args.no_plots,
+                             args.memory_budget, args.dtype)
+
+    save_results(records, output)
+
+    print(f'Results stored in {output}')
+
+    if args.compare:
+        compare(records, args.compare)
+
+if __name__ == "__main__":
+    main()
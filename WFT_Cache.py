@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+#----------------------------------------
+# On-disk cache of the results of WFT_Profile
+#----------------------------------------
+#
+# Every run of WFT_Profile.py with the cache enabled stores its profiles
+# and output files (figures, .txt and .npy files) in a folder of the cache
+# named after a hash of the general variables, of the grid and of the
+# source code of the model. A later run with the same key copies the
+# stored files instead of recomputing and redrawing them. When the cache
+# is larger than its size limit, the least recently used entries are
+# removed.
+#
+# i.e for Linux users:
+#
+#        python3 WFT_Cache.py info
+#        python3 WFT_Cache.py invalidate [--config Configuration.ini]
+#
+#----------------------------------------
+#
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+# Default folder and size limit [bytes] of the cache
+
+CACHE_DIR = './OUTPUT/Cache/'
+MAX_BYTES = 2**29
+
+def code_version(*modules):
+
+    """ This function returns a hash of the source files of the modules, so
+        that a change of the code invalidates the cached results.
+    """
+
+    digest = hashlib.sha256()
+
+    for module in modules:
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+
+    return digest.hexdigest()
+
+class ResultCache:
+
+    """ Content-addressed cache of profiles and output files.
+
+        ATTRIBUTES:
+
+            directory   : folder of the cache, with one subfolder for each key
+
+            max_bytes   : largest size of the cache, the least recently used
+                          entries are removed first
+
+            hits        : number of entries found in the cache
+
+            misses      : number of entries not found in the cache
+
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+
+        """ This function returns the key of an entry, a hash of parts
+            (numbers, strings, lists and dictionaries).
+        """
+
+        text = json.dumps(parts, sort_keys=True, default=float)
+
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _entry(self, key):
+
+        return os.path.join(self.directory, key)
+
+    def load_profiles(self, key):
+
+        """ This function returns the profiles stored with key (a dictionary
+            of arrays, see store_profiles), or None. A found entry becomes
+            the most recently used one.
+        """
+
+        filename = os.path.join(self._entry(key), 'profiles.npz')
+
+        if not os.path.exists(filename):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        os.utime(self._entry(key))
+
+        with np.load(filename) as data:
+            return {name : data[name] if data[name].ndim else data[name].item()
+                    for name in data.files}
+
+    def store_profiles(self, key, profiles):
+
+        """ This function stores a dictionary of arrays (and numbers) with key. """
+
+        self._write(key, 'profiles.npz', lambda path: np.savez(path, **profiles))
+
+    def has_files(self, key, names):
+
+        """ True if all the files names are stored with key. """
+
+        return all(os.path.exists(os.path.join(self._entry(key), name)) for name in names)
+
+    def copy_files(self, key, names, output_path):
+
+        """ This function copies the files names stored with key into the
+            folder output_path.
+        """
+
+        for name in names:
+            shutil.copyfile(os.path.join(self._entry(key), name),
+                            os.path.join(output_path, name))
+
+    def store_files(self, key, names, output_path):
+
+        """ This function stores with key the files names of the folder
+            output_path.
+        """
+
+        for name in names:
+            self._write(key, name, lambda path: shutil.copyfile(
+                os.path.join(output_path, name), path))
+
+    def _write(self, key, name, write):
+
+        """ Writes a file of an entry through a temporary file, so that an
+            interrupted run never leaves an incomplete file in the cache.
+        """
+
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+
+        temporary = os.path.join(entry, f'.{os.getpid()}.{name}')
+        write(temporary)
+
+        os.replace(temporary, os.path.join(entry, name))
+        os.utime(entry)
+
+        self.evict()
+
+    def entries(self):
+
+        """ This function returns the entries of the cache as a list of
+            (key, size in bytes, time of last use), the most recently used last.
+        """
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((key, size, os.path.getmtime(entry)))
+
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self):
+
+        """ This function removes the least recently used entries until the
+            cache is not larger than max_bytes. The most recent entry is
+            always kept.
+        """
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        for key, size, _ in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+    def invalidate(self, key=None):
+
+        """ This function removes the entry key, or every entry if key is None. """
+
+        if key is None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        else:
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+
+def main(argv=None):
+
+    """ Command line interface of the cache: 'info' lists the entries,
+        'invalidate' removes the entry of a configuration file, or all of
+        them with --all.
+    """
+
+    arguments = argparse.ArgumentParser(description = 'Cache of the WFT model results')
+    arguments.add_argument('command', choices = ('info', 'invalidate'))
+    arguments.add_argument('--config', default = 'Configuration.ini',
+                           help = 'configuration file whose entry is invalidated')
+    arguments.add_argument('--all', action = 'store_true',
+                           help = 'invalidate every entry')
+    arguments.add_argument('--cache-dir', default = CACHE_DIR,
+                           help = f'folder of the cache (default: {CACHE_DIR})')
+    args = arguments.parse_args(argv)
+
+    cache = ResultCache(args.cache_dir)
+
+    if args.command == 'info':
+        entries = cache.entries()
+        for key, size, used in entries:
+            print(f'{key[:16]}  {size/2**20:8.2f} MiB  last used '
+                  f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(used))}')
+        print(f'{len(entries)} entries, {sum(e[1] for e in entries)/2**20:.2f} MiB')
+
+    elif args.all:
+        cache.invalidate()
+        print(f'Cache {args.cache_dir} removed')
+
+    else:
+        import WFT_Profile as wp
+        key = wp.cache_key(wp.read_configuration(args.config))
+        cache.invalidate(key)
+        print(f'Entry of {args.config} removed')
+
+if __name__ == "__main__":
+    main()
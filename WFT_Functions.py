@@ -4,7 +4,11 @@
 #----------------------------------------
 
 import numpy as np
+from WFT_Instrumentation import instrumented
+from WFT_Validation import (check, check_columns, check_grid, check_height_vector,
+                            check_radiance_inputs, check_transmittances, GRID_STEP, RADIANCE)
 
+@instrumented('z_vector')
 def z_vector(z1,dz,z2,top):
     
     """ This function computes the heigth vector between z1 and z2.
@@ -27,27 +31,223 @@ def z_vector(z1,dz,z2,top):
                           under consideration
     
     """
-    if  dz <= 0 or dz > 0.5*(z2-z1):
-         raise ValueError (
-                'dz is not correct!')
-                
-    if  z1 != 0:
-         raise ValueError (
-                'The starting quote must be 0!')
-         
-    if z2 != 50:
-         raise ValueError (
-                'The highest quote must be 50!')
-    if  top > z2:
-         raise ValueError (
-                'The top of the plotted atmosphere must be smaller than the top of the analyzed atmosphere')
+    check_grid(z1, dz, z2, top)
     
     z = np.arange(z1,z2,dz)
     
     return z
 
+def custom_z_vector(levels):
+    
+    """ This function checks and returns a user-supplied, possibly 
+        non-uniform, height vector.
+    
+        INPUT:
+            
+            levels      : altitudes of the levels, strictly increasing,
+                          from 0 to at most 50
+        
+        OUTPUT:
+            
+            z           : altitude vector of the portion of atmosphere 
+                          under consideration
+    
+    """
+    
+    z = np.asarray(levels, dtype=float)
+    
+    # Check the levels (see WFT_Validation.py)
+    
+    check_height_vector(z)
+    
+    return z
+
+def layer_thickness(z):
+    
+    """ This function returns the thickness of each layer of z (between 
+        z[k] and z[k+1]), to be used as dz by the other functions on a 
+        non-uniform height vector.
+    """
+    
+    return np.diff(z)
+
+def _level_thickness(dz, n_levels):
+    
+    """ Thickness of the layer above each of the n_levels levels: the layer
+        thicknesses (dz for a uniform grid) followed by 0, as there is no 
+        layer above the last level.
+    """
+    
+    if np.ndim(dz) == 0:
+        return np.append(np.full(n_levels-1, dz), 0)
+    
+    return np.append(dz, 0)
+
+def _molecular_optical_depth(rho_n, csg, dz, out):
+    
+    """ Molecular optical depth of the layer above each level, written in
+        out: pairwise (trapezoidal) sum of the density of adjacent levels,
+        csg*(rho_n[:-1]+rho_n[1:])*0.5*dz with the operations done in place
+        in this order, and 0 for the last level, which has no layer above 
+        it. The sum runs along the last axis, so a batch of columns takes 
+        csg with shape (n_columns, 1).
+    """
+    
+    layers = np.add(rho_n[..., :-1], rho_n[..., 1:], out=out[..., :-1])
+    layers *= csg
+    layers *= 0.5
+    layers *= dz
+    out[..., -1] = 0
+    
+    return out
+
+def adaptive_z_vector(b, t, csg, coc, h, dz_coarse=0.1, dz_fine=0.005,
+                      width=0.5, gradient_fraction=0.05):
+    
+    """ This function builds a non-uniform height vector with a coarse step
+        everywhere and a fine step only where it is needed: within width
+        from the cloud base and top (which are always levels of the vector)
+        and in the layers where, on the coarse grid, the weighting function
+        changes by more than gradient_fraction of its maximum.
+    
+        INPUT:
+            
+            b, t        : cloud base and top
+            
+            csg         : cross section per unit mass of absorbing gas
+            
+            coc         : absorption coefficient of cloud layer
+            
+            h           : vertical scale height
+            
+            dz_coarse   : step value away from the refined regions
+            
+            dz_fine     : step value inside the refined regions
+            
+            width       : half width of the refined region around the 
+                          cloud base and top
+            
+            gradient_fraction : threshold on the change of the weighting 
+                          function between two coarse levels
+        
+        OUTPUT:
+            
+            z           : non-uniform altitude vector
+    
+    """
+    
+    check([(GRID_STEP, dz_fine <= 0 or dz_fine > dz_coarse)])
+    
+    # The last level is the same of the uniform grid with step dz_fine, so
+    # that both grids describe the same portion of atmosphere
+    
+    z_top = z_vector(0, dz_fine, 50, 50)[-1]
+    z_coarse = z_vector(0, dz_coarse, 50, 50)
+    z_coarse = _insert_levels(z_coarse[z_coarse < z_top], [b, t, z_top], dz_fine)
+    dz_layers = layer_thickness(z_coarse)
+    
+    # Weighting functions on the coarse grid
+    
+    rho_n = normalized_density_profile(z_coarse, h)
+    lod, loc = optical_depth(z_coarse, dz_layers, b, t, csg, coc, rho_n)
+    weights = np.stack(weighting_function(*TOA_transmittances(lod, loc, z_coarse),
+                                          z_coarse, dz_layers))
+    
+    # Layers to refine: steep weighting functions and cloud boundaries
+    
+    steep = np.any(np.abs(np.diff(weights, axis=-1)) >
+                   gradient_fraction*np.max(np.abs(weights), axis=-1, keepdims=True), axis=0)
+    
+    lower = z_coarse[:-1]
+    upper = z_coarse[1:]
+    near_cloud = np.zeros(len(lower), dtype=bool)
+    for boundary in (b, t):
+        near_cloud |= (upper > boundary - width) & (lower < boundary + width)
+    
+    refine = steep | near_cloud
+    
+    # Fine levels inside every refined layer
+    
+    fine = [np.arange(lower[k], upper[k], dz_fine) for k in np.flatnonzero(refine)]
+    
+    z = np.union1d(z_coarse, np.concatenate(fine) if fine else [])
+    
+    # Levels closer than half a fine step to the previous one are merged
+    
+    keep = np.ones(len(z), dtype=bool)
+    keep[1:] = np.diff(z) > 0.5*dz_fine
+    
+    return custom_z_vector(_insert_levels(z[keep], [b, t, z_top], dz_fine))
+
+def _insert_levels(z, altitudes, dz_min):
+    
+    """ Adds the altitudes to z as exact levels, removing the levels of z
+        closer than dz_min/2 to them.
+    """
+    
+    altitudes = np.asarray(altitudes, dtype=float)
+    
+    far = np.all(np.abs(z[:, np.newaxis] - altitudes) > 0.5*dz_min, axis=1)
+    
+    return np.union1d(z[far], altitudes)
+
+# Base and top [km] of the considered atmosphere and default step [km] of
+# the height vector
+
+Z1 = 0
+Z2 = 50
+DZ = 0.005
+
+# Largest distance [km] between an altitude and a level of the z vector
+# for the altitude to be considered on that level
+
+GRID_TOLERANCE = 1e-6
+
+def grid_index(z, altitude, tol=GRID_TOLERANCE, name='The altitude'):
+    
+    """ This function finds the position of one or more altitudes in 
+        the z vector by binary search, instead of a linear scan.
+        
+        INPUT:
+            
+            z           : altitude vector (increasing)
+            
+            altitude    : altitude, or array of altitudes, to look for
+            
+            tol         : largest distance between an altitude and a 
+                          level of z for the altitude to be on that level
+            
+            name        : description of the altitude used in the error 
+                          message
+        
+        OUTPUT:
+            
+            index       : position (or array of positions) in z
+    
+    """
+    
+    altitude = np.asarray(altitude, dtype=float)
+    
+    # Nearest level among the two around each altitude
+    
+    index = np.clip(np.searchsorted(z, altitude), 1, len(z)-1)
+    index = index - ((altitude - z[index-1]) < (z[index] - altitude))
+    
+    # Kept inside a trusted() block too, as the altitudes outside z or
+    # between two levels would be moved to a level; written so that NaN 
+    # altitudes fail as well
+    
+    if not np.all(np.abs(z[index] - altitude) <= tol):
+        raise ValueError (
+            f'{name} is not contained into the z vector!')
+    
+    if index.ndim == 0:
+        return int(index)
+    
+    return index
 
-def normalized_density_profile(z,h):
+@instrumented('normalized_density_profile')
+def normalized_density_profile(z,h,dtype=np.float64,out=None):
     
     """ This function computes the normalized density 
         profile starting from the exponential profile (rho) and 
@@ -61,6 +261,13 @@ def normalized_density_profile(z,h):
             
             h           : vertical scale height for the exponential profile 
             
+            dtype       : floating point type of the profile; the optical
+                          depths, transmittances and weighting functions 
+                          computed from it keep the same type
+            
+            out         : array with the shape of z where the profile is 
+                          written, instead of a new array (see Workspace)
+            
         
         OUTPUT:
             
@@ -68,13 +275,15 @@ def normalized_density_profile(z,h):
                           
     """
     
-    if h <= 0:
-        raise ValueError (
-    		'Vertical scale height h must be greater then 0!')
+    check_columns(z, h=h)
         
+    z = np.asarray(z, dtype=dtype)
+    h = z.dtype.type(h)
+    
     # Explonential density profile 
     
-    rho = np.exp(-z/h)
+    rho = np.divide(z, -h, out=out)
+    np.exp(rho, out=rho)
     
     # Normalization factor
      
@@ -82,11 +291,12 @@ def normalized_density_profile(z,h):
     
     # Normalized density profile
     
-    rho_n = rho*norm
+    rho_n = np.multiply(rho, norm, out=rho)
     
     return rho_n
 
-def optical_depth(z,dz,b,t,csg,coc,rho_n):
+@instrumented('optical_depth')
+def optical_depth(z,dz,b,t,csg,coc,rho_n,tol=GRID_TOLERANCE,out=None):
         
     """ This function computes the molecular optical depth vector (lod)
          and the total optical depth (loc).
@@ -99,7 +309,8 @@ def optical_depth(z,dz,b,t,csg,coc,rho_n):
              z           : altitude vector of the portion of atmosphere 
                            under consideration
             
-             dz          : step value of the vector z
+             dz          : step value of the vector z, or thickness of each
+                           layer (layer_thickness(z)) for a non-uniform z
              
              b           : cloud base
              
@@ -109,7 +320,14 @@ def optical_depth(z,dz,b,t,csg,coc,rho_n):
              
              coc         : absorption coefficient of cloud layer
              
-             rho_n       : normalized density profile
+             rho_n       : normalized density profile (lod and loc have
+                           the same floating point type)
+             
+             tol         : tolerance used to find b and t in the z vector
+             
+             out         : pair of arrays (lod, loc) with the shape of z 
+                           where the optical depths are written, instead 
+                           of new arrays (see Workspace)
             
         
          OUTPUT:
@@ -119,62 +337,151 @@ def optical_depth(z,dz,b,t,csg,coc,rho_n):
              loc         : total optical depth vector
                           
     """
-    # Check if b and t are in the layer of the considered atmosphere
+    # Check if b and t are in the layer of the considered atmosphere and 
+    # the cross sections are positive (see WFT_Validation.py)
     
-    if z[0] > b:
-        raise ValueError (
-    		'The bottom of the cloud cannot be smaller than the bottom of atmosphere (0)')
+    check_columns(z, b=b, t=t, csg=csg, coc=coc)
+    					    		
+    # Initialization of molecular and total optical depth vectors
     
-    if t > z[len(z)-1]:
-        raise ValueError (
-    		'The top of the cloud cannot be greater than the top of atmosphere (50)')
+    if out is None:
+        lod = np.empty(len(z), dtype=rho_n.dtype)
+        loc = np.empty(len(z), dtype=rho_n.dtype)
+    else:
+        lod, loc = out
     
-    if b >= t:
-    	raise ValueError (
-    		'The top of the cloud must be greater than the bottom')
+    # Molecular optical depth vector
     
-    if csg <= 0 or coc <= 0:
-    	raise ValueError (
-    		'The cross section must be positive')
-    					    		
-    # Initialization of molecular optical depth vector
+    _molecular_optical_depth(rho_n, csg, dz, out=lod)
     
-    lod = np.zeros(len(z))
+    # Position of the base and the top of the cloud in the vector z;
+    # a ValueError arises if b or t are not included in z vector
     
-    # Molecular optical depth vector 
+    cloud_base = grid_index(z, b, tol, 'The bottom of the cloud')
+    cloud_top = grid_index(z, t, tol, 'The top of the cloud')
     
-    for j in range(len(lod)-2, -1, -1):
-        lod[j] = csg*(rho_n[j]+rho_n[j+1])*0.5*dz
+    # Total optical depth vector: coc times the layer thickness is added to 
+    # the levels strictly between cloud base and cloud top (as 
+    # cloud_extinction_profile does)
     
-    # Initialization of total optical depth vector
+    loc[:] = lod
     
-    loc=1*lod
+    if np.ndim(dz) == 0:
+        loc[cloud_base+1:cloud_top] += coc*dz
+    else:
+        loc[cloud_base+1:cloud_top] += coc*np.asarray(dz)[cloud_base+1:cloud_top]
+        
+    return lod, loc    
+
+def cloud_extinction_profile(z, layers, tol=GRID_TOLERANCE):
     
-    # Position of the base and the top of the cloud in the vector z
-    z=list(z)
+    """ This function computes the cloud extinction of each level of z
+        for any number of cloud layers, possibly overlapping (the 
+        extinctions of overlapping layers are summed). As for a single 
+        cloud in optical_depth, a layer between b and t adds its 
+        absorption coefficient to the levels strictly between the 
+        positions of b and t in z.
+        
+        The layers are accumulated at once: +coc is placed at the first 
+        level of each layer and -coc after the last one, and the 
+        cumulative sum gives the extinction of every level.
+        
+        INPUT:
+            
+            z           : altitude vector of the portion of atmosphere 
+                          under consideration
+            
+            layers      : sequence of (b, t, coc) triples: cloud base, cloud
+                          top and absorption coefficient of each layer
+            
+            tol         : tolerance used to find b and t in the z vector
+        
+        OUTPUT:
+            
+            extinction  : cloud extinction vector, with the same length of z
+    
+    """
     
-    # Test if b value and t value are included in z vector
+    layers = np.asarray(layers, dtype=float).reshape(-1, 3)
+    b, t, coc = layers[:, 0], layers[:, 1], layers[:, 2]
     
-    if b in z:
-    	cloud_base = z.index(b)
-    else:
+    check_columns(z, b=b, t=t, coc=coc)
+    
+    cloud_base = grid_index(z, b, tol, 'The bottom of the cloud')
+    cloud_top = grid_index(z, t, tol, 'The top of the cloud')
+    
+    # Interval accumulation of all the layers
+    
+    steps = np.zeros(len(z)+1)
+    np.add.at(steps, cloud_base+1, coc)
+    np.add.at(steps, cloud_top, -coc)
+    
+    extinction = np.cumsum(steps[:-1])
+    
+    return extinction
+
+@instrumented('layered_optical_depth')
+def layered_optical_depth(z,dz,csg,rho_n,layers=None,extinction=None,tol=GRID_TOLERANCE):
+    
+    """ This function computes the molecular (lod) and total (loc) optical 
+         depth vectors for a cloudy sky made of several cloud layers, or 
+         described by a cloud extinction profile varying with height.
+         
+         
+         INPUT:
+            
+             z           : altitude vector of the portion of atmosphere 
+                           under consideration
+            
+             dz          : step value of the vector z, or thickness of each
+                           layer (layer_thickness(z)) for a non-uniform z
+             
+             csg         : cross section per unit mass of absorbing gas
+             
+             rho_n       : normalized density profile
+             
+             layers      : sequence of (b, t, coc) triples, one for each
+                           cloud layer (see cloud_extinction_profile)
+             
+             extinction  : cloud extinction of each level, used instead of
+                           layers; an array with shape (n_columns, n_levels)
+                           gives the total optical depth of many columns
+             
+             tol         : tolerance used to find the layers in the z vector
+            
+        
+         OUTPUT:
+            
+             lod         : molecular optical depth vector
+             
+             loc         : total optical depth vector (or array)
+                          
+    """
+    
+    if (layers is None) == (extinction is None):
         raise ValueError (
-    		'The bottom of the cloud is not contained into the z vector!')
-   	
-    if t in z:
-    	cloud_top = z.index(t)
-    else:    	
+            'Either the cloud layers or the cloud extinction must be given')
+    
+    check_columns(z, csg=csg)
+    
+    if extinction is not None and np.shape(extinction)[-1:] != (len(z),):
         raise ValueError (
-    		'The top of the cloud is not contained into the z vector!')
-        
-    # Total optical depth vector
+            f'The cloud extinction must have one value for each of the {len(z)} '
+            f'levels of z, not the shape {np.shape(extinction)}')
     
-    for k in range(cloud_base+1, cloud_top):
-        loc[k]=loc[k]+coc*dz
-        
-    return lod, loc    
+    lod = _molecular_optical_depth(rho_n, csg, dz, out=np.empty(len(z), dtype=rho_n.dtype))
     
-def TOA_transmittances(lod, loc, z):    
+    if extinction is None:
+        extinction = cloud_extinction_profile(z, layers, tol)
+    else:
+        check([('The cloud extinction cannot be negative', np.any(np.asarray(extinction) < 0))])
+    
+    loc = lod + (extinction*_level_thickness(dz, len(z))).astype(lod.dtype)
+    
+    return lod, loc
+    
+@instrumented('TOA_transmittances')
+def TOA_transmittances(lod, loc, z, mu=1, out=None):    
     
     """ This function computes the transimittances at the 
          top of the atmosphere (TOA) for both cases: clear sky 
@@ -186,45 +493,96 @@ def TOA_transmittances(lod, loc, z):
              z           : altitude vector of the portion of atmosphere 
                            under consideration
                            
-             dz          : step value of the vector z
+             dz          : step value of the vector z, or thickness of each
+                           layer (layer_thickness(z)) for a non-uniform z
              
              lod         : molecular optical depth vector
              
              loc         : total optical depth vector
              
+             mu          : cosine of the viewing zenith angle (1 for nadir), 
+                           or array of cosines with shape (n_angles,)
+             
+             out         : pair of contiguous arrays (clear_t, cloudy_t) 
+                           with the shape of the output where the 
+                           transmittances are written, instead of new 
+                           arrays (see Workspace)
+             
         
         OUTPUT:
             
              clear_t     : clear sky transmittance vector
              
              cloudy_t    : cloudy sky transmittance vector
+             
+             If mu is an array, the transmittances of every angle are 
+             returned along a new first axis: (n_angles,) + lod.shape
                           
     """
     
-    # Initialization of the vectors
+    # mu has the floating point type of the optical depths, so that float32
+    # optical depths give float32 transmittances
+    
+    mu = np.asarray(mu, dtype=np.result_type(lod, loc))
     
-    clear_t = np.ones(len(z))
-    cloudy_t = np.ones(len(z))
+    check_columns(mu=mu)
     
-    # Transmittance vectors
+    if out is None:
+        out = (np.empty(mu.shape + np.shape(lod), dtype=mu.dtype),
+               np.empty(mu.shape + np.shape(loc), dtype=mu.dtype))
     
-    for i in range(len(z)-2, -1, -1):
-        clear_t[i] = clear_t[i+1]*np.exp(-lod[i])
-        cloudy_t[i] = cloudy_t[i+1]*np.exp(-loc[i])
+    clear_t, cloudy_t = out
+    
+    if not (clear_t.flags.c_contiguous and cloudy_t.flags.c_contiguous):
+        raise ValueError (
+            'The output arrays of the transmittances must be contiguous')
+    
+    for layers, transmittance in ((lod, clear_t), (loc, cloudy_t)):
+        
+        # An empty batch (no columns or no angles) has nothing to compute
+        
+        if transmittance.size == 0:
+            continue
+        
+        # One view of the output for every viewing angle (a single one 
+        # if mu is a scalar)
+        
+        angles = transmittance.reshape((mu.size,) + np.shape(layers))
+        tau = angles[-1]
+        
+        # Optical depth between each level and the TOA: reverse cumulative
+        # sum of the layer optical depths (the last level has tau = 0).
+        # The sum runs along the last axis, so batches of columns with
+        # shape (n_columns, n_levels) are handled in the same call. It is
+        # stored in the output of the last angle, the slant paths of the
+        # other angles are computed from it before it is overwritten
+        
+        np.cumsum(layers[..., ::-1], axis=-1, out=tau[..., ::-1])
+        
+        # Transmittance vectors
+        #
+        # exp(-sum(tau)) replaces the former running product of exp(-tau):
+        # the two agree to within a relative difference of 1e-12 on the
+        # default grid (dz = 0.005), see WFT_Testing.py
+        
+        # Slant path: the optical depth is divided by mu, computed once and
+        # used for all the viewing angles
+        
+        for angle, cosine in zip(angles, mu.reshape(-1)[:-1]):
+            np.divide(tau, -cosine, out=angle)
+            np.exp(angle, out=angle)
+        
+        np.divide(tau, -mu.reshape(-1)[-1], out=tau)
+        np.exp(tau, out=tau)
     
     #check if transmittances values are reasonable
     
-    for i in range(0,len(clear_t)-1):
-    	if (clear_t[i]<0) or (clear_t[i]>1):
-    		raise ValueError (
-    		'Transmittance must be between 0 and 1')
-    	if (cloudy_t[i]<0) or (cloudy_t[i]>1):
-    		raise ValueError (
-    		'Transmittance must be between 0 and 1')
+    check_transmittances(clear_t, cloudy_t)
     
     return clear_t, cloudy_t
 
-def weighting_function(clear_t, cloudy_t, z, dz):
+@instrumented('weighting_function')
+def weighting_function(clear_t, cloudy_t, z, dz, out=None):
     
     """ This function computes the weighting function
         for both cases: clear sky (using clear_t vector) 
@@ -240,6 +598,14 @@ def weighting_function(clear_t, cloudy_t, z, dz):
              
              cloudy_t         : cloudy sky transmittance vector
              
+             dz               : step value of the vector z, or thickness of 
+                                each layer for a non-uniform z
+             
+             out              : pair of arrays (weight_clear, weight_cloudy)
+                                with the shape of the transmittances where 
+                                the weighting functions are written, instead
+                                of new arrays (see Workspace)
+             
                         
          OUTPUT:
             
@@ -249,16 +615,583 @@ def weighting_function(clear_t, cloudy_t, z, dz):
                           
     """
     
-    # Initialization of the vectors
+    # Initialization of the vectors (with the floating point type of the
+    # transmittances)
+    
+    clear_t = np.asarray(clear_t)
+    cloudy_t = np.asarray(cloudy_t)
     
-    weight_clear = np.zeros(len(z))
-    weight_cloudy = np.zeros(len(z))
+    if out is None:
+        out = (np.empty(clear_t.shape, dtype=np.result_type(clear_t, np.float32)),
+               np.empty(cloudy_t.shape, dtype=np.result_type(cloudy_t, np.float32)))
 
-    for i in range(1,len(z)):
-         weight_clear[i] = (clear_t[i]-clear_t[i-1])/dz
-         weight_cloudy[i] = (cloudy_t[i]-cloudy_t[i-1])/dz
-     
-    return weight_clear, weight_cloudy
+    # Backward differences of the transmittances along the levels (last
+    # axis), the first level is 0
+    
+    for transmittance, weight in zip((clear_t, cloudy_t), out):
+        weight[..., 0] = 0
+        difference = np.subtract(transmittance[..., 1:], transmittance[..., :-1], out=weight[..., 1:])
+        difference /= dz
+    
+    return out
+
+
+class Workspace:
+    
+    """ Arrays of the numerical chain of one z grid, allocated once and 
+        reused by every call of profiles: when the chain is run many times
+        (i.e. in a loop over many columns) no new array is allocated.
+        
+        ATTRIBUTES:
+            
+            z, dz       : altitude vector and step value of the vector z, or
+                          thickness of each layer for a non-uniform z
+            
+            dtype       : floating point type of the arrays
+            
+            rho_n, lod, loc, clear_t, cloudy_t, weight_clear, weight_cloudy :
+                          arrays of the last computed column
+    
+    """
+    
+    def __init__(self, z, dz, dtype=np.float64):
+        
+        self.z = np.asarray(z, dtype=float)
+        self.dz = dz
+        self.dtype = np.dtype(dtype)
+        
+        # The cloud base and top are looked for in z, the density profile is
+        # computed from z in the type of the workspace
+        
+        self._z = self.z.astype(self.dtype)
+        
+        for name in ('rho_n', 'lod', 'loc', 'clear_t', 'cloudy_t', 'weight_clear', 'weight_cloudy'):
+            setattr(self, name, np.empty(len(self.z), dtype=self.dtype))
+    
+    def profiles(self, b, t, csg, coc, h, mu=1):
+        
+        """ This function runs the whole chain for one column, writing the 
+            results in the arrays of the workspace.
+            
+             INPUT:
+                 
+                 b, t, csg, coc, h : parameters of the column (scalars)
+                 
+                 mu          : cosine of the viewing zenith angle (scalar)
+             
+             OUTPUT:
+                 
+                 clear_t, cloudy_t, weight_clear, weight_cloudy : arrays of 
+                               the workspace, overwritten by the next call 
+                               (they must be copied to be kept)
+        
+        """
+        
+        normalized_density_profile(self._z, h, self.dtype, out=self.rho_n)
+        optical_depth(self.z, self.dz, b, t, csg, coc, self.rho_n, out=(self.lod, self.loc))
+        TOA_transmittances(self.lod, self.loc, self.z, mu, out=(self.clear_t, self.cloudy_t))
+        weighting_function(self.clear_t, self.cloudy_t, self.z, self.dz,
+                           out=(self.weight_clear, self.weight_cloudy))
+        
+        return self.clear_t, self.cloudy_t, self.weight_clear, self.weight_cloudy
+
+@instrumented('batch_normalized_density_profile')
+def batch_normalized_density_profile(z,h,dtype=np.float64):
+    
+    """ This function computes the normalized density profiles of 
+        many atmospheric columns at once, one for each scale height.
+   
+            
+        INPUT:
+            
+            z           : altitude vector shared by all the columns
+            
+            h           : vertical scale heights, one for each column
+            
+            dtype       : floating point type of the profiles
+            
+        
+        OUTPUT:
+            
+            rho_n       : normalized density profiles with shape 
+                          (n_columns, n_levels)
+                          
+    """
+    
+    z = np.asarray(z, dtype=dtype)
+    h = np.atleast_1d(np.asarray(h, dtype=dtype))[:, np.newaxis]
+    
+    check_columns(z, h=h[:, 0])
+    
+    rho = np.exp(-z/h)
+    
+    norm = h*(1-np.exp(-(z[len(z)-1])/h))
+    
+    rho_n = rho*norm
+    
+    return rho_n
+
+@instrumented('batch_optical_depth')
+def batch_optical_depth(z,dz,b,t,csg,coc,rho_n,tol=GRID_TOLERANCE):
+        
+    """ This function computes the molecular (lod) and total (loc) 
+         optical depths of many atmospheric columns at once. 
+         Every parameter can be either a scalar, shared by all the 
+         columns, or an array with one value for each column.
+          
+            
+         INPUT:
+            
+             z           : altitude vector shared by all the columns
+            
+             dz          : step value of the vector z, or thickness of each
+                           layer (layer_thickness(z)) for a non-uniform z
+             
+             b           : cloud bases
+             
+             t           : cloud tops
+             
+             csg         : cross sections per unit mass of absorbing gas
+             
+             coc         : absorption coefficients of cloud layers
+             
+             rho_n       : normalized density profiles, with shape 
+                           (n_columns, n_levels) or (n_levels,); lod and loc
+                           have the same floating point type
+             
+             tol         : tolerance used to find b and t in the z vector
+            
+        
+         OUTPUT:
+            
+             lod         : molecular optical depths (n_columns, n_levels)
+             
+             loc         : total optical depths (n_columns, n_levels)
+                          
+    """
+    
+    rho_n = np.atleast_2d(rho_n)
+    
+    # Columns parameters, broadcast against each other and the profiles
+    
+    b, t, csg, coc, _ = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(p, dtype=float)) for p in (b, t, csg, coc)),
+        rho_n[:, 0])
+    
+    # Check if b and t are in the layer of the considered atmosphere, 
+    # reporting the failing columns (see WFT_Validation.py)
+    
+    check_columns(z, b=b, t=t, csg=csg, coc=coc)
+    
+    # Molecular optical depths of all the columns, with the floating point
+    # type of the density profiles
+    
+    dtype = rho_n.dtype
+    
+    lod = _molecular_optical_depth(rho_n, csg[:, np.newaxis].astype(dtype), dz,
+                                   out=np.empty((len(b), len(z)), dtype=dtype))
+    
+    # Position of the base and the top of the clouds in the vector z
+    
+    cloud_base = grid_index(z, b, tol, 'The bottom of the cloud')
+    cloud_top = grid_index(z, t, tol, 'The top of the cloud')
+    
+    # Total optical depths: the cloud levels of each column are selected
+    # with a mask instead of a loop over the levels
+    
+    k = np.arange(len(z))
+    in_cloud = (k > cloud_base[:, np.newaxis]) & (k < cloud_top[:, np.newaxis])
+    
+    thickness = np.asarray(_level_thickness(dz, len(z)), dtype=dtype)
+    loc = lod + in_cloud*(coc[:, np.newaxis].astype(dtype)*thickness)
+    
+    return lod, loc
+
+def batch_profiles(z,dz,b,t,csg,coc,h,mu=1,dtype=np.float64):
+    
+    """ This function runs the whole chain (normalized density profile, 
+        optical depth, transmittances and weighting functions) for many 
+        atmospheric columns in a single vectorized pass on a shared z grid.
+                  
+            
+         INPUT:
+            
+             z           : altitude vector shared by all the columns
+                           
+             dz          : step value of the vector z, or thickness of each
+                           layer (layer_thickness(z)) for a non-uniform z
+             
+             b, t        : cloud bases and tops
+             
+             csg         : cross sections per unit mass of absorbing gas
+             
+             coc         : absorption coefficients of cloud layers
+             
+             h           : vertical scale heights
+             
+             mu          : cosine of the viewing zenith angle, or array of 
+                           cosines with shape (n_angles,)
+             
+             dtype       : floating point type of the computation (float32
+                           halves the memory of the arrays, see the README
+                           for its accuracy)
+             
+        
+        OUTPUT:
+            
+             clear_t, cloudy_t             : transmittances with shape 
+                                             (n_columns, n_levels), or 
+                                             (n_angles, n_columns, n_levels)
+             
+             weight_clear, weight_cloudy   : weighting functions with the 
+                                             same shape of the transmittances
+                          
+    """
+    
+    rho_n = batch_normalized_density_profile(z,h,dtype)
+    
+    lod, loc = batch_optical_depth(z,dz,b,t,csg,coc,rho_n)
+    
+    clear_t, cloudy_t = TOA_transmittances(lod, loc, z, mu)
+    
+    weight_clear, weight_cloudy = weighting_function(clear_t, cloudy_t, z, dz)
+    
+    return clear_t, cloudy_t, weight_clear, weight_cloudy
+
+def spectral_profiles(z,dz,b,t,csg,coc,h,mu=1,dtype=np.float64):
+    
+    """ This function computes transmittances and weighting functions of 
+        one atmospheric column in many spectral bands at once. The bands
+        share the height vector, the density profile and the cloud layer,
+        while the gas cross section (and optionally the cloud absorption 
+        coefficient) changes from band to band.
+                  
+            
+         INPUT:
+             
+             z           : altitude vector of the portion of atmosphere 
+                           under consideration
+                           
+             dz          : step value of the vector z, or thickness of each
+                           layer (layer_thickness(z)) for a non-uniform z
+             
+             b, t        : cloud base and top
+             
+             csg         : cross sections per unit mass of absorbing gas, 
+                           one for each band, with shape (n_bands,)
+             
+             coc         : absorption coefficient of the cloud layer, shared
+                           by all the bands or one for each band
+             
+             h           : vertical scale height
+             
+             mu          : cosine of the viewing zenith angle, or array of 
+                           cosines with shape (n_angles,)
+             
+             dtype       : floating point type of the computation
+             
+        
+        OUTPUT:
+            
+             clear_t, cloudy_t             : transmittances with shape 
+                                             (n_bands, n_levels), or 
+                                             (n_angles, n_bands, n_levels)
+             
+             weight_clear, weight_cloudy   : weighting functions with the 
+                                             same shape of the transmittances
+                          
+    """
+    
+    # One density profile for all the bands, broadcast against the cross 
+    # sections by batch_optical_depth
+    
+    rho_n = normalized_density_profile(z,h,dtype)
+    
+    lod, loc = batch_optical_depth(z,dz,b,t,csg,coc,rho_n)
+    
+    clear_t, cloudy_t = TOA_transmittances(lod, loc, z, mu)
+    
+    weight_clear, weight_cloudy = weighting_function(clear_t, cloudy_t, z, dz)
+    
+    return clear_t, cloudy_t, weight_clear, weight_cloudy
+
+# Radiation constants of the Planck function for wavenumbers in cm^-1:
+# 2hc^2 [W m^-2 sr^-1 (cm^-1)^-4] and hc/k [cm K]
+
+PLANCK_C1 = 1.191042972e-8
+PLANCK_C2 = 1.4387769
+
+# Temperature [K] of the 1976 US standard atmosphere at its breakpoints [km]
+
+STANDARD_ATMOSPHERE = ((0, 11, 20, 32, 47, 51, 71, 84.852),
+                       (288.15, 216.65, 216.65, 228.65, 270.65, 270.65, 214.65, 186.946))
 
+def standard_temperature_profile(z):
 
+    """ This function returns the temperature [K] of the 1976 US standard
+        atmosphere at the heights z [km], linear between the breakpoints of
+        STANDARD_ATMOSPHERE.
+    """
+
+    return np.interp(z, *STANDARD_ATMOSPHERE)
+
+def planck(wavenumber, temperature):
+
+    """ This function computes the Planck function (black body radiance).
+
+
+         INPUT:
+
+             wavenumber  : wavenumbers [cm^-1]
+
+             temperature : temperatures [K], broadcast against wavenumber
+
+
+         OUTPUT:
+
+             radiance    : black body radiance [W m^-2 sr^-1 (cm^-1)^-1]
+
+    """
+
+    wavenumber = np.asarray(wavenumber)
+    temperature = np.asarray(temperature)
+
+    # exp overflows only where the radiance is negligible (0 is returned)
+
+    with np.errstate(over='ignore'):
+        return PLANCK_C1*wavenumber**3/np.expm1(PLANCK_C2*wavenumber/temperature)
+
+def brightness_temperature(wavenumber, radiance):
+
+    """ This function inverts the Planck function: it returns the
+        temperature [K] of the black body emitting radiance [W m^-2 sr^-1
+        (cm^-1)^-1] at wavenumber [cm^-1] (broadcast against each other).
+    """
+
+    radiance = np.asarray(radiance)
+
+    check([(RADIANCE, radiance <= 0)], radiance.shape)
+
+    return PLANCK_C2*np.asarray(wavenumber)/np.log1p(PLANCK_C1*np.asarray(wavenumber)**3/radiance)
+
+@instrumented('TOA_radiance')
+def TOA_radiance(weight_clear, weight_cloudy, dz, wavenumber, temperature,
+                 surface_temperature, emissivity=1):
+
+    """ This function computes the upwelling radiance at the top of the
+        atmosphere for clear and cloudy sky (Schwarzschild's equation
+        solution): the surface emission crossing the whole atmosphere plus
+        the integral of the Planck function weighted by the weighting
+        function,
+
+            L = emissivity*B(Ts)*T(z0) + integral of B(T(z))*W(z) dz
+
+        The integral is the sum over the layers of the mean Planck function
+        of the two levels of the layer times W*dz (the transmittance change
+        across the layer); the transmittance of the surface follows from
+        the weighting function, being 1 at the TOA. The radiance reflected
+        by a non-black surface is not included.
+
+
+         INPUT:
+
+             weight_clear, weight_cloudy : weighting functions, with the
+                                           levels on the last axis (as
+                                           returned by weighting_function)
+
+             dz          : step value of the vector z, or thickness of each
+                           layer for a non-uniform z
+
+             wavenumber  : wavenumbers [cm^-1], broadcast against the
+                           weighting functions without their last axis,
+                           i.e. with shape (n_bands,) for spectral_profiles
+
+             temperature : temperature profile [K], one value for each
+                           level, shared by all the columns or with the
+                           shape of the weighting functions
+
+             surface_temperature : temperature of the surface [K], a number
+                           or one value for each column
+
+             emissivity  : emissivity of the surface
+
+
+         OUTPUT:
+
+             radiance_clear, radiance_cloudy : TOA radiances [W m^-2 sr^-1
+                                               (cm^-1)^-1] with the shape of
+                                               the weighting functions
+                                               without their last axis
+
+    """
+
+    weight_clear = np.asarray(weight_clear)
+    weight_cloudy = np.asarray(weight_cloudy)
+
+    # Planck function in the floating point type of the weighting functions
+
+    dtype = np.result_type(weight_clear, weight_cloudy, np.float32)
+    n_levels = weight_clear.shape[-1]
+
+    wavenumber = np.asarray(wavenumber, dtype=dtype)
+    temperature = np.asarray(temperature, dtype=dtype)
+    surface_temperature = np.asarray(surface_temperature, dtype=dtype)
+
+    if temperature.shape[-1:] != (n_levels,):
+        raise ValueError (
+            'The temperature profile must have one value for each level of z')
+
+    # Check the temperatures, wavenumbers and emissivity, reporting the
+    # failing columns (see WFT_Validation.py)
+
+    check_radiance_inputs(wavenumber, temperature, surface_temperature, emissivity,
+                          weight_clear.shape[:-1])
+
+    # Planck function of every level and mean of every layer, evaluated once
+    # for clear and cloudy sky
+
+    emission = planck(wavenumber[..., np.newaxis], temperature)
+    emission = 0.5*(emission[..., 1:] + emission[..., :-1])
+    surface = emissivity*planck(wavenumber, surface_temperature)
+
+    # The thickness of the layers is folded into the (small) Planck term, so
+    # that no array as large as the weighting functions is created
+
+    layer_dz = np.broadcast_to(np.asarray(dz, dtype=dtype), (n_levels-1,))
+    emission = emission*layer_dz
+
+    radiances = []
+
+    for weight in (weight_clear, weight_cloudy):
+
+        # Transmittance of the surface (the sum of W*dz is the transmittance
+        # change from the surface to the TOA) and atmospheric emission
+
+        surface_t = 1 - weight[..., 1:] @ layer_dz
+
+        atmosphere = np.einsum('...i,...i->...', emission, weight[..., 1:])
+
+        radiances.append(surface*surface_t + atmosphere)
+
+    return tuple(radiances)
+
+# Parameters of the jacobians computed by profile_jacobians
+
+JACOBIAN_PARAMETERS = ('csg', 'coc', 'h', 'b', 't')
+
+def profile_jacobians(z,dz,b,t,csg,coc,h,mu=1):
+    
+    """ This function computes transmittances and weighting functions, as
+        batch_profiles, together with their derivatives with respect to 
+        csg, coc, h, b and t, in the same vectorized pass (forward mode):
+        every derivative is propagated through the chain next to the 
+        profile it belongs to, so that the cost is close to one forward 
+        evaluation instead of two for each parameter (finite differences).
+        
+        For the cloud base and top, whose position on the z vector moves 
+        by whole levels, the derivative of the continuous cloud is used: 
+        raising t by dt adds coc*dt to the optical depth of every level 
+        below the cloud top, raising b by db removes coc*db from the levels
+        at or below the cloud base.
+        
+        The parameters can be scalars or arrays (one value for each column) 
+        as in batch_profiles.
+                  
+            
+         INPUT:
+             
+             z           : altitude vector shared by all the columns
+                           
+             dz          : step value of the vector z, or thickness of each
+                           layer (layer_thickness(z)) for a non-uniform z
+             
+             b, t        : cloud bases and tops
+             
+             csg         : cross sections per unit mass of absorbing gas
+             
+             coc         : absorption coefficients of cloud layers
+             
+             h           : vertical scale heights
+             
+             mu          : cosine of the viewing zenith angle (a single 
+                           angle, a number)
+             
+        
+        OUTPUT:
+            
+             profiles    : clear_t, cloudy_t, weight_clear, weight_cloudy
+             
+             jacobians   : dictionary parameter -> derivatives of 
+                           (clear_t, cloudy_t, weight_clear, weight_cloudy)
+                           with respect to that parameter, for every 
+                           parameter of JACOBIAN_PARAMETERS
+             
+             All the arrays have shape (n_columns, n_levels), or (n_levels,)
+             if all the parameters are scalars.
+                          
+    """
+    
+    if np.ndim(mu) != 0:
+        raise ValueError (
+            'The jacobians are computed for a single viewing angle: mu must be a number')
+    
+    single = all(np.ndim(p) == 0 for p in (b, t, csg, coc, h))
+    
+    b, t, csg, coc, h = (p[:, np.newaxis] for p in np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(p, dtype=float)) for p in (b, t, csg, coc, h))))
+    
+    # Forward chain
+    
+    rho_n = batch_normalized_density_profile(z, h[:, 0])
+    lod, loc = batch_optical_depth(z,dz,b[:, 0],t[:, 0],csg[:, 0],coc[:, 0],rho_n)
+    clear_t, cloudy_t = TOA_transmittances(lod, loc, z, mu)
+    weight_clear, weight_cloudy = weighting_function(clear_t, cloudy_t, z, dz)
+    
+    # Derivative of the normalized density profile with respect to h
+    
+    z_top = z[len(z)-1]
+    decay = np.exp(-z/h)
+    norm = h*(1-np.exp(-z_top/h))
+    d_norm = (1-np.exp(-z_top/h)) - (z_top/h)*np.exp(-z_top/h)
+    d_rho_n = decay*(z/h**2)*norm + decay*d_norm
+    
+    # Derivatives of the layer optical depths: the gas term is shared by 
+    # clear and cloudy sky, the cloud term only affects the cloudy sky
+    
+    d_lod_h = _molecular_optical_depth(d_rho_n, csg, dz, out=np.empty(lod.shape))
+    
+    d_loc_coc = (loc - lod)/coc
+    
+    # Derivatives of the optical depth between each level and the TOA
+    
+    def reverse_cumsum(x):
+        return np.cumsum(x[..., ::-1], axis=-1)[..., ::-1]
+    
+    d_tau_clear = {'csg' : reverse_cumsum(lod)/csg, 'h' : reverse_cumsum(d_lod_h)}
+    
+    cloud_base = grid_index(z, b[:, 0], name='The bottom of the cloud')[:, np.newaxis]
+    cloud_top = grid_index(z, t[:, 0], name='The top of the cloud')[:, np.newaxis]
+    k = np.arange(len(z))
+    
+    d_tau_cloudy = {'csg' : d_tau_clear['csg'], 'h' : d_tau_clear['h'],
+                    'coc' : reverse_cumsum(d_loc_coc),
+                    'b' : -coc*(k <= cloud_base),
+                    't' : coc*(k < cloud_top)}
+    
+    # Derivatives of transmittances (dT = -T dtau/mu) and weighting functions
+    
+    jacobians = {}
+    
+    for p in JACOBIAN_PARAMETERS:
+        d_clear_t = -clear_t*d_tau_clear[p]/mu if p in d_tau_clear else np.zeros(clear_t.shape)
+        d_cloudy_t = -cloudy_t*d_tau_cloudy[p]/mu
+        d_weights = weighting_function(d_clear_t, d_cloudy_t, z, dz)
+        jacobians[p] = (d_clear_t, d_cloudy_t) + d_weights
+    
+    profiles = (clear_t, cloudy_t, weight_clear, weight_cloudy)
+    
+    if single:
+        profiles = tuple(p[0] for p in profiles)
+        jacobians = {p : tuple(d[0] for d in jacobians[p]) for p in jacobians}
     
+    return profiles, jacobians
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+#----------------------------------------
+# Opt-in timing of the WFT pipeline stages
+#----------------------------------------
+#
+# The stages of WFT_Functions (decorated with @instrumented) and the
+# output steps of WFT_Profile (wrapped in "with stage(...)") report their
+# wall time, number of calls and size of the arrays they allocate to the
+# active Instrumentation, if any (the results written in arrays given
+# with out= are not counted). Without an active Instrumentation the
+# only cost is the check of a global variable.
+#
+#        recorder = Instrumentation()
+#        with instrument(recorder):
+#            WFT_Profile.run(config)
+#        print(recorder.report())
+#
+
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Instrumentation receiving the measures (None: instrumentation disabled)
+
+_active = None
+
+class Instrumentation:
+
+    """ Collector of the measures of the pipeline stages.
+
+        ATTRIBUTES:
+
+            stages      : dictionary stage name -> {'calls', 'seconds', 'bytes'}
+                          with the total over all the calls of the stage
+
+            callback    : optional function callback(name, seconds, nbytes)
+                          called at the end of every stage
+
+    """
+
+    def __init__(self, callback=None):
+
+        self.stages = {}
+        self.callback = callback
+
+    def record(self, name, seconds, nbytes=0):
+
+        """ Adds one call of the stage name to the measures. """
+
+        totals = self.stages.setdefault(name, {'calls' : 0, 'seconds' : 0.0, 'bytes' : 0})
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        totals['bytes'] += nbytes
+
+        if self.callback is not None:
+            self.callback(name, seconds, nbytes)
+
+    def report(self):
+
+        """ This function returns the measures of every stage, ordered by
+            decreasing total time, with the mean time of a call and the
+            fraction of the total time of all the stages.
+        """
+
+        total = sum(s['seconds'] for s in self.stages.values()) or 1.0
+
+        report = {}
+        for name, s in sorted(self.stages.items(), key=lambda item: -item[1]['seconds']):
+            report[name] = dict(s, mean_seconds = s['seconds']/s['calls'],
+                                fraction = s['seconds']/total)
+
+        return report
+
+    def format_report(self):
+
+        """ Report as a text table. """
+
+        lines = [f'{"stage":28s} {"calls":>7s} {"total [ms]":>11s} {"mean [ms]":>10s} '
+                 f'{"MiB":>9s} {"%":>6s}']
+        for name, s in self.report().items():
+            lines.append(f'{name:28s} {s["calls"]:7d} {s["seconds"]*1e3:11.3f} '
+                         f'{s["mean_seconds"]*1e3:10.3f} {s["bytes"]/2**20:9.2f} '
+                         f'{s["fraction"]*100:6.1f}')
+
+        return '\n'.join(lines)
+
+@contextmanager
+def instrument(instrumentation=None):
+
+    """ Activates instrumentation (a new Instrumentation if None) inside
+        the with block and returns it.
+    """
+
+    global _active
+
+    previous = _active
+    _active = instrumentation if instrumentation is not None else Instrumentation()
+
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+def _arrays(value):
+
+    """ Arrays of a result or of an out= argument (an array or a tuple). """
+
+    if isinstance(value, np.ndarray):
+        return [value]
+
+    if isinstance(value, (tuple, list)):
+        return [a for v in value for a in _arrays(v)]
+
+    return []
+
+def _nbytes(result, out=None):
+
+    """ Size of the arrays returned by a stage, without the ones written in
+        the arrays given with out= (not allocated by the stage).
+    """
+
+    reused = _arrays(out)
+
+    return sum(a.nbytes for a in _arrays(result)
+               if not any(np.may_share_memory(a, r) for r in reused))
+
+def instrumented(name):
+
+    """ Decorator recording every call of the function as the stage name. """
+
+    def decorator(function):
+
+        # Position of the out= argument of the function, if it has one
+
+        parameters = list(inspect.signature(function).parameters)
+        position = parameters.index('out') if 'out' in parameters else None
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+
+            recorder = _active
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            seconds = time.perf_counter() - start
+
+            if position is not None and len(args) > position:
+                out = args[position]
+            else:
+                out = kwargs.get('out')
+
+            recorder.record(name, seconds, _nbytes(result, out))
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+@contextmanager
+def stage(name, nbytes=0):
+
+    """ Records the with block as one call of the stage name. """
+
+    if _active is None:
+        yield
+        return
+
+    recorder = _active
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        recorder.record(name, time.perf_counter() - start, nbytes)
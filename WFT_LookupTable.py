@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+#-----------------------------------------------------------------
+# Lookup tables of the Weighting functions and Transmittances model
+#-----------------------------------------------------------------
+#
+# The transmittances and the weighting functions for clear and cloudy sky
+# are computed once with the WFT_Functions chain on a grid of the
+# parameters (cloud base and top, cross section, cloud absorption
+# coefficient, scale height and viewing angle) and stored. A query is a
+# weighted sum of the stored profiles of the neighbouring nodes: linear
+# in the cross section, the absorption coefficient, the scale height and
+# the cosine of the viewing angle, while the cloud base and top must be
+# nodes of the table (a cloud edge between two levels is not the mean of
+# the two profiles). No exponential is evaluated for a query.
+#
+# i.e for Linux users:
+#
+#        python3 WFT_LookupTable.py --h 5 9 41 --csg 0.1 0.3 3
+#
+#-----------------------------------------------------------------
+#
+
+import argparse
+import itertools
+from configparser import ConfigParser
+
+import numpy as np
+import WFT_Functions as fn
+from WFT_Sweep import PROFILES
+from WFT_Validation import check, check_columns
+
+# Axes of the table, in the order of the stored profiles, and the ones
+# whose values must be nodes of the table
+
+AXES = ('b', 't', 'csg', 'coc', 'h', 'mu')
+EXACT_AXES = ('b', 't')
+
+# Names of the axes in the error messages
+
+AXIS_NAMES = {'b' : 'The bottom of the cloud', 't' : 'The top of the cloud',
+              'csg' : 'The cross section', 'coc' : 'The absorption coefficient of the cloud',
+              'h' : 'The scale height', 'mu' : 'The cosine of the zenith angle'}
+
+class LookupTable:
+
+    """ Profiles of the model on a grid of parameters.
+
+        ATTRIBUTES:
+
+            z, dz       : height vector and step (or layer thicknesses)
+
+            axes        : dictionary with the nodes of every axis of AXES
+
+            profiles    : clear_t, cloudy_t, weight_clear and weight_cloudy
+                          of every node, shape (n_nodes, 4, n_levels), the
+                          nodes in the order of AXES (C order); the nodes
+                          with the cloud base at or above the top are NaN
+
+            errors      : largest absolute errors of the interpolated profiles
+                          (see error_bounds) computed when the table was built
+
+    """
+
+    def __init__(self, z, dz, axes, profiles, errors=None):
+
+        self.z = np.asarray(z, dtype=float)
+        self.dz = dz
+        self.axes = {name : np.atleast_1d(np.asarray(axes[name], dtype=float)) for name in AXES}
+        self.profiles = profiles
+        self.errors = errors
+
+        self.shape = tuple(len(self.axes[name]) for name in AXES)
+
+        # Distance between the rows of two consecutive nodes of every axis
+
+        self._strides = np.cumprod((1,) + self.shape[:0:-1])[::-1]
+
+    @property
+    def nbytes(self):
+
+        """ Memory [bytes] taken by the tabulated profiles. """
+
+        return self.profiles.nbytes
+
+    def query(self, b, t, csg, coc, h, mu=1):
+
+        """ This function interpolates the table to compute the transmittances
+            and the weighting functions for clear and cloudy sky. Every
+            parameter can be a scalar or an array with one value for each
+            column, as in fn.batch_profiles.
+
+
+             INPUT:
+
+                 b, t        : cloud bases and tops (nodes of the table)
+
+                 csg         : cross sections per unit mass of absorbing gas
+
+                 coc         : absorption coefficients of cloud layers
+
+                 h           : vertical scale heights
+
+                 mu          : cosines of the viewing zenith angles, one for
+                               each column
+
+                 csg, coc, h and mu must be inside the range of the table.
+
+
+             OUTPUT:
+
+                 clear_t, cloudy_t             : transmittances with shape
+                                                 (n_columns, n_levels), or
+                                                 (n_levels,) if all the
+                                                 parameters are scalars, with
+                                                 the type of the table
+
+                 weight_clear, weight_cloudy   : weighting functions with the
+                                                 same shape of the transmittances
+
+        """
+
+        scalar = all(np.ndim(p) == 0 for p in (b, t, csg, coc, h, mu))
+
+        values = np.broadcast_arrays(
+            *(np.atleast_1d(np.asarray(p, dtype=float)) for p in (b, t, csg, coc, h, mu)))
+
+        check_columns(b=values[0], t=values[1], csg=values[2], coc=values[3], h=values[4], mu=values[5])
+
+        # Lower node of every column on every axis, and the weights of the
+        # upper node on the interpolated axes
+
+        index = []
+        weights = []
+
+        for k, (name, value) in enumerate(zip(AXES, values)):
+            axis = self.axes[name]
+
+            if name in EXACT_AXES:
+                index.append(_node_index(axis, value, AXIS_NAMES[name]))
+            else:
+                lower, weight = _interpolation_weights(axis, value, AXIS_NAMES[name])
+                index.append(lower)
+                if len(axis) > 1:
+                    weights.append((self._strides[k], weight))
+
+        rows = np.ravel_multi_index(index, self.shape)
+
+        # Weighted sum of the profiles of the 2**n_axes neighbouring nodes;
+        # the nodes with a null weight for all the columns (i.e. queries on
+        # the nodes of an axis) are skipped
+
+        profiles = None
+
+        for corner in itertools.product((0, 1), repeat=len(weights)):
+            weight = np.ones(len(rows))
+            offset = 0
+            for upper, (stride, w) in zip(corner, weights):
+                weight = weight*(w if upper else 1-w)
+                offset += upper*stride
+
+            if not weight.any():
+                continue
+
+            term = self.profiles[rows+offset]
+            term *= weight.astype(term.dtype)[:, np.newaxis, np.newaxis]
+
+            if profiles is None:
+                profiles = term
+            else:
+                profiles += term
+
+        profiles = tuple(profiles[:, k] for k in range(len(PROFILES)))
+
+        if scalar:
+            profiles = tuple(p[0] for p in profiles)
+
+        return profiles
+
+    def error_bounds(self):
+
+        """ This function estimates the interpolation errors of the table,
+            comparing the queries with the exact computation
+            (fn.batch_profiles) in the middle of every interval of every
+            interpolated axis, where linear interpolation is the least
+            accurate; the other parameters are at their first node (and the
+            cloud at the first node with the base below the top).
+
+             OUTPUT:
+
+                 errors      : dictionary with the largest absolute error of
+                               every profile (see WFT_Sweep.PROFILES)
+
+        """
+
+        b, t = self.axes['b'], self.axes['t']
+        pairs = [(x, y) for x in b for y in t if x < y]
+        reference = dict({name : self.axes[name][0] for name in AXES}, b=pairs[0][0], t=pairs[0][1])
+
+        columns = []
+        for name in AXES:
+            axis = self.axes[name]
+            if name not in EXACT_AXES and len(axis) > 1:
+                columns += [dict(reference, **{name : value}) for value in 0.5*(axis[:-1]+axis[1:])]
+
+        errors = dict.fromkeys(PROFILES, 0.0)
+
+        for mu in np.unique([c['mu'] for c in columns]):
+            group = [c for c in columns if c['mu'] == mu]
+            parameters = [[c[name] for c in group] for name in AXES[:-1]]
+
+            exact = fn.batch_profiles(self.z, self.dz, *parameters, mu)
+            interpolated = self.query(*parameters, mu)
+
+            for name, e, i in zip(PROFILES, exact, interpolated):
+                errors[name] = max(errors[name], float(np.max(np.abs(e-i))))
+
+        return errors
+
+    def save(self, filename):
+
+        """ This function stores the table in a single .npz file. """
+
+        errors = self.errors or {}
+
+        np.savez(filename, z=self.z, dz=np.asarray(self.dz), profiles=self.profiles,
+                 error_names=np.array(list(errors), dtype=str),
+                 error_values=np.array(list(errors.values()), dtype=float),
+                 **self.axes)
+
+def _node_index(axis, values, name):
+
+    """ Position of values among the nodes of axis, which they must match
+        (within fn.GRID_TOLERANCE).
+    """
+
+    index = fn.grid_index(axis, values, tol=np.inf) if len(axis) > 1 else np.zeros(len(values), dtype=int)
+
+    check([(f'{name} is not a node of the table!', np.abs(axis[index] - values) > fn.GRID_TOLERANCE)],
+          values.shape)
+
+    return index
+
+def _interpolation_weights(axis, values, name):
+
+    """ Position of values in the grid axis: index of the lower node and
+        weight of the upper one. An axis with a single node only accepts
+        that value.
+    """
+
+    check([(f'{name} is outside the range of the table!',
+            (values < axis[0]-fn.GRID_TOLERANCE) | (values > axis[-1]+fn.GRID_TOLERANCE))], values.shape)
+
+    if len(axis) == 1:
+        return np.zeros(len(values), dtype=int), np.zeros(len(values))
+
+    index = np.clip(np.searchsorted(axis, values, side='right')-1, 0, len(axis)-2)
+    weight = np.clip((values-axis[index])/(axis[index+1]-axis[index]), 0, 1)
+
+    return index, weight
+
+def build_table(z, dz, b=1, t=2, csg=0.2, coc=5, h=7, mu=1, dtype=np.float32, chunk_size=256):
+
+    """ This function computes a lookup table with the WFT_Functions chain.
+
+
+         INPUT:
+
+             z, dz       : height vector and step (or layer thicknesses)
+
+             b, t, csg, coc, h, mu : nodes of every axis of the table (a
+                           number or a sequence); cloud bases and tops are
+                           levels of z
+
+             dtype       : type of the stored profiles (float32 halves the size
+                           of the table and the time of the queries, with
+                           relative errors of about 1e-7)
+
+             chunk_size  : number of nodes computed in a single call
+
+
+         OUTPUT:
+
+             table       : LookupTable
+
+    """
+
+    axes = {name : np.unique(np.asarray(value, dtype=float))
+            for name, value in zip(AXES, (b, t, csg, coc, h, mu))}
+
+    for name in AXES:
+        check_columns(z, **{name : axes[name]})
+
+    # All the nodes but the viewing angle, which is computed for all of them
+    # at once
+
+    nodes = [g.ravel() for g in np.meshgrid(*(axes[name] for name in AXES[:-1]), indexing='ij')]
+    valid = np.flatnonzero(nodes[0] < nodes[1])
+
+    check([('No node of the table has the cloud base below the cloud top', len(valid) == 0)])
+
+    profiles = np.full((len(nodes[0]), len(axes['mu']), len(PROFILES), len(z)), np.nan, dtype=dtype)
+
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start+chunk_size]
+
+        computed = fn.batch_profiles(z, dz, *(p[chunk] for p in nodes), axes['mu'])
+
+        # (4, n_angles, n_chunk, n_levels) -> (n_chunk, n_angles, 4, n_levels)
+
+        profiles[chunk] = np.moveaxis(np.stack(computed), (0, 1, 2), (2, 1, 0))
+
+    table = LookupTable(z, dz, axes, profiles.reshape(-1, len(PROFILES), len(z)))
+    table.errors = table.error_bounds()
+
+    return table
+
+def load_table(filename):
+
+    """ This function reads a table stored by LookupTable.save. """
+
+    with np.load(filename) as data:
+        dz = data['dz']
+        errors = dict(zip(data['error_names'].tolist(), data['error_values'].tolist()))
+
+        return LookupTable(data['z'], float(dz) if dz.ndim == 0 else dz,
+                           {name : data[name] for name in AXES}, data['profiles'],
+                           errors or None)
+
+def main(argv=None):
+
+    """ Command line interface: every axis is given as START STOP NUM (as in
+        np.linspace), the axes that are not given have the single node of
+        Configuration.ini (the scale heights go from 5 to 9 km in 41 nodes).
+    """
+
+    parser = ConfigParser()
+    parser.read("Configuration.ini")
+
+    defaults = {
+        'b' : parser.getfloat("General_Variables", "Bottom_cloud", fallback = 1),
+        't' : parser.getfloat("General_Variables", "Top_cloud", fallback = 2),
+        'csg' : parser.getfloat("General_Variables", "Cross_section_abs_gas", fallback = 0.2),
+        'coc' : parser.getfloat("General_Variables", "Abs_coeff_cloud", fallback = 5),
+        'h' : (5, 9, 41),
+        'mu' : parser.getfloat("General_Variables", "cos_zenith_angle", fallback = 1)}
+
+    arguments = argparse.ArgumentParser(description = 'Lookup table of the WFT model')
+    for name, text in (('b', 'cloud bases [km] (levels of the height vector)'),
+                       ('t', 'cloud tops [km] (levels of the height vector)'),
+                       ('csg', 'cross sections per unit mass of absorbing gas'),
+                       ('coc', 'absorption coefficients of the cloud layer'),
+                       ('h', 'vertical scale heights [km]'),
+                       ('mu', 'cosines of the viewing zenith angles')):
+        arguments.add_argument(f'--{name}', nargs=3, type=float, metavar=('START', 'STOP', 'NUM'),
+                               help = text)
+    arguments.add_argument('--dz', type=float, default=fn.DZ,
+                           help = 'step value of the height vector [km]')
+    arguments.add_argument('--dtype', choices=('float32', 'float64'), default='float32',
+                           help = 'type of the stored profiles')
+    arguments.add_argument('--output', default='./OUTPUT/LookupTable.npz',
+                           help = 'output .npz file')
+    args = arguments.parse_args(argv)
+
+    nodes = {}
+    for name in AXES:
+        value = getattr(args, name)
+        if value is None:
+            value = defaults[name]
+        nodes[name] = np.linspace(value[0], value[1], int(value[2])) if np.ndim(value) else value
+
+    z = fn.z_vector(fn.Z1, args.dz, fn.Z2, fn.Z2)
+
+    table = build_table(z, args.dz, **nodes, dtype = args.dtype)
+
+    table.save(args.output)
+
+    print(f'Table of {table.nbytes/2**20:.2f} MiB stored in {args.output}')
+    for name, error in table.errors.items():
+        print(f'{name:14s} largest interpolation error {error:.3g}')
+
+if __name__ == "__main__":
+    main()
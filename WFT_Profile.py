@@ -1,181 +1,334 @@
 #!/usr/bin/python3
 #-----------------------------------------------------------------
-# Weighting functions and Transmittances 
+# Weighting functions and Transmittances
 #-----------------------------------------------------------------
 #
-# "Weighting_Function_&_Transmittance" is a simple model to compute 
-# the weighting functions and transmittances in clear air and 
-# in presence of a cloud layer. 
-# 
+# "Weighting_Function_&_Transmittance" is a simple model to compute
+# the weighting functions and transmittances in clear air and
+# in presence of a cloud layer.
+#
 # It is assumed that clouds only absorb and emit (i.e there is no scattering).
 #
+# Importing this file has no side effects: the model is run by main()
+# (command line) or by run(config) (from other programs). Matplotlib is
+# imported only when the plots are requested.
+#
+# i.e for Linux users:
+#
+#        python3 WFT_Profile.py [--config Configuration.ini] [--no-plots]
+#                               [--format {txt,npy,both}] [--timing]
+#                               [--no-cache] [--cache-dir OUTPUT/Cache/]
+#
+# Results and figures are cached on disk (see WFT_Cache.py): running again
+# with the same configuration and code copies the stored files.
 #
 #-----------------------------------------------------------------
 #
 
-import matplotlib.pyplot as plt
+import argparse
+import sys
 import numpy as np
 import WFT_Functions as fn
 from configparser import ConfigParser
+from WFT_Cache import CACHE_DIR, ResultCache, code_version
+from WFT_Instrumentation import Instrumentation, instrument, stage
+import WFT_Render
+from WFT_Render import FIGURE_FILES, render_scene
 
+#Definition of the base and the top of the considered atmosphere
+z1 = fn.Z1
+z2 = fn.Z2
+dz = fn.DZ
+#These are the values of the atmosphere where there's LTE, so z1=0 is the Earth surface and z2=50 is the top of the atmosphere
 
-# These variables are obtained from the configuration file: "Configuration.ini"
+def read_configuration(filename="Configuration.ini"):
 
-parser = ConfigParser()
-parser.read("Configuration.ini")
+    """ This function reads the general variables and the output path
+        from the configuration file.
 
-b = parser.getfloat("General_Variables", "Bottom_cloud",
-                         fallback = 1)
-t = parser.getfloat("General_Variables", "Top_cloud",
-                         fallback = 2)
-csg = parser.getfloat("General_Variables", "Cross_section_abs_gas",
-                         fallback = 0.2)
-coc = parser.getfloat("General_Variables", "Abs_coeff_cloud",
-                         fallback = 5)
-top = parser.getfloat("General_Variables", "Top_level",
-                         fallback = 20)
-h = parser.getfloat("General_Variables", "vertical_height_scale",
-                         fallback = 7)
-#Definition of the base and the top of the considered atmosphere
-z1 = 0
-z2 = 50
-dz= 0.005
-#These are the values of the atmosphere where there's LTE, so z1=0 is the Earth surface and z2=50 is the top of the atmosphere
+         INPUT:
 
-z = fn.z_vector(z1, dz, z2, top)
+             filename    : path of the configuration file
 
-rho_n= fn.normalized_density_profile(z,h)
+         OUTPUT:
 
-lod, loc = fn.optical_depth(z,dz,b,t,csg,coc,rho_n)
+             config      : dictionary with the cloud base (b) and top (t),
+                           the cross section (csg), the cloud absorption
+                           coefficient (coc), the top level of the plots (top),
+                           the scale height (h), the cosine of the viewing
+                           zenith angle (mu) and the output path
 
-#FIG.1
+    """
 
-clear_t, cloudy_t = fn.TOA_transmittances(lod, loc, z)
+    parser = ConfigParser()
+    parser.read(filename)
 
-#Find the position in z vector of "top" value
+    config = {
+        'b' : parser.getfloat("General_Variables", "Bottom_cloud",
+                              fallback = 1),
+        't' : parser.getfloat("General_Variables", "Top_cloud",
+                              fallback = 2),
+        'csg' : parser.getfloat("General_Variables", "Cross_section_abs_gas",
+                                fallback = 0.2),
+        'coc' : parser.getfloat("General_Variables", "Abs_coeff_cloud",
+                                fallback = 5),
+        'top' : parser.getfloat("General_Variables", "Top_level",
+                                fallback = 20),
+        'h' : parser.getfloat("General_Variables", "vertical_height_scale",
+                              fallback = 7),
+        'mu' : parser.getfloat("General_Variables", "Cos_zenith_angle",
+                               fallback = 1),
+        'output_path' : parser.get('Output_Path', 'output_graph',
+                                   fallback = './OUTPUT/')}
 
-z=list(z)
+    return config
 
-zt=z.index(top)
+def compute_profiles(config):
 
-#Definition of the x and y axes for the plot
+    """ This function runs the numerical chain of the model: height vector,
+        normalized density profile, optical depths, transmittances and
+        weighting functions.
 
-x_clear=np.zeros(zt+1)
-x_cloudy=np.zeros(zt+1)
-y_trans=np.zeros(zt+1)
+         INPUT:
 
-#Extract values from vectors of transimittances until the zt-th value
+             config      : dictionary of the general variables
+                           (see read_configuration)
 
-for i in range(zt+1):
-    x_clear[i]=clear_t[i]
-    x_cloudy[i]=cloudy_t[i]
-    y_trans[i]=z[i]
-    
-figure_name_1 = 'Transmittances for clear sky and cloudy sky'
-fig_1 = plt.figure()
-plt.plot(x_clear, y_trans, 'b--', label ='clear sky', linewidth = 2)
-plt.plot(x_cloudy, y_trans, 'r-', label ='cloudy sky', linewidth = 2)
-fig_1.suptitle(figure_name_1)
-plt.ylabel('Height [km]')
-plt.xlabel('Transmittance')
-# Definition of legend which is on the plot 
-leg = plt.legend()
-# Saving figure in the same folder of code
+         OUTPUT:
 
-fig_1.savefig('OUTPUT/Transmittances in clear and cloud sky.png') 
-#
+             profiles    : dictionary with the height vector (z), the
+                           transmittances (clear_t, cloudy_t), the weighting
+                           functions (weight_clear, weight_cloudy) and the
+                           position of the top of the plots in z (zt)
+
+    """
+
+    z = fn.z_vector(z1, dz, z2, config['top'])
+
+    rho_n= fn.normalized_density_profile(z,config['h'])
+
+    lod, loc = fn.optical_depth(z,dz,config['b'],config['t'],config['csg'],config['coc'],rho_n)
+
+    clear_t, cloudy_t = fn.TOA_transmittances(lod, loc, z, config.get('mu', 1))
+
+    weight_clear, weight_cloudy = fn.weighting_function(clear_t, cloudy_t, z, dz)
+
+    #Find the position in z vector of "top" value
+
+    zt=fn.grid_index(z, config['top'], name='The top of the plotted atmosphere')
+
+    return {'z' : z, 'clear_t' : clear_t, 'cloudy_t' : cloudy_t,
+            'weight_clear' : weight_clear, 'weight_cloudy' : weight_cloudy,
+            'zt' : zt}
+
+def plot_profiles(profiles, output_path):
+
+    """ This function draws and saves the three figures of the model:
+        transmittances, log weighting functions and weighting functions
+        for clear and cloudy sky, from the ground to the top level.
+        The figures are drawn on the Agg canvas and released once saved
+        (see WFT_Render.py).
+
+         INPUT:
+
+             profiles    : dictionary of the computed profiles
+                           (see compute_profiles)
+
+             output_path : folder where the figures are stored
+
+    """
+
+    render_scene(profiles, output_path)
+
+def clear_save_txt(profiles, output_path):
 
-#FIG. 2
-
-weight_clear, weight_cloudy = fn.weighting_function(clear_t, cloudy_t, z, dz)
-
-#Definition of the x and y axes for the plot
-
-x_clear=np.zeros(zt+1)
-x_cloudy=np.zeros(zt+1)
-y_weight=np.zeros(zt+1)
-
-#Extract values from weighting function vectors from the second until the zt-th value
-
-for i in range(1,zt+1):
-    x_clear[i]=weight_clear[i]
-    x_cloudy[i]=weight_cloudy[i]
-    y_weight[i]=z[i]
-    
-figure_name_2 = 'Log weighting functions for clear and cloudy sky'
-fig_2 = plt.figure()
-plt.semilogx(x_clear, y_weight, 'g--', label = 'clear sky', linewidth = 2)   
-plt.semilogx(x_cloudy, y_weight, 'b-', label = 'cloudy sky', linewidth = 2)
-fig_2.suptitle(figure_name_2)
-plt.ylabel('Height [km]')
-plt.xlabel('Log weighting function')
-# Definition of legend which is on the plot 
-leg = plt.legend()
-# Saving figure in the same folder of code
-
-fig_2.savefig('OUTPUT/Log weighting functions for clear and cloudy sky.png')
-
-#FIG.3
-
-figure_name_3 = 'Weighting functions for clear and cloudy sky'
-fig_3 = plt.figure()
-plt.plot(x_clear, y_weight, 'k--', label = 'clear sky', linewidth = 2)   
-plt.plot(x_cloudy, y_weight, 'y-', label = 'cloudy sky', linewidth = 2)
-fig_3.suptitle(figure_name_3)
-plt.ylabel('Height [km]')
-plt.xlabel('Weighting function')
-# Definition of legend which is on the plot 
-leg = plt.legend()
-# Saving figure in the same folder of code
-
-fig_3.savefig('OUTPUT/Weighting functions for clear and cloudy sky.png')
-
-output_path = parser.get('Output_Path', 'output_graph',
-                         fallback = './OUTPUT/')
-                         
-def clear_save_txt():
-    
     """ This function saves the values of computed transmittances
-        and weighting functions for clear sky in a txt file.                 
+        and weighting functions for clear sky in a txt file.
         The output is then stored in the same folder of the plots (./OUTPUT)
-                     
-                        
+
+
          OUTPUT:
-            
+
              Clear_Sky.txt    : file containing values of height, transmittance
              			 and wighting function for clear sky
-             
-                          
+
+
     """
     file_title = 'Clear_Sky'
     output_txt = output_path + file_title
     header_file = 'Height[km]  Transmittance  Weighting_Function'
-    
-    np.savetxt(f'{output_txt}.txt',  np.c_[z, clear_t, weight_clear], fmt="%f", 
-               delimiter="        ", header = header_file)
-               
-clear_save_txt()
-
-def cloudy_save_txt():
-    
+
+    np.savetxt(f'{output_txt}.txt',  np.c_[profiles['z'], profiles['clear_t'], profiles['weight_clear']],
+               fmt="%f", delimiter="        ", header = header_file)
+
+def cloudy_save_txt(profiles, output_path):
+
     """ This function saves the values of computed transmittances
-        and weighting functions for cloudy sky in a txt file.                 
+        and weighting functions for cloudy sky in a txt file.
         The output is then stored in the same folder of the plots (./OUTPUT)
-                     
-                        
+
+
          OUTPUT:
-            
+
              Cloudy_Sky.txt    : file containing values of height, transmittance
              			  and wighting function for clear sky
-             
-                          
+
+
     """
     file_title = 'Cloudy_Sky'
     output_txt = output_path + file_title
     header_file = 'Height[km]  Transmittance  Weighting_Function'
-    
-    np.savetxt(f'{output_txt}.txt',  np.c_[z, cloudy_t, weight_cloudy], fmt="%f", 
-               delimiter="        ", header = header_file)
-               
-cloudy_save_txt()
 
+    np.savetxt(f'{output_txt}.txt',  np.c_[profiles['z'], profiles['cloudy_t'], profiles['weight_cloudy']],
+               fmt="%f", delimiter="        ", header = header_file)
+
+# Order of the rows of the binary output file
+
+BINARY_ROWS = ('z', 'clear_t', 'weight_clear', 'cloudy_t', 'weight_cloudy')
+
+def binary_save(profiles, output_path):
+
+    """ This function saves the height, the transmittances and the weighting
+        functions of both sky cases in a single binary .npy file, with full
+        double precision. The file contains an array with shape (5, n_levels),
+        one row for each entry of BINARY_ROWS, and can be read without parsing:
+
+            data = np.load('WFT_Profiles.npy', mmap_mode='r')
+            cloudy_t = data[BINARY_ROWS.index('cloudy_t')]
+
+
+         OUTPUT:
+
+             WFT_Profiles.npy  : file containing height, transmittances and
+                                 weighting functions for clear and cloudy sky
+
+    """
+    file_title = 'WFT_Profiles'
+    output_npy = output_path + file_title
+
+    np.save(f'{output_npy}.npy', np.stack([profiles[name] for name in BINARY_ROWS]))
+
+# Files written by every output step
+
+OUTPUT_FILES = {
+    'plots' : FIGURE_FILES,
+    'txt' : ('Clear_Sky.txt', 'Cloudy_Sky.txt'),
+    'npy' : ('WFT_Profiles.npy',)}
+
+def cache_key(config):
+
+    """ This function returns the key of the cached results of config: a hash
+        of the general variables, of the grid and of the source code of the
+        model and of the figures (the output path is not part of the key).
+    """
+
+    settings = {name : value for name, value in config.items() if name != 'output_path'}
+    grid = {'z1' : z1, 'z2' : z2, 'dz' : dz}
+
+    return ResultCache.key(settings, grid, code_version(fn, sys.modules[__name__], WFT_Render))
+
+def run(config, plots=True, output_format='txt', cache=None):
+
+    """ This function runs the whole model: it computes the profiles,
+        saves them in the txt files and, if requested, draws the plots.
+
+         INPUT:
+
+             config      : dictionary of the general variables
+                           (see read_configuration)
+
+             plots       : if False, only the numerical chain is run and
+                           the data are saved (matplotlib is not imported)
+
+             output_format : 'txt' (Clear_Sky.txt and Cloudy_Sky.txt),
+                           'npy' (WFT_Profiles.npy) or 'both'
+
+             cache       : ResultCache where the profiles and the output files
+                           are looked for before being computed, and stored
+                           afterwards (None: no cache)
+
+         OUTPUT:
+
+             profiles    : dictionary of the computed profiles
+                           (see compute_profiles)
+
+    """
+
+    output_path = config['output_path']
+
+    def save_txt(profiles):
+        clear_save_txt(profiles, output_path)
+        cloudy_save_txt(profiles, output_path)
+
+    steps = []
+
+    if plots:
+        steps.append(('plots', 'plotting', lambda profiles: plot_profiles(profiles, output_path)))
+
+    if output_format in ('txt', 'both'):
+        steps.append(('txt', 'txt_output', save_txt))
+
+    if output_format in ('npy', 'both'):
+        steps.append(('npy', 'npy_output', lambda profiles: binary_save(profiles, output_path)))
+
+    profiles = None
+
+    if cache is not None:
+        key = cache_key(config)
+        with stage('cache_lookup'):
+            profiles = cache.load_profiles(key)
+
+    if profiles is None:
+        profiles = compute_profiles(config)
+        if cache is not None:
+            cache.store_profiles(key, profiles)
+
+    # Output files already in the cache are copied, the others are written
+    # and then stored in the cache
+
+    for group, name, write in steps:
+        if cache is not None and cache.has_files(key, OUTPUT_FILES[group]):
+            with stage('cache_copy'):
+                cache.copy_files(key, OUTPUT_FILES[group], output_path)
+            continue
+
+        with stage(name):
+            write(profiles)
+
+        if cache is not None:
+            cache.store_files(key, OUTPUT_FILES[group], output_path)
+
+    return profiles
+
+def main(argv=None):
+
+    """ Command line entry point of the model. """
+
+    arguments = argparse.ArgumentParser(description = 'Weighting functions and Transmittances')
+    arguments.add_argument('--config', default = 'Configuration.ini',
+                           help = 'configuration file (default: Configuration.ini)')
+    arguments.add_argument('--no-plots', action = 'store_true',
+                           help = 'run the numerical chain and save the data only')
+    arguments.add_argument('--format', choices = ('txt', 'npy', 'both'), default = 'txt',
+                           help = 'format of the data files (default: txt)')
+    arguments.add_argument('--timing', action = 'store_true',
+                           help = 'print the time spent in every stage of the run')
+    arguments.add_argument('--no-cache', action = 'store_true',
+                           help = 'always recompute the results, without using the cache')
+    arguments.add_argument('--cache-dir', default = CACHE_DIR,
+                           help = f'folder of the cache (default: {CACHE_DIR})')
+    args = arguments.parse_args(argv)
+
+    cache = None if args.no_cache else ResultCache(args.cache_dir)
+
+    if args.timing:
+        with instrument(Instrumentation()) as recorder:
+            run(read_configuration(args.config), plots = not args.no_plots,
+                output_format = args.format, cache = cache)
+        print(recorder.format_report())
+    else:
+        run(read_configuration(args.config), plots = not args.no_plots,
+            output_format = args.format, cache = cache)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+#-----------------------------------------------------------------
+# Rendering of the figures of the Weighting functions and Transmittances model
+#-----------------------------------------------------------------
+#
+# The three figures of WFT_Profile.py (transmittances, log weighting
+# functions and weighting functions for clear and cloudy sky) are drawn
+# with the object-oriented API of matplotlib on the Agg canvas: no pyplot
+# state machine and no display are used, and every figure is released as
+# soon as it is saved. The profiles (10000 levels on the default grid) are
+# decimated to the vertical resolution of the figure before being drawn,
+# keeping the smallest and the largest value of the levels falling in
+# every row of pixels, so that the drawn lines look the same. Many scenes
+# are rendered in a pool of processes.
+#
+# i.e for Linux users (figures of the results of WFT_Sweep.py):
+#
+#        python3 WFT_Render.py OUTPUT/Sweep/ --workers 8 --output OUTPUT/Figures/
+#
+#-----------------------------------------------------------------
+#
+
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+# File names of the three figures of a scene
+
+FIGURE_FILES = ('Transmittances in clear and cloud sky.png',
+                'Log weighting functions for clear and cloudy sky.png',
+                'Weighting functions for clear and cloudy sky.png')
+
+# Size [inches] and resolution [dots per inch] of the figures (the
+# matplotlib defaults)
+
+FIGURE_SIZE = (6.4, 4.8)
+DPI = 100
+
+def decimate(values, n_rows):
+
+    """ This function returns the indices of the levels to draw for a profile
+        plotted against the height: the levels are split in n_rows groups
+        (one for each row of pixels) and the levels with the smallest and the
+        largest value of every group are kept, together with the first and
+        the last level.
+
+
+         INPUT:
+
+             values      : profile, one value for each level
+
+             n_rows      : number of groups (rows of pixels of the figure)
+
+
+         OUTPUT:
+
+             index       : increasing indices of the kept levels
+
+    """
+
+    n_levels = len(values)
+
+    if n_levels <= 2*n_rows:
+        return np.arange(n_levels)
+
+    # Groups of the same size (the last group is padded with its last level)
+
+    size = -(-n_levels // n_rows)
+    padded = np.concatenate((values, np.repeat(values[-1:], n_rows*size - n_levels)))
+    groups = padded.reshape(n_rows, size)
+
+    start = np.arange(n_rows)*size
+    index = np.concatenate(([0, n_levels-1],
+                            start + np.argmin(groups, axis=1),
+                            start + np.argmax(groups, axis=1)))
+
+    return np.unique(np.minimum(index, n_levels-1))
+
+def _decimated(x, y, n_rows):
+
+    """ Profile x plotted against y, decimated to n_rows rows of pixels. """
+
+    index = decimate(x, n_rows)
+
+    return x[index], y[index]
+
+def render_scene(profiles, output_path, prefix=''):
+
+    """ This function draws and saves the three figures of one scene, as
+        WFT_Profile.plot_profiles, with the object-oriented API of matplotlib
+        on the Agg canvas.
+
+
+         INPUT:
+
+             profiles    : dictionary with the height vector (z), the
+                           transmittances (clear_t, cloudy_t), the weighting
+                           functions (weight_clear, weight_cloudy) and the
+                           position of the top of the plots in z (zt)
+
+             output_path : folder where the figures are stored
+
+             prefix      : string put before the names of the files
+
+
+         OUTPUT:
+
+             files       : paths of the saved figures
+
+    """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    zt = profiles['zt']
+    z = np.asarray(profiles['z'])[:zt+1]
+
+    n_rows = int(FIGURE_SIZE[1]*DPI)
+
+    figures = (
+        ('Transmittances for clear sky and cloudy sky', 'plot', 'Transmittance',
+         ('clear_t', 'b--'), ('cloudy_t', 'r-')),
+        ('Log weighting functions for clear and cloudy sky', 'semilogx', 'Log weighting function',
+         ('weight_clear', 'g--'), ('weight_cloudy', 'b-')),
+        ('Weighting functions for clear and cloudy sky', 'plot', 'Weighting function',
+         ('weight_clear', 'k--'), ('weight_cloudy', 'y-')))
+
+    files = []
+
+    for file_name, (title, kind, xlabel, clear, cloudy) in zip(FIGURE_FILES, figures):
+        figure = Figure(figsize=FIGURE_SIZE, dpi=DPI)
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot()
+
+        for (name, style), label in ((clear, 'clear sky'), (cloudy, 'cloudy sky')):
+            x, y = _decimated(np.asarray(profiles[name])[:zt+1], z, n_rows)
+            getattr(axes, kind)(x, y, style, label = label, linewidth = 2)
+
+        figure.suptitle(title)
+        axes.set_ylabel('Height [km]')
+        axes.set_xlabel(xlabel)
+        axes.legend()
+
+        files.append(os.path.join(output_path, prefix + file_name))
+        figure.savefig(files[-1])
+
+        # The figure is not registered in pyplot: clearing it releases its
+        # artists at once
+
+        figure.clear()
+
+    return files
+
+def _render_scene(arguments):
+
+    """ Renders one scene in a process of the pool. """
+
+    return render_scene(*arguments)
+
+def render_scenes(scenes, workers=None):
+
+    """ This function renders many scenes in a pool of processes. The
+        profiles are decimated before being sent to the processes.
+
+
+         INPUT:
+
+             scenes      : sequence of (profiles, output_path, prefix) triples
+                           (see render_scene)
+
+             workers     : number of processes (default: number of cores)
+
+
+         OUTPUT:
+
+             files       : paths of the saved figures, three for each scene
+
+    """
+
+    n_rows = int(FIGURE_SIZE[1]*DPI)
+
+    def reduced(profiles):
+        zt = profiles['zt']
+        z = np.asarray(profiles['z'])[:zt+1]
+
+        # The levels kept by any of the profiles, so that all of them share
+        # the same height vector
+
+        index = np.unique(np.concatenate([
+            decimate(np.asarray(profiles[name])[:zt+1], n_rows)
+            for name in ('clear_t', 'cloudy_t', 'weight_clear', 'weight_cloudy')]))
+
+        scene = {name : np.asarray(profiles[name])[:zt+1][index]
+                 for name in ('clear_t', 'cloudy_t', 'weight_clear', 'weight_cloudy')}
+        scene['z'] = z[index]
+        scene['zt'] = len(index) - 1
+
+        return scene
+
+    workers = workers or os.cpu_count() or 1
+    scenes = iter(enumerate(scenes))
+    files = {}
+
+    def submit(pool, count):
+        return {pool.submit(_render_scene, (reduced(profiles), output_path, prefix)) : i
+                for i, (profiles, output_path, prefix) in itertools.islice(scenes, count)}
+
+    # At most two scenes for each worker are waiting in the pool, so that
+    # the memory does not grow with the number of scenes
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = submit(pool, 2*workers)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                files[pending.pop(future)] = future.result()
+
+            pending.update(submit(pool, len(done)))
+
+    return [name for i in sorted(files) for name in files[i]]
+
+def main(argv=None):
+
+    """ Command line interface: renders the figures of every point stored by
+        WFT_Sweep.py or WFT_Stream.py.
+    """
+
+    arguments = argparse.ArgumentParser(description = 'Figures of the WFT model')
+    arguments.add_argument('results',
+                           help = 'folder with the results of WFT_Sweep.py or WFT_Stream.py')
+    arguments.add_argument('--top', type=float, default=20,
+                           help = 'maximum height of the figures [km]')
+    arguments.add_argument('--workers', type=int, default=None,
+                           help = 'number of processes (default: number of cores)')
+    arguments.add_argument('--output', default='./OUTPUT/Figures/',
+                           help = 'folder where the figures are stored')
+    args = arguments.parse_args(argv)
+
+    import WFT_Functions as fn
+
+    z = np.load(os.path.join(args.results, 'z.npy'))
+    zt = fn.grid_index(z, args.top, tol=np.inf)
+
+    stored = {name : np.load(os.path.join(args.results, f'{name}.npy'), mmap_mode='r')
+              for name in ('clear_t', 'cloudy_t', 'weight_clear', 'weight_cloudy')}
+
+    os.makedirs(args.output, exist_ok=True)
+
+    scenes = (({'z' : z, 'zt' : zt, **{name : array[i] for name, array in stored.items()}},
+               args.output, f'scene_{i:06d}_')
+              for i in range(len(stored['clear_t'])))
+
+    files = render_scenes(scenes, args.workers)
+
+    print(f'{len(files)} figures stored in {args.output}')
+
+if __name__ == "__main__":
+    main()
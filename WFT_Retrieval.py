@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+#----------------------------------------
+# Retrieval of the cloud parameters
+#----------------------------------------
+#
+# Inverse mode of the model: cloud base (b), cloud top (t) and cloud
+# absorption coefficient (coc) are estimated, for many pixels at once,
+# from the observed cloudy sky transmittances (or weighting functions).
+#
+# Gas cross section (csg) and scale height (h) are known, so the clear
+# sky optical depth is computed once with the forward chain. What is left
+# of the observed optical depth is the cloud optical depth, which is linear
+# in coc: for every candidate (b, t) the best coc and the misfit follow in
+# closed form (least squares). With cumulative sums of the observations
+# along the levels, the misfit of a candidate costs a few operations, no
+# matter the number of levels, so that many pixels and candidates are
+# handled at once. The candidates of a lookup table (b and t every table
+# step) are searched first, then the best candidate is refined level by
+# level, moving b and t together within one table step and then by one
+# level at a time, until it does not change anymore.
+#
+
+import time
+
+import numpy as np
+import WFT_Functions as fn
+from WFT_Session import ProfileSession
+
+def transmittance_from_weighting(weight, dz):
+
+    """ This function rebuilds the transmittance from the weighting function
+        (its derivative), knowing that the transmittance is 1 at the TOA.
+
+         INPUT:
+
+             weight      : weighting function, with the levels on the last axis
+
+             dz          : step value of the vector z, or thickness of each layer
+
+         OUTPUT:
+
+             transmittance : transmittance with the same shape of weight
+
+    """
+
+    transmittance = np.ones(np.shape(weight))
+    steps = weight[..., 1:]*dz
+    transmittance[..., :-1] = 1 - np.cumsum(steps[..., ::-1], axis=-1)[..., ::-1]
+
+    return transmittance
+
+class CloudRetrieval:
+
+    """ Retrieval of cloud base, top and absorption coefficient for a known
+        gas absorption (csg) and scale height (h).
+
+        ATTRIBUTES:
+
+            z, dz       : height vector and step (or layer thicknesses)
+
+            mu          : cosine of the viewing zenith angle of the observations
+
+            bases, tops : cloud bases and tops [km] of the lookup table
+
+            min_transmittance : levels whose observed transmittance is below
+                          this value are not used (the signal is saturated)
+
+    """
+
+    def __init__(self, z, dz, csg, h, bases=None, tops=None, mu=1,
+                 min_transmittance=1e-6):
+
+        self.z = np.asarray(z, dtype=float)
+        self.dz = dz
+        self.mu = mu
+        self.min_transmittance = min_transmittance
+
+        step = 0.25
+        if bases is None:
+            bases = np.arange(0, 20, step)
+        if tops is None:
+            tops = np.arange(step, 20+step, step)
+
+        # Candidate positions on the z vector (the nearest levels)
+
+        base_index = np.unique(fn.grid_index(self.z, bases, tol=np.inf))
+        top_index = np.unique(fn.grid_index(self.z, tops, tol=np.inf))
+
+        base_index, top_index = np.meshgrid(base_index, top_index, indexing='ij')
+        valid = base_index < top_index
+        self.base_index = base_index[valid]
+        self.top_index = top_index[valid]
+
+        self.bases = self.z[self.base_index]
+        self.tops = self.z[self.top_index]
+
+        # Only the levels up to the highest cloud top can hold a cloud
+
+        self.n_levels = int(self.top_index.max()) + 1
+
+        # Cumulative thickness of the layers from the ground to each level
+
+        layer_dz = np.broadcast_to(dz, (len(self.z)-1,))
+        self._cumulative = np.concatenate(([0], np.cumsum(layer_dz)))
+
+        # Refinement window: one table step, in levels
+
+        table_step = np.max(np.diff(np.unique(self.bases)), initial=0)
+        self._window = max(1, int(np.ceil(table_step/np.min(layer_dz))))
+
+        # Clear sky optical depth from the forward chain
+
+        self.clear_tau = ProfileSession(self.z, dz).clear_sky(h, csg)['tau']
+
+    def _fit(self, sums, base, top):
+
+        """ Best coc (least squares) and misfit of the candidate clouds
+            between the levels base and top (arrays with shape
+            (n_pixels, n_candidates)), from the cumulative sums of the
+            observations (see retrieve).
+
+            The cloud optical depth of level i, for a unit coc, is
+            C[t] - C[max(i, b+1)] below the top and 0 above, where C is the
+            cumulative layer thickness: its products with the observations,
+            summed over the levels, only need the cumulative sums at b+1 and t.
+        """
+
+        C = self._cumulative
+
+        def at(name, k):
+            return np.take_along_axis(sums[name], k, axis=1)
+
+        b1 = np.minimum(base+1, top)
+        Ct = C[top]
+        Cb = C[b1]
+
+        projection = (Ct*at('e', top) - Cb*at('e', b1)
+                      - (at('eC', top) - at('eC', b1)))/self.mu
+
+        norm = ((Ct-Cb)**2*at('w', b1) + Ct**2*(at('w', top) - at('w', b1))
+                - 2*Ct*(at('wC', top) - at('wC', b1))
+                + (at('wC2', top) - at('wC2', b1)))/self.mu**2
+
+        norm = np.maximum(norm, np.finfo(float).tiny)
+        coc = projection/norm
+
+        # A cloud cannot have a negative absorption coefficient: the misfit of
+        # those candidates is the one of a clear sky. Candidates with the base
+        # at or above the top are excluded
+
+        misfit = np.where(coc > 0, -projection**2/norm, 0)
+        misfit = np.where(base < top, misfit, np.inf)
+
+        return np.maximum(coc, 0), misfit
+
+    def retrieve(self, cloudy_t=None, weight_cloudy=None, tolerance=1e-3,
+                 max_iterations=20, chunk_size=64):
+
+        """ This function estimates cloud base, top and absorption coefficient
+            of every pixel.
+
+             INPUT:
+
+                 cloudy_t       : observed cloudy sky transmittances, with
+                                  shape (n_pixels, n_levels)
+
+                 weight_cloudy  : observed cloudy sky weighting functions, used
+                                  instead of cloudy_t
+
+                 tolerance      : largest RMS misfit of the optical depth of a
+                                  converged pixel
+
+                 max_iterations : largest number of refinement iterations
+
+                 chunk_size     : pixels refined at the same time
+
+
+             OUTPUT:
+
+                 result      : dictionary with the arrays b, t, coc, rms (RMS
+                               misfit of the optical depth), converged and
+                               iterations (one value for each pixel)
+
+                 stats       : dictionary with number of pixels and candidates,
+                               number of converged pixels and the time of the
+                               table search, of the refinement and in total
+
+        """
+
+        start = time.perf_counter()
+
+        if (cloudy_t is None) == (weight_cloudy is None):
+            raise ValueError (
+                'Either the transmittances or the weighting functions must be given')
+
+        if cloudy_t is None:
+            cloudy_t = transmittance_from_weighting(np.atleast_2d(weight_cloudy), self.dz)
+
+        cloudy_t = np.atleast_2d(np.asarray(cloudy_t, dtype=float))
+
+        if cloudy_t.shape[-1] != len(self.z):
+            raise ValueError (
+                'The observed profiles must have one value for each level of z')
+
+        # Cloud optical depth of the observations and levels used in the fit
+
+        weights = (cloudy_t > self.min_transmittance).astype(float)
+        excess = (-np.log(np.clip(cloudy_t, self.min_transmittance, 1))
+                  - self.clear_tau/self.mu)*weights
+
+        # Misfit of a clear sky; above the highest cloud top every candidate
+        # leaves this misfit unchanged
+
+        misfit_clear = np.sum(excess**2, axis=-1)
+
+        n_pixels = len(cloudy_t)
+        base = np.zeros(n_pixels, dtype=int)
+        top = np.zeros(n_pixels, dtype=int)
+        best_coc = np.zeros(n_pixels)
+        best_misfit = np.zeros(n_pixels)
+        iterations = np.zeros(n_pixels, dtype=int)
+        moving = np.zeros(n_pixels, dtype=bool)
+
+        table_time = 0.0
+        offsets = np.arange(-self._window, self._window+1)
+        C = self._cumulative[:self.n_levels]
+
+        for p in np.array_split(np.arange(n_pixels), max(1, n_pixels//chunk_size)):
+            chunk_start = time.perf_counter()
+
+            # Cumulative sums (from the ground) of the observations
+
+            e = excess[p, :self.n_levels]
+            w = weights[p, :self.n_levels]
+
+            def cumulative(x):
+                return np.concatenate((np.zeros((len(x), 1)), np.cumsum(x, axis=-1)), axis=-1)
+
+            sums = {'e' : cumulative(e), 'eC' : cumulative(e*C), 'w' : cumulative(w),
+                    'wC' : cumulative(w*C), 'wC2' : cumulative(w*C**2)}
+
+            # Lookup table search
+
+            table_base = np.broadcast_to(self.base_index, (len(p), len(self.base_index)))
+            table_top = np.broadcast_to(self.top_index, (len(p), len(self.top_index)))
+
+            coc, misfit = self._fit(sums, table_base, table_top)
+            best = np.argmin(misfit, axis=-1)
+            rows = np.arange(len(p))
+
+            base[p] = self.base_index[best]
+            top[p] = self.top_index[best]
+            best_coc[p] = coc[rows, best]
+            best_misfit[p] = misfit[rows, best]
+
+            table_time += time.perf_counter() - chunk_start
+
+            # Refinement: base and top move together within one table step
+
+            still = np.ones(len(p), dtype=bool)
+
+            for iteration in range(max_iterations):
+                if not np.any(still):
+                    break
+
+                q = np.flatnonzero(still)
+                iterations[p[q]] = iteration + 1
+
+                # The first iteration covers one table step around the table
+                # candidate, the next ones the neighbouring levels only
+
+                steps = offsets if iteration == 0 else offsets[self._window-1:self._window+2]
+
+                new_base = np.clip(base[p[q], None, None] + steps[:, None], 0, self.n_levels-1)
+                new_top = np.clip(top[p[q], None, None] + steps[None, :], 0, self.n_levels-1)
+                new_base, new_top = np.broadcast_arrays(new_base, new_top)
+                new_base = new_base.reshape(len(q), -1)
+                new_top = new_top.reshape(len(q), -1)
+
+                sub_sums = {name : value[q] for name, value in sums.items()}
+                c, m = self._fit(sub_sums, new_base, new_top)
+
+                choice = np.argmin(m, axis=-1)
+                rows = np.arange(len(q))
+                better = m[rows, choice] < best_misfit[p[q]]
+
+                base[p[q]] = np.where(better, new_base[rows, choice], base[p[q]])
+                top[p[q]] = np.where(better, new_top[rows, choice], top[p[q]])
+                best_coc[p[q]] = np.where(better, c[rows, choice], best_coc[p[q]])
+                best_misfit[p[q]] = np.where(better, m[rows, choice], best_misfit[p[q]])
+
+                still[q] = better
+
+            moving[p] = still
+
+        n_used = np.maximum(np.sum(weights, axis=-1), 1)
+        rms = np.sqrt(np.maximum(misfit_clear + best_misfit, 0)/n_used)
+
+        result = {'b' : self.z[base], 't' : self.z[top], 'coc' : best_coc, 'rms' : rms,
+                  'converged' : ~moving & (rms <= tolerance), 'iterations' : iterations}
+
+        total_time = time.perf_counter() - start
+
+        stats = {'n_pixels' : n_pixels, 'n_candidates' : len(self.base_index),
+                 'n_converged' : int(np.sum(result['converged'])),
+                 'table_seconds' : table_time,
+                 'refinement_seconds' : total_time - table_time,
+                 'total_seconds' : total_time,
+                 'pixels_per_second' : len(cloudy_t)/total_time}
+
+        return result, stats
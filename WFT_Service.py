@@ -0,0 +1,629 @@
+#!/usr/bin/python3
+#-----------------------------------------------------------------
+# Local service of the Weighting functions and Transmittances model
+#-----------------------------------------------------------------
+#
+# A long-running process that computes transmittances and weighting
+# functions on demand, so that interactive tools do not start a new
+# interpreter (and import numpy again) for every profile. The service
+# listens on localhost (TCP) or on a Unix socket and speaks a minimal
+# HTTP/1.1:
+#
+#        POST /profiles   JSON body {"b": .., "t": .., "csg": .., "coc": ..,
+#                         "h": .., "mu": 1, "dz": 0.005, "dtype": "float64"},
+#                         every parameter a number or a list (one value
+#                         for each column); the answer is a .npy array
+#                         with shape (4, n_columns, n_levels), the profiles
+#                         in the order of WFT_Sweep.PROFILES
+#
+#        GET /grid?dz=0.005   the .npy height vector of the profiles
+#
+#        GET /stats           JSON counters of requests, batches and caches
+#
+# The height vectors and the normalized density profiles are kept in memory
+# between requests, and the requests arriving together are computed in a
+# single batched call of the WFT_Functions chain.
+#
+# i.e for Linux users:
+#
+#        python3 WFT_Service.py --port 8765
+#        python3 WFT_Service.py --socket /tmp/wft.sock
+#
+#-----------------------------------------------------------------
+#
+
+import argparse
+import asyncio
+import http.client
+import io
+import ipaddress
+import json
+import socket
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import WFT_Functions as fn
+from WFT_Sweep import PARAMETERS
+
+# Default address of the service
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Floating point types of the profiles
+
+DTYPES = ('float32', 'float64')
+
+# Largest accepted body of a request [bytes]
+
+MAX_BODY = 2**24
+
+# Largest number of values (columns times levels times angles) of every
+# profile of a request, and of the batches
+
+MAX_VALUES = 2**23
+
+class ProfileService:
+
+    """ Profiles computed on demand, with warm caches and batching.
+
+        ATTRIBUTES:
+
+            batch_window : time [s] the service waits for more requests
+                           before computing a batch
+
+            max_columns  : largest number of columns of a batch
+
+            chunk_size   : number of columns computed in a single call of
+                           the chain
+
+            maxsize      : largest number of density profiles kept in memory,
+                           the least recently used one is discarded first
+
+            max_grids    : largest number of height vectors kept in memory,
+                           the least recently used one is discarded first
+
+            max_values   : largest number of values (columns times levels
+                           times angles) of every profile of a request; the
+                           batches stop growing beyond it
+
+            stats        : counters of requests, batches, columns and of the
+                           hits and misses of the density cache
+
+    """
+
+    def __init__(self, batch_window=0.002, max_columns=4096, chunk_size=16, maxsize=256,
+                 max_grids=8, max_values=MAX_VALUES):
+
+        self.batch_window = batch_window
+        self.max_columns = max_columns
+        self.chunk_size = chunk_size
+        self.maxsize = maxsize
+        self.max_grids = max_grids
+        self.max_values = max_values
+
+        self.stats = {'requests' : 0, 'batches' : 0, 'columns' : 0, 'largest_batch' : 0,
+                      'density_hits' : 0, 'density_misses' : 0, 'compute_seconds' : 0.0}
+
+        self._grids = OrderedDict()
+        self._density = OrderedDict()
+        self._queue = None
+        self._batcher = None
+        self._servers = []
+
+    def grid(self, dz):
+
+        """ This function returns the read-only height vector with step dz,
+            building it only the first time.
+        """
+
+        dz = float(dz)
+
+        if dz in self._grids:
+            self._grids.move_to_end(dz)
+            return self._grids[dz]
+
+        self._check_size(dz, 1)
+
+        z = fn.z_vector(fn.Z1, dz, fn.Z2, fn.Z2)
+        z.setflags(write=False)
+        self._grids[dz] = z
+
+        if len(self._grids) > self.max_grids:
+            self._grids.popitem(last=False)
+
+        return z
+
+    def _check_size(self, dz, n_columns, n_angles=1):
+
+        """ Raises a ValueError if the profiles of a request would have more
+            than max_values values, before any array is built.
+        """
+
+        n_levels = _n_levels(dz)
+
+        if n_columns*n_levels*n_angles > self.max_values:
+            raise ValueError (
+                f'The request is too large: {n_columns} columns of {n_levels} levels '
+                f'for {n_angles} angles (at most {self.max_values} values)')
+
+    def density(self, dz, h, dtype=np.float64):
+
+        """ This function returns the read-only normalized density profiles
+            of the scale heights h on the grid with step dz, with shape
+            (len(h), n_levels); every profile is computed only the first time.
+        """
+
+        z = self.grid(dz)
+        dtype = np.dtype(dtype)
+        h = np.atleast_1d(np.asarray(h, dtype=float))
+
+        profiles = []
+
+        for value in h:
+            key = (float(dz), float(value), dtype.str)
+
+            if key in self._density:
+                self.stats['density_hits'] += 1
+                self._density.move_to_end(key)
+            else:
+                self.stats['density_misses'] += 1
+                rho_n = fn.normalized_density_profile(z, value, dtype)
+                rho_n.setflags(write=False)
+                self._density[key] = rho_n
+
+                if len(self._density) > self.maxsize:
+                    self._density.popitem(last=False)
+
+            profiles.append(self._density[key])
+
+        if not profiles:
+            return np.empty((0, len(z)), dtype=dtype)
+
+        return np.stack(profiles)
+
+    def profiles(self, dz, b, t, csg, coc, h, mu=1, dtype=np.float64):
+
+        """ This function runs the chain of fn.batch_profiles with the cached
+            height vector and density profiles.
+
+             OUTPUT:
+
+                 profiles    : array with shape (4, n_columns, n_levels), or
+                               (4, n_angles, n_columns, n_levels) for an array
+                               of mu, with the profiles in the order of
+                               WFT_Sweep.PROFILES
+
+        """
+
+        b, t, csg, coc, h = np.broadcast_arrays(*(np.atleast_1d(np.asarray(p, dtype=float))
+                                                  for p in (b, t, csg, coc, h)))
+        self._check_size(dz, len(b), np.size(mu))
+        z = self.grid(dz)
+
+        # Every distinct scale height is taken from the cache once; a single
+        # one is broadcast to all the columns, as in fn.batch_profiles
+
+        heights, inverse = np.unique(h, return_inverse=True)
+        rho_n = self.density(dz, heights, dtype)
+
+        if len(heights) == 1:
+            inverse = np.zeros(1, dtype=int)
+
+        profiles = np.empty((4,) + np.shape(mu) + (len(b), len(z)), dtype=rho_n.dtype)
+
+        # The columns are computed in chunks small enough to stay in the
+        # processor cache, straight into the output array
+
+        for start in range(0, len(b), self.chunk_size):
+            part = slice(start, start + self.chunk_size)
+
+            lod, loc = fn.batch_optical_depth(z, dz, b[part], t[part], csg[part], coc[part],
+                                              rho_n[inverse[part] if len(inverse) > 1 else inverse])
+
+            if np.ndim(mu) == 0:
+                fn.TOA_transmittances(lod, loc, z, mu, out=(profiles[0, part], profiles[1, part]))
+                fn.weighting_function(profiles[0, part], profiles[1, part], z, dz,
+                                      out=(profiles[2, part], profiles[3, part]))
+            else:
+                clear_t, cloudy_t = fn.TOA_transmittances(lod, loc, z, mu)
+                chunk = (clear_t, cloudy_t) + fn.weighting_function(clear_t, cloudy_t, z, dz)
+                for k in range(4):
+                    profiles[k][..., part, :] = chunk[k]
+
+        return profiles
+
+    async def compute(self, dz, b, t, csg, coc, h, mu=1, dtype='float64'):
+
+        """ This function returns the profiles of the columns (see profiles),
+            computed in a batch together with the other requests waiting in
+            the service.
+        """
+
+        if np.dtype(dtype).name not in DTYPES:
+            raise ValueError (
+                f'The type of the profiles must be {" or ".join(DTYPES)}, not {dtype}')
+
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._batcher is None or self._batcher.done():
+            self._batcher = asyncio.create_task(self._run_batches())
+
+        columns = np.broadcast_arrays(*(np.atleast_1d(np.asarray(p, dtype=float))
+                                        for p in (b, t, csg, coc, h)))
+        if columns[0].ndim != 1:
+            raise ValueError (
+                'The parameters must be numbers or lists of numbers')
+
+        key = (float(dz), tuple(np.atleast_1d(np.asarray(mu, dtype=float)).tolist()),
+               np.dtype(dtype).str, np.ndim(mu))
+
+        self._check_size(key[0], len(columns[0]), len(key[1]))
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((key, columns, future))
+
+        self.stats['requests'] += 1
+
+        return await future
+
+    async def _run_batches(self):
+
+        """ Takes the waiting requests, groups the ones with the same grid,
+            angles and type and computes every group in a single call, in a
+            thread so that new requests are accepted meanwhile. A batch
+            stops growing at max_columns columns or max_values values.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            requests = [await self._queue.get()]
+            n_columns = len(requests[0][1][0])
+            n_values = _n_values(requests[0])
+            deadline = loop.time() + self.batch_window
+
+            while n_columns < self.max_columns and n_values < self.max_values:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self._queue.get_nowait()
+
+                requests.append(request)
+                n_columns += len(request[1][0])
+                n_values += _n_values(request)
+
+            groups = {}
+            for request in requests:
+                groups.setdefault(request[0], []).append(request)
+
+            for key, group in groups.items():
+                await loop.run_in_executor(None, self._compute_group, key, group)
+
+    def _compute_group(self, key, group):
+
+        """ Computes the requests of a group in one batch and sets their
+            results. When the batch fails, every request is computed alone,
+            so that an invalid request does not fail the others; any error
+            is given to its request, so that no request is left waiting.
+        """
+
+        dz, mu, dtype, mu_ndim = key
+        mu = np.array(mu) if mu_ndim else mu[0]
+
+        start = time.perf_counter()
+
+        columns = [np.concatenate(p) for p in zip(*(columns for _, columns, _ in group))]
+
+        try:
+            results = self.profiles(dz, *columns, mu, dtype)
+            sizes = np.cumsum([len(columns[0]) for _, columns, _ in group])[:-1]
+            results = np.split(results, sizes, axis=-2)
+
+        except Exception:
+            results = []
+            for _, columns, _ in group:
+                try:
+                    results.append(self.profiles(dz, *columns, mu, dtype))
+                except Exception as error:
+                    results.append(error)
+
+        self.stats['batches'] += 1
+        self.stats['columns'] += sum(len(columns[0]) for _, columns, _ in group)
+        self.stats['largest_batch'] = max(self.stats['largest_batch'],
+                                          sum(len(columns[0]) for _, columns, _ in group))
+        self.stats['compute_seconds'] += time.perf_counter() - start
+
+        for (_, _, future), result in zip(group, results):
+            future.get_loop().call_soon_threadsafe(_set_result, future, result)
+
+    async def _handle(self, reader, writer):
+
+        """ Answers the HTTP requests of a connection, until it is closed. """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, content_type, body = 413, 'application/json', _error('The request is too large')
+                    await _respond(writer, status, content_type, body, close=True)
+                    break
+
+                body = await reader.readexactly(length) if length else b''
+
+                status, content_type, body = await self._dispatch(method, target, body)
+
+                close = headers.get('connection', '').lower() == 'close'
+                await _respond(writer, status, content_type, body, close)
+
+                if close:
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, body):
+
+        """ Status, content type and body of the answer to a request. """
+
+        url = urlsplit(target)
+
+        try:
+            if method == 'POST' and url.path == '/profiles':
+                parameters = json.loads(body or b'{}')
+
+                missing = [p for p in PARAMETERS if p not in parameters]
+                if missing:
+                    raise ValueError (
+                        f'The request has no parameter {", ".join(missing)}!')
+
+                profiles = await self.compute(parameters.get('dz', fn.DZ),
+                                              *(parameters[p] for p in PARAMETERS),
+                                              mu = parameters.get('mu', 1),
+                                              dtype = parameters.get('dtype', 'float64'))
+
+                return 200, 'application/x-npy', _npy(profiles)
+
+            if method == 'GET' and url.path == '/grid':
+                dz = float(parse_qs(url.query).get('dz', [fn.DZ])[0])
+                return 200, 'application/x-npy', _npy(self.grid(dz))
+
+            if method == 'GET' and url.path == '/stats':
+                stats = dict(self.stats, grids=len(self._grids), density_profiles=len(self._density))
+                return 200, 'application/json', json.dumps(stats).encode()
+
+            return 404, 'application/json', _error(f'Unknown request {method} {url.path}')
+
+        except (ValueError, TypeError) as error:
+            return 400, 'application/json', _error(str(error))
+
+    async def start(self, host=HOST, port=PORT, socket_path=None):
+
+        """ This function starts listening on the Unix socket socket_path, or
+            on host and port (a loopback address only: the service is local).
+            The server is returned; its sockets tell the port when port is 0.
+        """
+
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self._handle, path=socket_path)
+
+        else:
+            if not _is_loopback(host):
+                raise ValueError (
+                    f'The service only listens on localhost, not on {host}')
+            server = await asyncio.start_server(self._handle, host, port)
+
+        self._servers.append(server)
+
+        return server
+
+    async def close(self):
+
+        """ This function stops the servers and the batches. """
+
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+
+        if self._batcher is not None:
+            self._batcher.cancel()
+            self._batcher = None
+
+def _n_values(request):
+
+    """ Number of values of every profile of a queued request. """
+
+    (dz, mu, _, _), columns, _ = request
+
+    return len(columns[0])*_n_levels(dz)*len(mu)
+
+def _n_levels(dz):
+
+    """ Number of levels of the height vector with step dz. """
+
+    return int(np.ceil((fn.Z2 - fn.Z1)/dz)) if dz > 0 else 0
+
+def _set_result(future, result):
+
+    """ Sets the result (or the error) of a request, if it is still waited. """
+
+    if future.done():
+        return
+
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+def _npy(array):
+
+    """ Bytes of array in the .npy format. """
+
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+
+    return buffer.getvalue()
+
+def _error(message):
+
+    """ JSON body of an error answer. """
+
+    return json.dumps({'error' : message}).encode()
+
+async def _respond(writer, status, content_type, body, close=False):
+
+    """ Writes an HTTP answer. """
+
+    head = (f'HTTP/1.1 {status} {http.client.responses[status]}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"close" if close else "keep-alive"}\r\n\r\n')
+
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+def _is_loopback(host):
+
+    """ True if host is a loopback address or resolves only to loopback ones. """
+
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        pass
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+
+    return bool(addresses) and all(ipaddress.ip_address(a).is_loopback for a in addresses)
+
+class _UnixConnection(http.client.HTTPConnection):
+
+    """ HTTP connection through a Unix socket. """
+
+    def __init__(self, socket_path, timeout=None):
+
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def request_profiles(b, t, csg, coc, h, mu=1, dz=fn.DZ, dtype='float64',
+                     host=HOST, port=PORT, socket_path=None, timeout=60):
+
+    """ This function asks the profiles of the columns to a running service.
+
+
+         INPUT:
+
+             b, t, csg, coc, h, mu : parameters of the columns (numbers or
+                                     sequences, see fn.batch_profiles)
+
+             dz, dtype   : step of the height vector and floating point type
+
+             host, port  : address of the service, or
+
+             socket_path : its Unix socket
+
+
+         OUTPUT:
+
+             clear_t, cloudy_t, weight_clear, weight_cloudy : arrays with
+                           shape (n_columns, n_levels)
+
+    """
+
+    if socket_path is not None:
+        connection = _UnixConnection(socket_path, timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def listed(value):
+        return np.asarray(value, dtype=float).tolist()
+
+    body = json.dumps({'b' : listed(b), 't' : listed(t), 'csg' : listed(csg),
+                       'coc' : listed(coc), 'h' : listed(h), 'mu' : listed(mu),
+                       'dz' : dz, 'dtype' : dtype})
+
+    try:
+        connection.request('POST', '/profiles', body, {'Content-Type' : 'application/json'})
+        response = connection.getresponse()
+        content = response.read()
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise ValueError (
+            json.loads(content).get('error', f'The service answered {response.status}'))
+
+    return tuple(np.load(io.BytesIO(content)))
+
+def main(argv=None):
+
+    """ Command line interface: runs the service until it is interrupted. """
+
+    arguments = argparse.ArgumentParser(description = 'Local service of the WFT model')
+    arguments.add_argument('--host', default=HOST,
+                           help = 'loopback address of the service')
+    arguments.add_argument('--port', type=int, default=PORT,
+                           help = 'port of the service')
+    arguments.add_argument('--socket', default=None,
+                           help = 'Unix socket used instead of host and port')
+    arguments.add_argument('--batch-window', type=float, default=0.002,
+                           help = 'time [s] waited for more requests before a batch')
+    arguments.add_argument('--max-columns', type=int, default=4096,
+                           help = 'largest number of columns of a batch')
+    arguments.add_argument('--max-values', type=int, default=MAX_VALUES,
+                           help = 'largest number of values (columns times levels times angles) of a request')
+    arguments.add_argument('--max-grids', type=int, default=8,
+                           help = 'largest number of height vectors kept in memory')
+    args = arguments.parse_args(argv)
+
+    async def serve():
+        service = ProfileService(args.batch_window, args.max_columns,
+                                 max_grids=args.max_grids, max_values=args.max_values)
+        server = await service.start(args.host, args.port, args.socket)
+
+        print(f'WFT service listening on {args.socket or f"{args.host}:{args.port}"}')
+
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+#----------------------------------------
+# Cached profile session for WFT_Functions
+#----------------------------------------
+#
+# When only the cloud parameters (b, t, coc) change, the clear sky chain
+# (normalized density profile, molecular optical depth, clear sky
+# transmittance and weighting function) is the same. A ProfileSession
+# keeps the clear sky results of a z grid for every (h, csg) already seen
+# and recomputes only the cloudy branch, and only from the ground up to
+# the cloud top: above the cloud the cloudy sky profiles are equal to the
+# clear sky ones.
+#
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import WFT_Functions as fn
+from WFT_Validation import check_columns
+
+class ProfileSession:
+
+    """ Cache of the clear sky profiles of one z grid.
+
+        ATTRIBUTES:
+
+            z           : altitude vector of the session
+
+            dz          : step value of the vector z, or thickness of each
+                          layer (fn.layer_thickness(z)) for a non-uniform z
+
+            maxsize     : largest number of (h, csg) pairs kept in memory,
+                          the least recently used pair is discarded first
+
+            hits        : number of clear sky profiles found in the cache
+
+            misses      : number of clear sky profiles computed
+
+    """
+
+    def __init__(self, z, dz, maxsize=128):
+
+        self.z = np.asarray(z, dtype=float)
+        self.dz = dz
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        # The grid is part of the cache key, so that the cached profiles
+        # are never used with a different z vector
+
+        self._grid_key = hashlib.sha1(self.z.tobytes()).hexdigest()
+        self._clear = OrderedDict()
+
+    def clear(self):
+
+        """ Empties the cache of the clear sky profiles. """
+
+        self._clear.clear()
+
+    def clear_sky(self, h, csg):
+
+        """ This function returns the clear sky profiles for the scale height
+            h and the cross section csg, computing them only the first time.
+
+             OUTPUT:
+
+                 clear       : dictionary with the normalized density (rho_n),
+                               the molecular optical depth (lod), the optical
+                               depth from each level to the TOA (tau), the
+                               clear sky transmittance (clear_t) and weighting
+                               function (weight_clear), all read-only
+
+        """
+
+        key = (self._grid_key, float(h), float(csg))
+
+        if key in self._clear:
+            self.hits += 1
+            self._clear.move_to_end(key)
+            return self._clear[key]
+
+        check_columns(csg=csg)
+
+        self.misses += 1
+
+        rho_n = fn.normalized_density_profile(self.z, h)
+
+        # Molecular optical depth, as in optical_depth (which also needs the
+        # cloud parameters to build the total optical depth)
+
+        lod = np.zeros(len(self.z))
+        lod[:-1] = csg*(rho_n[:-1]+rho_n[1:])*0.5*self.dz
+
+        tau = np.cumsum(lod[::-1])[::-1]
+        clear_t = np.exp(-tau)
+        weight_clear = np.zeros(len(self.z))
+        weight_clear[1:] = np.diff(clear_t)/self.dz
+
+        clear = {'rho_n' : rho_n, 'lod' : lod, 'tau' : tau,
+                 'clear_t' : clear_t, 'weight_clear' : weight_clear}
+
+        for array in clear.values():
+            array.setflags(write=False)
+
+        self._clear[key] = clear
+
+        if len(self._clear) > self.maxsize:
+            self._clear.popitem(last=False)
+
+        return clear
+
+    def profiles(self, b, t, csg, coc, h):
+
+        """ This function computes the transmittances and the weighting
+            functions for clear and cloudy sky, as optical_depth,
+            TOA_transmittances and weighting_function would do, reusing the
+            cached clear sky profiles.
+
+            Only the levels from the ground to the cloud top are computed
+            for the cloudy sky: each of them is crossed by the gas optical
+            depth (cached) plus coc times the thickness of the cloud levels
+            between the level itself and the cloud top.
+
+
+             INPUT:
+
+                 b, t        : cloud base and top
+
+                 csg         : cross section per unit mass of absorbing gas
+
+                 coc         : absorption coefficient of cloud layer
+
+                 h           : vertical scale height
+
+
+             OUTPUT:
+
+                 clear_t, cloudy_t            : transmittance vectors
+
+                 weight_clear, weight_cloudy  : weighting function vectors
+
+        """
+
+        check_columns(self.z, b=b, t=t, coc=coc)
+
+        clear = self.clear_sky(h, csg)
+
+        cloud_base = fn.grid_index(self.z, b, name='The bottom of the cloud')
+        cloud_top = fn.grid_index(self.z, t, name='The top of the cloud')
+
+        # Cloud thickness (cloud levels cloud_base+1 ... cloud_top-1) between
+        # each level below the cloud top and the cloud top
+
+        layer_dz = np.broadcast_to(self.dz, (len(self.z)-1,))
+
+        thickness = np.zeros(cloud_top+1)
+        thickness[cloud_base+1:cloud_top] = layer_dz[cloud_base+1:cloud_top]
+        cloud_depth = np.cumsum(thickness[::-1])[::-1]
+
+        cloudy_t = clear['clear_t'].copy()
+        cloudy_t[:cloud_top+1] = np.exp(-(clear['tau'][:cloud_top+1] + coc*cloud_depth))
+
+        weight_cloudy = clear['weight_clear'].copy()
+        weight_cloudy[1:cloud_top+2] = np.diff(cloudy_t[:cloud_top+2])/layer_dz[:cloud_top+1]
+
+        return clear['clear_t'], cloudy_t, clear['weight_clear'], weight_cloudy
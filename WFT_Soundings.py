@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+#-----------------------------------------------------------------
+# Measured density profiles of the absorbing gas (soundings)
+#-----------------------------------------------------------------
+#
+# Radiosondes and model output give the density of the absorbing gas on
+# their own levels. The soundings are loaded in bulk from a binary (.npy,
+# .npz) or text (.csv, .txt) file with one row for each measured point:
+#
+#        sounding,z,density
+#        16080,0.0,1.2
+#        16080,0.5,1.1
+#        ...
+#
+# (height in km, extra columns are ignored) and all of them are
+# interpolated onto the z vector in a single vectorized pass, giving the
+# density profiles (n_soundings, n_levels) used by the optical depth
+# instead of the analytic normalized_density_profile.
+#
+# i.e for Linux users:
+#
+#        python3 WFT_Soundings.py soundings.csv --output OUTPUT/Soundings.npz
+#
+#-----------------------------------------------------------------
+#
+
+import argparse
+
+import numpy as np
+import WFT_Functions as fn
+from WFT_Validation import check, check_columns, check_soundings, SOUNDING_LEVELS
+
+# Names of the columns of the input files
+
+FIELDS = ('sounding', 'z', 'density')
+
+class Soundings:
+
+    """ Density profiles measured on their own levels.
+
+        ATTRIBUTES:
+
+            ids         : labels of the soundings (sorted)
+
+            index       : sounding of every point (position in ids)
+
+            heights     : height [km] of every point
+
+            density     : density of the absorbing gas of every point, in
+                          units consistent with the cross section csg
+
+            starts      : position of the first point of every sounding
+
+            counts      : number of points of every sounding
+
+        The points are sorted by sounding and height; a repeated height of
+        a sounding keeps its first point only.
+
+    """
+
+    def __init__(self, sounding, z, density):
+
+        sounding = np.asarray(sounding)
+        heights = np.asarray(z, dtype=float)
+        density = np.asarray(density, dtype=float)
+
+        if not sounding.shape == heights.shape == density.shape or heights.ndim != 1:
+            raise ValueError (
+                'sounding, z and density must be vectors with the same length')
+
+        self.ids, index = np.unique(sounding, return_inverse=True)
+
+        # Check the points, reporting the failing soundings (see
+        # WFT_Validation.py)
+
+        check_soundings(index, heights, density, len(self.ids))
+
+        # Points sorted by sounding, then by height, without repeated heights
+
+        order = np.lexsort((heights, index))
+        index, heights, density = index[order], heights[order], density[order]
+
+        keep = np.ones(len(index), dtype=bool)
+        keep[1:] = (index[1:] != index[:-1]) | (heights[1:] != heights[:-1])
+
+        self.index = index[keep]
+        self.heights = heights[keep]
+        self.density = density[keep]
+
+        self.counts = np.bincount(self.index, minlength=len(self.ids))
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+
+        check([(SOUNDING_LEVELS, self.counts < 2)], self.counts.shape)
+
+    def __len__(self):
+
+        return len(self.ids)
+
+    def interpolate(self, z, log=True, scale_height=7.0, dtype=np.float64, chunk_size=256):
+
+        """ This function interpolates all the soundings onto the vector z.
+            Between the measured levels the interpolation is linear in the
+            logarithm of the density (log=True, the density must be
+            positive) or in the density; below the lowest level the density
+            is constant and above the highest one it decreases exponentially
+            with scale_height [km].
+
+
+             INPUT:
+
+                 z           : altitude vector
+
+                 log         : interpolate the logarithm of the density
+
+                 scale_height : scale height above the top of the soundings
+
+                 dtype       : floating point type of the profiles
+
+                 chunk_size  : soundings interpolated at the same time (the
+                               temporary arrays grow with it)
+
+
+             OUTPUT:
+
+                 rho         : density profiles with shape
+                               (n_soundings, n_levels)
+
+        """
+
+        z = np.asarray(z, dtype=float)
+
+        if log:
+            check_soundings(self.index, self.heights, self.density, len(self), log=True)
+
+        check_columns(h=scale_height)
+
+        values = np.log(self.density) if log else self.density
+        first = self.starts
+        last = self.starts + self.counts - 1
+
+        # The soundings are put one after the other on a single axis, each
+        # one shifted by its position times a span larger than all the
+        # heights, so that a single np.interp call (linear in the number of
+        # points, z being sorted) interpolates all of them. Every sounding
+        # gets two more points at the ends of its span: the first density
+        # below it and the last one above it (for the logarithm, its
+        # exponential decrease, a straight line)
+
+        low = min(self.heights.min(), z[0]) - 1
+        span = max(self.heights.max(), z[-1]) - low + 1
+        shift = np.arange(len(self))*span
+
+        top = values[last] - (span - 0.5 - (self.heights[last] - low))/scale_height if log else values[last]
+
+        ends = np.concatenate((last+1, first))
+        keys = np.insert(shift[self.index] + (self.heights - low), ends,
+                         np.concatenate((shift + span - 0.5, shift)))
+        values = np.insert(values, ends, np.concatenate((top, values[first])))
+
+        rho = np.empty((len(self), len(z)), dtype=dtype)
+
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+
+            # Points of the chunk (with two more for each sounding), shifted
+            # back to the first sounding of the chunk for precision
+
+            points = slice(first[start] + 2*start, last[stop-1] + 2*stop + 1)
+
+            profile = np.interp((shift[start:stop] - shift[start])[:, np.newaxis] + (z - low),
+                                keys[points] - shift[start], values[points])
+
+            if log:
+                np.exp(profile, out=rho[start:stop], casting='unsafe')
+            else:
+                profile *= np.exp(-np.maximum(z - self.heights[last[start:stop], np.newaxis], 0)/scale_height)
+                rho[start:stop] = profile
+
+        return rho
+
+    def profiles(self, z, dz, b, t, csg, coc, mu=1, dtype=np.float64, **options):
+
+        """ This function runs the chain of fn.batch_profiles with the
+            interpolated soundings (one column for each sounding) instead of
+            the analytic density profile. The cloud parameters are numbers or
+            arrays with one value for each sounding; options are passed to
+            interpolate.
+
+             OUTPUT:
+
+                 clear_t, cloudy_t, weight_clear, weight_cloudy : profiles
+                               with shape (n_soundings, n_levels)
+
+        """
+
+        rho = self.interpolate(z, dtype=dtype, **options)
+
+        lod, loc = fn.batch_optical_depth(z, dz, b, t, csg, coc, rho)
+
+        clear_t, cloudy_t = fn.TOA_transmittances(lod, loc, z, mu)
+
+        weight_clear, weight_cloudy = fn.weighting_function(clear_t, cloudy_t, z, dz)
+
+        return clear_t, cloudy_t, weight_clear, weight_cloudy
+
+def load_soundings(filename):
+
+    """ This function reads the soundings of a file in bulk.
+
+
+         INPUT:
+
+             filename    : .npy file with a structured array with the fields
+                           sounding, z and density; .npz file with the
+                           arrays sounding, z and density (one value for
+                           each point), or z and density with shape
+                           (n_soundings, n_points) padded with NaN; text
+                           file with a header line naming the columns
+
+
+         OUTPUT:
+
+             soundings   : Soundings
+
+    """
+
+    if filename.endswith('.npy'):
+        points = np.load(filename, mmap_mode='r')
+        _check_fields(points.dtype.names or ())
+        return Soundings(*(points[f] for f in FIELDS))
+
+    if filename.endswith('.npz'):
+        with np.load(filename) as data:
+            if 'sounding' in data.files:
+                return Soundings(*(data[f] for f in FIELDS))
+
+            heights = np.atleast_2d(data['z'])
+            density = np.atleast_2d(data['density'])
+            heights, density = np.broadcast_arrays(heights, density)
+
+            # Padded tables: one row for each sounding, NaN where there is
+            # no point
+
+            valid = ~(np.isnan(heights) | np.isnan(density))
+            sounding = np.broadcast_to(np.arange(len(heights))[:, np.newaxis], heights.shape)
+
+            return Soundings(sounding[valid], heights[valid], density[valid])
+
+    with open(filename) as file:
+        header = file.readline().strip().lstrip('#').strip()
+        delimiter = ',' if ',' in header else None
+        names = [name.strip() for name in header.split(delimiter)]
+        _check_fields(names)
+
+        # All the rows at once; labels that are not numbers are read in a
+        # second pass as text
+
+        usecols = [names.index(f) for f in FIELDS]
+        body = file.tell()
+
+        try:
+            columns = np.loadtxt(file, delimiter=delimiter, ndmin=2, usecols=usecols)
+            sounding, heights, density = columns.T
+
+            # Integer labels (i.e. WMO station numbers) stay integers
+
+            if np.all(sounding == np.round(sounding)):
+                sounding = sounding.astype(np.int64)
+
+        except ValueError:
+            file.seek(body)
+            sounding = np.loadtxt(file, delimiter=delimiter, dtype=str, ndmin=1, usecols=usecols[0])
+            file.seek(body)
+            heights, density = np.loadtxt(file, delimiter=delimiter, ndmin=2, usecols=usecols[1:]).T
+
+    return Soundings(sounding, heights, density)
+
+def _check_fields(names):
+
+    """ Raises an error if a field of FIELDS is missing. """
+
+    missing = [f for f in FIELDS if f not in names]
+    if missing:
+        raise ValueError (
+            f'The soundings have no column {", ".join(missing)}!')
+
+def main(argv=None):
+
+    """ Command line interface: interpolates the soundings of a file onto the
+        z vector and stores them in a .npz file (ids, z and rho).
+    """
+
+    arguments = argparse.ArgumentParser(description = 'Soundings of the WFT model')
+    arguments.add_argument('input',
+                           help = 'input .npy, .npz or text file with the soundings')
+    arguments.add_argument('--dz', type=float, default=fn.DZ,
+                           help = 'step value of the height vector [km]')
+    arguments.add_argument('--linear', action='store_true',
+                           help = 'interpolate the density instead of its logarithm')
+    arguments.add_argument('--scale-height', type=float, default=7.0,
+                           help = 'scale height above the top of the soundings [km]')
+    arguments.add_argument('--dtype', choices=('float64', 'float32'), default='float64',
+                           help = 'floating point type of the profiles')
+    arguments.add_argument('--output', default='./OUTPUT/Soundings.npz',
+                           help = 'output .npz file')
+    args = arguments.parse_args(argv)
+
+    z = fn.z_vector(fn.Z1, args.dz, fn.Z2, fn.Z2)
+
+    soundings = load_soundings(args.input)
+    rho = soundings.interpolate(z, not args.linear, args.scale_height, np.dtype(args.dtype))
+
+    np.savez(args.output, ids=soundings.ids, z=z, rho=rho)
+
+    print(f'{len(soundings)} soundings stored in {args.output}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+#-----------------------------------------------------------------
+# Streaming computation of very large sets of atmospheric columns
+#-----------------------------------------------------------------
+#
+# The parameters of the columns (cloud base and top, cross section, cloud
+# absorption coefficient and scale height) are read from a file in chunks,
+# every chunk is computed with the batched chain of WFT_Functions and its
+# profiles are written in the memory-mapped store of WFT_Sweep, so that
+# only a few chunks are in memory at the same time whatever the number of
+# columns. The next chunk is read and the previous one is written while
+# the current one is computed.
+#
+# The input file is either a .npy file with a structured array (fields b,
+# t, csg, coc and h, read with mmap) or a text file with a header line
+# naming the columns, i.e.
+#
+#        b,t,csg,coc,h
+#        1,2,0.2,5,7
+#        ...
+#
+# i.e for Linux users:
+#
+#        python3 WFT_Stream.py columns.csv --output OUTPUT/Stream/
+#
+#-----------------------------------------------------------------
+#
+
+import argparse
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import WFT_Functions as fn
+from WFT_Sweep import PARAMETERS, PROFILES, open_result_store
+
+def _text_header(file):
+
+    """ Names of the columns of a text file and its delimiter. """
+
+    header = file.readline().strip().lstrip('#').strip()
+    delimiter = ',' if ',' in header else None
+    names = [name.strip() for name in header.split(delimiter)]
+
+    missing = [p for p in PARAMETERS if p not in names]
+    if missing:
+        raise ValueError (
+            f'The input file has no column {", ".join(missing)}!')
+
+    return names, delimiter
+
+def count_columns(filename):
+
+    """ This function returns the number of columns (rows of parameters) of
+        the input file, reading a text file line by line.
+    """
+
+    if filename.endswith('.npy'):
+        return len(np.load(filename, mmap_mode='r'))
+
+    with open(filename) as file:
+        _text_header(file)
+        return sum(1 for line in file if line.strip())
+
+def read_columns(filename, chunk_size):
+
+    """ This function reads the parameters of the columns in chunks.
+
+
+         INPUT:
+
+             filename    : .npy file with a structured array, or text file
+                           with a header line naming the columns
+
+             chunk_size  : number of columns of every chunk
+
+
+         OUTPUT:
+
+             chunks      : generator of structured arrays with the fields
+                           of WFT_Sweep.PARAMETERS
+
+    """
+
+    if filename.endswith('.npy'):
+        columns = np.load(filename, mmap_mode='r')
+
+        for start in range(0, len(columns), chunk_size):
+            rows = columns[start:start+chunk_size]
+            chunk = np.zeros(len(rows), dtype=[(p, float) for p in PARAMETERS])
+            for p in PARAMETERS:
+                chunk[p] = rows[p]
+            yield chunk
+
+        return
+
+    with open(filename) as file:
+        names, delimiter = _text_header(file)
+
+        while True:
+            lines = [line for line in itertools.islice(file, chunk_size) if line.strip()]
+            if not lines:
+                return
+
+            values = np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+
+            chunk = np.zeros(len(values), dtype=[(p, float) for p in PARAMETERS])
+            for p in PARAMETERS:
+                chunk[p] = values[:, names.index(p)]
+            yield chunk
+
+def run_stream(filename, dz, output_dir, chunk_size=1024, mu=1, dtype=np.float64):
+
+    """ This function computes the transmittances and the weighting functions
+        of every column of the input file, chunk by chunk.
+
+
+         INPUT:
+
+             filename    : input file (see read_columns)
+
+             dz          : step value of the height vector
+
+             output_dir  : folder where the results are stored (see
+                           WFT_Sweep.open_result_store)
+
+             chunk_size  : number of columns computed in a single call
+
+             mu          : cosine of the viewing zenith angle
+
+             dtype       : floating point type of the computation and of the
+                           stored profiles
+
+
+         OUTPUT:
+
+             stats       : dictionary with the number of columns, the time
+                           spent computing, writing (in parallel with the
+                           computation) and in total and the throughput
+                           (columns/s)
+
+    """
+
+    start = time.perf_counter()
+
+    z = fn.z_vector(fn.Z1, dz, fn.Z2, fn.Z2)
+    n_columns = count_columns(filename)
+
+    store = open_result_store(output_dir, z, n_columns, dtype)
+
+    chunks = read_columns(filename, chunk_size)
+    compute_time = 0.0
+    write_time = []
+
+    def write(position, chunk, profiles):
+        write_start = time.perf_counter()
+
+        rows = slice(position, position+len(chunk))
+        store['parameters'][rows] = chunk
+        for name, profile in zip(PROFILES, profiles):
+            store[name][rows] = profile
+
+        # Written pages are sent to the disk, so that they can be released
+        # from memory
+
+        for array in store.values():
+            array.flush()
+
+        write_time.append(time.perf_counter() - write_start)
+
+    # The next chunk is read and the previous one is written in two threads
+    # while the current one is computed: at most three chunks are in memory
+
+    position = 0
+    written = None
+
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        following = reader.submit(next, chunks, None)
+
+        while True:
+            chunk = following.result()
+            if chunk is None:
+                break
+
+            following = reader.submit(next, chunks, None)
+
+            compute_start = time.perf_counter()
+            profiles = fn.batch_profiles(z, dz, chunk['b'], chunk['t'], chunk['csg'],
+                                         chunk['coc'], chunk['h'], mu, dtype)
+            compute_time += time.perf_counter() - compute_start
+
+            if written is not None:
+                written.result()
+            written = writer.submit(write, position, chunk, profiles)
+
+            position += len(chunk)
+
+        if written is not None:
+            written.result()
+
+    total_time = time.perf_counter() - start
+
+    return {'n_columns' : position, 'compute_seconds' : compute_time,
+            'write_seconds' : sum(write_time), 'total_seconds' : total_time,
+            'columns_per_second' : position/total_time}
+
+def main(argv=None):
+
+    """ Command line interface of the streaming computation. """
+
+    arguments = argparse.ArgumentParser(description = 'Streaming computation of the WFT model')
+    arguments.add_argument('input',
+                           help = 'input .npy or text file with the parameters of the columns')
+    arguments.add_argument('--dz', type=float, default=fn.DZ,
+                           help = 'step value of the height vector [km]')
+    arguments.add_argument('--chunk-size', type=int, default=1024,
+                           help = 'number of columns computed in a single call')
+    arguments.add_argument('--mu', type=float, default=1,
+                           help = 'cosine of the viewing zenith angle')
+    arguments.add_argument('--dtype', choices=('float64', 'float32'), default='float64',
+                           help = 'floating point type of the computation (float32 halves the memory)')
+    arguments.add_argument('--output', default='./OUTPUT/Stream/',
+                           help = 'folder where the results are stored')
+    args = arguments.parse_args(argv)
+
+    stats = run_stream(args.input, args.dz, args.output, args.chunk_size, args.mu,
+                       np.dtype(args.dtype))
+
+    print(f'{stats["n_columns"]} columns stored in {args.output} '
+          f'({stats["columns_per_second"]:.0f} columns/s)')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+#-----------------------------------------------------------------
+# Parameter sweep of the Weighting functions and Transmittances model
+#-----------------------------------------------------------------
+#
+# The z_vector -> normalized_density_profile -> optical_depth ->
+# TOA_transmittances -> weighting_function chain is run for every point
+# of a grid of cloud bases, cloud tops, cross sections, cloud absorption
+# coefficients and scale heights. The points are split in chunks that are
+# computed in a pool of processes and streamed into one set of .npy files.
+#
+# i.e for Linux users:
+#
+#        python3 WFT_Sweep.py --csg 0.01 0.2 20 --coc 1 5 5 --workers 8
+#
+#-----------------------------------------------------------------
+#
+
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from configparser import ConfigParser
+
+import numpy as np
+import WFT_Functions as fn
+
+# Names and order of the swept parameters
+
+PARAMETERS = ('b', 't', 'csg', 'coc', 'h')
+
+# Names of the output profiles, in the order returned by fn.batch_profiles
+
+PROFILES = ('clear_t', 'cloudy_t', 'weight_clear', 'weight_cloudy')
+
+# Grid, floating point type and result store shared by the processes of
+# the pool, set once for each worker
+
+_z = None
+_dz = None
+_dtype = None
+_store = None
+
+def parameter_grid(z, b, t, csg, coc, h):
+
+    """ This function builds all the combinations of the swept parameters.
+        Cloud bases and tops must be levels of z (a ValueError arises
+        otherwise) and the combinations having the cloud base above (or at)
+        the cloud top are discarded.
+
+
+         INPUT:
+
+             z                  : altitude vector of the portion of atmosphere
+                                  under consideration
+
+             b, t, csg, coc, h  : sequences of values of each parameter
+
+
+        OUTPUT:
+
+             points             : structured array with one field for each
+                                  parameter and one element for each point
+
+    """
+
+    def levels(values, name):
+        return np.unique(z[fn.grid_index(z, np.atleast_1d(np.asarray(values, dtype=float)), name=name)])
+
+    values = [levels(b, 'The bottom of the cloud'), levels(t, 'The top of the cloud'),
+              np.asarray(csg, dtype=float), np.asarray(coc, dtype=float),
+              np.asarray(h, dtype=float)]
+
+    combinations = np.stack([g.ravel() for g in np.meshgrid(*values, indexing='ij')], axis=1)
+
+    # Keep only the physical combinations (cloud base below cloud top)
+
+    combinations = combinations[combinations[:, 0] < combinations[:, 1]]
+
+    points = np.zeros(len(combinations), dtype=[(p, float) for p in PARAMETERS])
+    for i, p in enumerate(PARAMETERS):
+        points[p] = combinations[:, i]
+
+    return points
+
+def open_result_store(output_dir, z, points, dtype=float):
+
+    """ This function creates the consolidated output of a run: the height
+        vector, the parameters of every point and one memory-mapped .npy
+        file for each profile, with shape (n_points, n_levels).
+
+
+         INPUT:
+
+             output_dir  : folder where the files are stored
+
+             z           : altitude vector
+
+             points      : structured array of the parameters, or number of
+                           points when the parameters are not known yet (they
+                           are then written by the caller in store['parameters'])
+
+             dtype       : floating point type of the stored profiles
+
+
+        OUTPUT:
+
+             store       : dictionary of the memory-mapped profile arrays
+
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    np.save(os.path.join(output_dir, 'z.npy'), z)
+
+    store = {}
+
+    if np.ndim(points) == 0:
+        store['parameters'] = np.lib.format.open_memmap(
+            os.path.join(output_dir, 'parameters.npy'), mode='w+',
+            dtype=[(p, float) for p in PARAMETERS], shape=(int(points),))
+        points = store['parameters']
+    else:
+        np.save(os.path.join(output_dir, 'parameters.npy'), points)
+
+    for name in PROFILES:
+        store[name] = np.lib.format.open_memmap(os.path.join(output_dir, f'{name}.npy'),
+                                                mode='w+', dtype=dtype,
+                                                shape=(len(points), len(z)))
+
+    return store
+
+def _init_worker(dz, dtype, output_dir):
+
+    """ Builds the shared grid and opens the result store once in every
+        process of the pool.
+    """
+
+    global _z, _dz, _dtype, _store
+
+    _z = fn.z_vector(fn.Z1, dz, fn.Z2, fn.Z2)
+    _dz = dz
+    _dtype = dtype
+    _store = {name : np.load(os.path.join(output_dir, f'{name}.npy'), mmap_mode='r+')
+              for name in PROFILES}
+
+def _run_chunk(start, chunk):
+
+    """ Runs the whole chain on one chunk of points of the sweep and writes
+        the profiles in the result store; only the position of the chunk is
+        sent back.
+    """
+
+    profiles = fn.batch_profiles(_z, _dz, chunk['b'], chunk['t'], chunk['csg'],
+                                 chunk['coc'], chunk['h'], dtype=_dtype)
+
+    for name, profile in zip(PROFILES, profiles):
+        _store[name][start:start+len(profile)] = profile
+
+    return start, len(chunk)
+
+def run_sweep(points, dz, output_dir, workers=None, chunk_size=256, dtype=np.float64):
+
+    """ This function computes the transmittances and the weighting functions
+        of every point of the sweep in a pool of processes. The points are
+        sent to the pool in chunks and every worker writes its chunks in the
+        result store itself (the .npy files are memory-mapped in every
+        process), so that the profiles are never sent back to the parent
+        process and at most two chunks for each worker are waiting.
+
+
+         INPUT:
+
+             points      : structured array of the parameters (see parameter_grid)
+
+             dz          : step value of the height vector
+
+             output_dir  : folder where the results are stored
+
+             workers     : number of processes (default: number of cores)
+
+             chunk_size  : number of points computed in a single call
+
+             dtype       : floating point type of the computation and of the
+                           stored profiles
+
+
+        OUTPUT:
+
+             store       : dictionary of the memory-mapped profile arrays
+
+    """
+
+    z = fn.z_vector(fn.Z1, dz, fn.Z2, fn.Z2)
+
+    store = open_result_store(output_dir, z, points, dtype)
+
+    for array in store.values():
+        array.flush()
+
+    workers = workers or os.cpu_count() or 1
+    starts = iter(range(0, len(points), chunk_size))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(dz, dtype, output_dir)) as pool:
+        pending = set()
+
+        for start in itertools.islice(starts, 2*workers):
+            pending.add(pool.submit(_run_chunk, start, points[start:start+chunk_size]))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            # The errors of the workers are raised here
+
+            for future in done:
+                future.result()
+
+            for start in itertools.islice(starts, len(done)):
+                pending.add(pool.submit(_run_chunk, start, points[start:start+chunk_size]))
+
+    return store
+
+def main(argv=None):
+
+    """ Command line interface of the sweep: every parameter is given as
+        START STOP NUM (as in np.linspace), parameters that are not given
+        keep the value of Configuration.ini.
+    """
+
+    parser = ConfigParser()
+    parser.read("Configuration.ini")
+
+    defaults = {
+        'b' : parser.getfloat("General_Variables", "Bottom_cloud", fallback = 1),
+        't' : parser.getfloat("General_Variables", "Top_cloud", fallback = 2),
+        'csg' : parser.getfloat("General_Variables", "Cross_section_abs_gas", fallback = 0.2),
+        'coc' : parser.getfloat("General_Variables", "Abs_coeff_cloud", fallback = 5),
+        'h' : parser.getfloat("General_Variables", "vertical_height_scale", fallback = 7)}
+
+    arguments = argparse.ArgumentParser(description = 'Parameter sweep of the WFT model')
+    arguments.add_argument('--b', nargs=3, type=float, metavar=('START', 'STOP', 'NUM'),
+                           help = 'cloud base [km]')
+    arguments.add_argument('--t', nargs=3, type=float, metavar=('START', 'STOP', 'NUM'),
+                           help = 'cloud top [km]')
+    arguments.add_argument('--csg', nargs=3, type=float, metavar=('START', 'STOP', 'NUM'),
+                           help = 'cross section per unit mass of absorbing gas')
+    arguments.add_argument('--coc', nargs=3, type=float, metavar=('START', 'STOP', 'NUM'),
+                           help = 'absorption coefficient of the cloud layer')
+    arguments.add_argument('--h', nargs=3, type=float, metavar=('START', 'STOP', 'NUM'),
+                           help = 'vertical scale height [km]')
+    arguments.add_argument('--dz', type=float, default=fn.DZ,
+                           help = 'step value of the height vector [km]')
+    arguments.add_argument('--workers', type=int, default=None,
+                           help = 'number of processes (default: number of cores)')
+    arguments.add_argument('--chunk-size', type=int, default=256,
+                           help = 'number of points computed in a single call')
+    arguments.add_argument('--dtype', choices=('float64', 'float32'), default='float64',
+                           help = 'floating point type of the computation (float32 halves the memory)')
+    arguments.add_argument('--output', default='./OUTPUT/Sweep/',
+                           help = 'folder where the results are stored')
+    args = arguments.parse_args(argv)
+
+    ranges = {}
+    for p in PARAMETERS:
+        value = getattr(args, p)
+        if value is None:
+            ranges[p] = [defaults[p]]
+        else:
+            ranges[p] = np.linspace(value[0], value[1], int(value[2]))
+
+    z = fn.z_vector(fn.Z1, args.dz, fn.Z2, fn.Z2)
+    points = parameter_grid(z, **ranges)
+
+    if len(points) == 0:
+        raise ValueError (
+            'No point of the sweep has the cloud base below the cloud top')
+
+    run_sweep(points, args.dz, args.output, args.workers, args.chunk_size, np.dtype(args.dtype))
+
+    print(f'{len(points)} points stored in {args.output}')
+
+if __name__ == "__main__":
+    main()
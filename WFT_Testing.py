@@ -233,3 +233,1051 @@ def test_weighting_functions(clear_t,cloudy_t,weight_clear,weight_cloudy):
     assert(len(clear_t)==len(weight_clear))
     assert(len(cloudy_t)==len(weight_clear))
 
+
+def test_vectorized_kernels():
+
+    """ This test compares the vectorized optical depth, transmittance and weighting function
+        with the original level-by-level loops.
+
+        The transmittance is now computed as exp(-sum(tau)) instead of a running product of exp(-tau):
+        the two must agree within a relative tolerance of 1e-12.
+    """
+
+    # Reference values computed with the explicit loops
+
+    lod_ref = np.zeros(len(z))
+    for j in range(len(z)-2, -1, -1):
+        lod_ref[j] = csg*(rho_n[j]+rho_n[j+1])*0.5*dz
+
+    t_ref = np.ones(len(z))
+    for i in range(len(z)-2, -1, -1):
+        t_ref[i] = t_ref[i+1]*np.exp(-lod_ref[i])
+
+    w_ref = np.zeros(len(z))
+    for i in range(1, len(z)):
+        w_ref[i] = (t_ref[i]-t_ref[i-1])/dz
+
+    lod_v, loc_v = fn.optical_depth(z,dz,b,t,csg,coc,rho_n)
+    clear_v, cloudy_v = fn.TOA_transmittances(lod_v, loc_v, z)
+    weight_v, _ = fn.weighting_function(clear_v, cloudy_v, z, dz)
+
+    assert np.allclose(lod_v, lod_ref, rtol=1e-12, atol=0)
+    assert np.allclose(clear_v, t_ref, rtol=1e-12, atol=0)
+    assert np.allclose(weight_v, w_ref, rtol=1e-9, atol=1e-12)
+
+def test_batch_profiles():
+
+    """ This test checks that the batched engine gives, column by column, the same profiles
+        computed one at a time by the single column functions.
+    """
+
+    b_batch = np.array([1, 5, 10])
+    t_batch = np.array([2, 10, 15])
+    csg_batch = np.array([0.003, 0.02, 0.2])
+    coc_batch = np.array([5, 5, 2])
+    h_batch = np.array([7, 6, 8])
+
+    profiles = fn.batch_profiles(z,dz,b_batch,t_batch,csg_batch,coc_batch,h_batch)
+
+    #check the shape of the outputs, also for an empty batch
+
+    for p in profiles:
+        assert(p.shape == (len(b_batch), len(z)))
+
+    for mu, shape in ((1, (0, len(z))), (np.array([1, 0.5]), (2, 0, len(z)))):
+        for p in fn.batch_profiles(z,dz,[],[],0.2,5,7,mu=mu):
+            assert(p.shape == shape)
+
+    #check every column against the single column chain
+
+    for i in range(len(b_batch)):
+        rho_i = fn.normalized_density_profile(z,h_batch[i])
+        lod_i, loc_i = fn.optical_depth(z,dz,b_batch[i],t_batch[i],csg_batch[i],coc_batch[i],rho_i)
+        clear_i, cloudy_i = fn.TOA_transmittances(lod_i, loc_i, z)
+        single = (clear_i, cloudy_i) + fn.weighting_function(clear_i, cloudy_i, z, dz)
+        for p, s in zip(profiles, single):
+            assert np.allclose(p[i], s)
+
+def test_sweep(tmp_path):
+
+    """ This test runs a small parameter sweep in a pool of two processes and checks that
+        the consolidated output is the same of the batched engine.
+
+        The combinations with the cloud base above the cloud top must be discarded and the cloud
+        bases and tops must be levels of z.
+    """
+
+    import WFT_Sweep as sw
+
+    points = sw.parameter_grid(z, [1, 5, 12], [2, 10], [0.02, 0.2], [5], [7])
+
+    assert(np.all(points['b'] < points['t']))
+    assert(len(points) == 6)
+
+    store = sw.run_sweep(points, dz, str(tmp_path), workers=2, chunk_size=4)
+
+    profiles = fn.batch_profiles(z,dz,points['b'],points['t'],points['csg'],points['coc'],points['h'])
+
+    for name, profile in zip(sw.PROFILES, profiles):
+        assert np.array_equal(np.load(tmp_path / f'{name}.npy'), profile)
+        assert np.array_equal(store[name], profile)
+
+    #check if a ValueError arises if a cloud base or top is not a level of z
+
+    with pytest.raises(ValueError, match='The top of the cloud'):
+        sw.parameter_grid(z, [1], [2.0012], [0.2], [5], [7])
+
+def test_grid_index():
+
+    """ This test checks the lookup of altitudes in the z vector.
+
+        The index must be found by binary search (grid_index), altitudes within the tolerance from a
+        level must be accepted, the others must raise a ValueError.
+    """
+
+    assert(fn.grid_index(z, 5) == 1000)
+
+    #check that an altitude within the tolerance is accepted
+
+    assert(fn.grid_index(z, 5.0000000001) == 1000)
+
+    #check the lookup of an array of altitudes
+
+    assert np.array_equal(fn.grid_index(z, [0, 10, 49.995]), [0, 2000, 9999])
+
+    #check if a ValueError arises if the altitude is not a level of z
+
+    for altitude in (5.002, -1, 60):
+        with pytest.raises(ValueError):
+            fn.grid_index(z, altitude)
+
+def test_profile_no_plots(tmp_path):
+
+    """ This test checks that WFT_Profile.py can be imported and run without plots.
+
+        Importing the module must not import matplotlib, and a run with plots=False must only
+        write the two txt files in the output folder.
+    """
+
+    import subprocess
+    import sys
+
+    #check that the import has no side effects (matplotlib is not imported)
+
+    check = 'import sys, WFT_Profile; print("matplotlib" in sys.modules)'
+    result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True)
+    assert(result.stdout.strip() == 'False')
+
+    import WFT_Profile as wp
+
+    config = wp.read_configuration()
+    config['output_path'] = str(tmp_path) + '/'
+
+    profiles = wp.run(config, plots=False)
+
+    assert(sorted(p.name for p in tmp_path.iterdir()) == ['Clear_Sky.txt', 'Cloudy_Sky.txt'])
+    assert np.allclose(np.loadtxt(tmp_path / 'Cloudy_Sky.txt')[:, 1], profiles['cloudy_t'], atol=1e-6)
+
+def test_binary_save(tmp_path):
+
+    """ This test checks the binary output of WFT_Profile.py.
+
+        The .npy file must be readable as a memory map without parsing and must keep the
+        computed profiles with full precision.
+    """
+
+    import WFT_Profile as wp
+
+    config = wp.read_configuration()
+    config['output_path'] = str(tmp_path) + '/'
+
+    profiles = wp.run(config, plots=False, output_format='npy')
+
+    data = np.load(tmp_path / 'WFT_Profiles.npy', mmap_mode='r')
+
+    assert(isinstance(data, np.memmap))
+    assert(data.shape == (len(wp.BINARY_ROWS), len(profiles['z'])))
+
+    for row, name in enumerate(wp.BINARY_ROWS):
+        assert np.array_equal(data[row], profiles[name])
+
+def test_profile_session():
+
+    """ This test checks that a ProfileSession gives the same profiles of the whole chain
+        while computing the clear sky profiles only once for each (h, csg) pair.
+    """
+
+    import WFT_Session as ws
+
+    session = ws.ProfileSession(z, dz)
+
+    for b_s, t_s, coc_s in ((1, 2, 5), (5, 10, 2), (10, 15, 3), (0, 49.995, 1)):
+        profiles = session.profiles(b_s, t_s, csg, coc_s, h)
+        reference = fn.batch_profiles(z,dz,b_s,t_s,csg,coc_s,h)
+        for p, r in zip(profiles, reference):
+            assert np.allclose(p, r[0], rtol=1e-12, atol=1e-12)
+
+    #check that the clear sky chain was computed only the first time
+
+    assert(session.misses == 1)
+    assert(session.hits == 3)
+
+def test_benchmark(tmp_path):
+
+    """ This test runs the benchmarks on a coarse grid and checks that a record is stored
+        for every stage, with a positive time and throughput, in the .json and .csv files.
+    """
+
+    import json
+    import WFT_Benchmark as bm
+
+    records = bm.run_benchmarks(dz_values=[0.1], columns=[1, 4], repeat=1, plots=False)
+
+    stages = [r['stage'] for r in records]
+
+    assert(stages.count('optical_depth') == 2)
+    assert('text_output' in stages)
+    assert all(r['seconds'] > 0 and r['levels_per_s'] > 0 for r in records)
+
+    bm.save_results(records, str(tmp_path / 'benchmark.json'))
+
+    with open(tmp_path / 'benchmark.json') as file:
+        assert(json.load(file)['records'] == records)
+    assert((tmp_path / 'benchmark.csv').exists())
+
+def test_instrumentation(tmp_path):
+
+    """ This test checks that the stages of a run are recorded only when the instrumentation
+        is active, with the right number of calls and the size of the produced arrays.
+    """
+
+    import WFT_Profile as wp
+    from WFT_Instrumentation import Instrumentation, instrument
+
+    config = wp.read_configuration()
+    config['output_path'] = str(tmp_path) + '/'
+
+    calls = []
+    recorder = Instrumentation(callback=lambda name, seconds, nbytes: calls.append(name))
+
+    with instrument(recorder):
+        wp.run(config, plots=False)
+
+    report = recorder.report()
+
+    for name in ('z_vector', 'normalized_density_profile', 'optical_depth',
+                 'TOA_transmittances', 'weighting_function', 'txt_output'):
+        assert(report[name]['calls'] == 1)
+        assert(name in calls)
+
+    assert(report['optical_depth']['bytes'] == 2*len(z)*8)
+
+    #check that the results written in out= arrays (i.e. by a Workspace) are not counted
+
+    workspace = fn.Workspace(z,dz)
+
+    with instrument() as reused:
+        workspace.profiles(1,2,0.2,5,7)
+        fn.normalized_density_profile(z,7,np.float64,workspace.rho_n)
+
+    for name in ('normalized_density_profile', 'optical_depth', 'TOA_transmittances', 'weighting_function'):
+        assert(reused.stages[name]['bytes'] == 0)
+
+    #check that nothing is recorded outside the with block
+
+    fn.z_vector(z1,dz,z2,20)
+    assert(recorder.stages['z_vector']['calls'] == 1)
+
+def test_zenith_angles():
+
+    """ This test checks the slant path transmittances exp(-tau/mu).
+
+        With an array of viewing angles the outputs must have one row for every angle, equal to
+        the profiles computed one angle at a time, and mu = 1 must give the nadir profiles.
+    """
+
+    mu = np.array([1, 0.8, 0.5])
+
+    clear_mu, cloudy_mu = fn.TOA_transmittances(lod, loc, z, mu)
+
+    assert(clear_mu.shape == (len(mu), len(z)))
+
+    for i in range(len(mu)):
+        clear_i, cloudy_i = fn.TOA_transmittances(lod, loc, z, mu[i])
+        assert np.allclose(clear_mu[i], clear_i)
+        assert np.allclose(cloudy_mu[i], cloudy_i)
+
+    assert np.allclose(clear_mu[0], clear_t)
+
+    #check the slant path: T(mu) = T(1)**(1/mu)
+
+    assert np.allclose(cloudy_mu[2], cloudy_t**2)
+
+    #check the shape of the batched outputs
+
+    profiles = fn.batch_profiles(z,dz,[1, 5],[2, 10],csg,coc,h,mu)
+    for p in profiles:
+        assert(p.shape == (len(mu), 2, len(z)))
+
+    #check if a ValueError arises if mu is not in (0, 1]
+
+    with pytest.raises(ValueError):
+        fn.TOA_transmittances(lod, loc, z, 0)
+
+def test_spectral_profiles():
+
+    """ This test checks that the spectral mode gives, band by band, the same profiles computed
+        with one cross section (and one cloud absorption coefficient) at a time.
+    """
+
+    csg_bands = np.array([0.003, 0.02, 0.2, 2])
+    coc_bands = np.array([5, 4, 3, 2])
+
+    profiles = fn.spectral_profiles(z,dz,b,t,csg_bands,coc_bands,h)
+
+    for p in profiles:
+        assert(p.shape == (len(csg_bands), len(z)))
+
+    for i in range(len(csg_bands)):
+        lod_i, loc_i = fn.optical_depth(z,dz,b,t,csg_bands[i],coc_bands[i],rho_n)
+        clear_i, cloudy_i = fn.TOA_transmittances(lod_i, loc_i, z)
+        single = (clear_i, cloudy_i) + fn.weighting_function(clear_i, cloudy_i, z, dz)
+        for p, s in zip(profiles, single):
+            assert np.allclose(p[i], s, rtol=1e-12, atol=1e-12)
+
+def test_cloud_layers():
+
+    """ This test checks the optical depth of a sky with several cloud layers.
+
+        A single layer must give the same total optical depth of optical_depth, two separate layers
+        must add their contributions, and a per-level extinction profile must give the same result
+        of the equivalent list of layers.
+    """
+
+    #check the single layer case
+
+    lod_1, loc_1 = fn.layered_optical_depth(z,dz,csg,rho_n,layers=[(b, t, coc)])
+    assert np.array_equal(loc_1, loc)
+
+    #check two layers: the cloud optical depth is the sum of the two layers
+
+    layers = [(1, 2, 5), (10, 15, 2), (12, 13, 1)]
+    lod_3, loc_3 = fn.layered_optical_depth(z,dz,csg,rho_n,layers=layers)
+
+    extra = sum(fn.optical_depth(z,dz,b_l,t_l,csg,coc_l,rho_n)[1] - lod for b_l, t_l, coc_l in layers)
+    assert np.allclose(loc_3, lod + extra)
+
+    #check the per-level extinction profile
+
+    extinction = fn.cloud_extinction_profile(z, layers)
+    _, loc_e = fn.layered_optical_depth(z,dz,csg,rho_n,extinction=extinction)
+    assert np.array_equal(loc_e, loc_3)
+
+    #check if a ValueError arises if a layer has the base above the top
+
+    with pytest.raises(ValueError):
+        fn.cloud_extinction_profile(z, [(1, 2, 5), (15, 10, 2)])
+
+    #check if a ValueError arises if the extinction has not one value for each level, also in
+    #trusted mode
+
+    from WFT_Validation import trusted
+
+    for wrong in (0.1, extinction[:-1], np.ones((3, len(z)+1))):
+        with pytest.raises(ValueError, match='one value for each'):
+            fn.layered_optical_depth(z,dz,csg,rho_n,extinction=wrong)
+        with pytest.raises(ValueError, match='one value for each'), trusted():
+            fn.layered_optical_depth(z,dz,csg,rho_n,extinction=wrong)
+
+    #check that an extinction at the top level adds nothing: there is no layer above it, with a
+    #uniform or a non-uniform grid, and the cloudy transmittance is 1 at the TOA
+
+    extinction = np.full(len(z), 0.1)
+    _, loc_u = fn.layered_optical_depth(z,dz,csg,rho_n,extinction=extinction)
+    _, loc_n = fn.layered_optical_depth(z,np.diff(z),csg,rho_n,extinction=extinction)
+
+    assert(loc_u[-1] == 0 and loc_n[-1] == 0)
+    assert np.allclose(loc_u, loc_n, rtol=1e-12)
+    assert(fn.TOA_transmittances(lod_1, loc_u, z)[1][-1] == 1)
+
+def test_non_uniform_grid():
+
+    """ This test checks the functions on non-uniform height vectors.
+
+        A user-supplied vector with the levels of the uniform one must give the same profiles
+        using the layer thicknesses as dz, and the adaptive vector must reproduce the cloudy sky
+        transmittance of the uniform vector with far fewer levels.
+    """
+
+    #check the user-supplied vector
+
+    with pytest.raises(ValueError):
+        fn.custom_z_vector([0, 2, 1, 3])
+
+    z_c = fn.custom_z_vector(list(z))
+    dz_c = fn.layer_thickness(z_c)
+    lod_c, loc_c = fn.optical_depth(z_c,dz_c,b,t,csg,coc,rho_n)
+    clear_c, cloudy_c = fn.TOA_transmittances(lod_c, loc_c, z_c)
+    weight_c = fn.weighting_function(clear_c, cloudy_c, z_c, dz_c)
+
+    assert np.allclose(cloudy_c, cloudy_t, rtol=1e-9)
+    assert np.allclose(weight_c[1], weight_cloudy, rtol=1e-6, atol=1e-9)
+
+    #check the adaptive vector
+
+    z_a = fn.adaptive_z_vector(b,t,csg,coc,h)
+    dz_a = fn.layer_thickness(z_a)
+
+    assert(len(z_a) < len(z)/5)
+    assert(fn.grid_index(z_a, b) >= 0 and fn.grid_index(z_a, t) >= 0)
+
+    rho_a = fn.normalized_density_profile(z_a,h)
+    lod_a, loc_a = fn.optical_depth(z_a,dz_a,b,t,csg,coc,rho_a)
+    clear_a, cloudy_a = fn.TOA_transmittances(lod_a, loc_a, z_a)
+
+    assert np.allclose(cloudy_a, np.interp(z_a, z, cloudy_t), atol=1e-4)
+    assert np.allclose(clear_a, np.interp(z_a, z, clear_t), atol=1e-4)
+
+    #check the cached session on the adaptive vector
+
+    import WFT_Session as ws
+
+    profiles = ws.ProfileSession(z_a, dz_a).profiles(b,t,csg,coc,h)
+    assert np.allclose(profiles[1], cloudy_a)
+    assert np.allclose(profiles[3], fn.weighting_function(clear_a, cloudy_a, z_a, dz_a)[1])
+
+def test_profile_jacobians():
+
+    """ This test compares the analytic jacobians with central finite differences of the whole chain.
+
+        For csg, coc and h the derivatives of all the profiles must agree; for the cloud base and top
+        (which move by whole levels) the derivative of the cloudy transmittance at the surface is
+        compared with a finite difference over several levels.
+    """
+
+    parameters = {'b' : 1, 't' : 2, 'csg' : 0.02, 'coc' : 0.5, 'h' : 7}
+
+    profiles, jacobians = fn.profile_jacobians(z,dz,**parameters)
+
+    reference = fn.batch_profiles(z,dz,**parameters)
+    for p, r in zip(profiles, reference):
+        assert np.allclose(p, r[0])
+
+    for name, step in (('csg', 1e-6), ('coc', 1e-6), ('h', 1e-5), ('b', 0.05), ('t', 0.05)):
+        plus = dict(parameters, **{name : parameters[name] + step})
+        minus = dict(parameters, **{name : parameters[name] - step})
+        profiles_plus = fn.batch_profiles(z,dz,**plus)
+        profiles_minus = fn.batch_profiles(z,dz,**minus)
+
+        if name in ('b', 't'):
+            fd = (profiles_plus[1][0][0] - profiles_minus[1][0][0])/(2*step)
+            assert np.isclose(jacobians[name][1][0], fd, rtol=1e-3)
+        else:
+            for d, p_plus, p_minus in zip(jacobians[name], profiles_plus, profiles_minus):
+                fd = (p_plus[0] - p_minus[0])/(2*step)
+                assert np.allclose(d, fd, rtol=1e-4, atol=1e-6*max(np.abs(fd).max(), 1))
+
+    #check if a ValueError arises for more than one viewing angle
+
+    with pytest.raises(ValueError, match='single viewing angle'):
+        fn.profile_jacobians(z,dz,1,2,0.2,5,7,mu=[0.5, 1])
+
+def test_cloud_retrieval():
+
+    """ This test retrieves the cloud parameters of synthetic pixels computed with the forward model.
+
+        For clouds with base and top on the z vector, base, top and absorption coefficient must be
+        found again, from the transmittances and from the weighting functions.
+    """
+
+    import WFT_Retrieval as wr
+
+    b_true = z[[200, 1000, 1500, 3000]]
+    t_true = z[[400, 1010, 2300, 3300]]
+    coc_true = np.array([0.5, 2, 0.1, 1])
+
+    clear_r, cloudy_r, weight_clear_r, weight_cloudy_r = fn.batch_profiles(z,dz,b_true,t_true,0.02,coc_true,h)
+
+    retrieval = wr.CloudRetrieval(z,dz,0.02,h)
+    result, stats = retrieval.retrieve(cloudy_r)
+
+    assert np.allclose(result['b'], b_true)
+    assert np.allclose(result['t'], t_true)
+    assert np.allclose(result['coc'], coc_true, rtol=1e-6)
+    assert np.all(result['converged'])
+    assert(stats['n_converged'] == 4)
+
+    result_w, _ = retrieval.retrieve(weight_cloudy=weight_cloudy_r)
+    assert np.allclose(result_w['b'], b_true)
+    assert np.allclose(result_w['t'], t_true)
+    assert np.allclose(result_w['coc'], coc_true, rtol=1e-6)
+
+def test_lookup_table(tmp_path):
+
+    """ This test compares the profiles interpolated in a lookup table with the exact ones.
+
+        On the nodes of the table (for every cloud, cross section and viewing angle) the profiles
+        must be exact; between them the errors must stay below the estimated bounds. Clouds that are
+        not nodes of the table and values outside its range must raise a ValueError. The table must
+        be the same after being stored and read again.
+    """
+
+    import WFT_LookupTable as wl
+
+    #check the nodes of every axis
+
+    nodes = wl.build_table(z,dz,[1, b],[2, t],[0.02, csg],[0.5, coc],h,[0.5, 1],dtype=np.float64)
+
+    profiles = nodes.query([1, b],[2, t],[0.02, csg],[0.5, coc],h,1)
+    reference = fn.batch_profiles(z,dz,[1, b],[2, t],[0.02, csg],[0.5, coc],h,1)
+    slant = nodes.query(b,t,csg,coc,h,0.5)
+
+    for p, r, q, s in zip(profiles, reference, slant, fn.batch_profiles(z,dz,b,t,csg,coc,h,0.5)):
+        assert np.allclose(p, r, rtol=1e-14, atol=0)
+        assert np.allclose(q, s[0], rtol=1e-14, atol=0)
+
+    #check the interpolation between the scale heights
+
+    table = wl.build_table(z,dz,b,t,csg,coc,np.linspace(5,9,41),dtype=np.float64)
+
+    errors = table.error_bounds()
+    assert(errors == table.errors)
+    assert(errors['cloudy_t'] < 1e-3)
+
+    profiles = table.query(b,t,csg,coc,[7.05, 5.52])
+    reference = fn.batch_profiles(z,dz,b,t,csg,coc,[7.05, 5.52])
+    for p, r, name in zip(profiles, reference, wl.PROFILES):
+        assert(np.abs(p - r).max() <= errors[name])
+
+    table.save(tmp_path / 'table.npz')
+    loaded = wl.load_table(tmp_path / 'table.npz')
+    assert(loaded.errors == table.errors)
+    assert np.array_equal(loaded.query(b,t,csg,coc,h)[1], table.query(b,t,csg,coc,h)[1])
+
+    with pytest.raises(ValueError, match='outside the range'):
+        table.query(b,t,csg,coc,10)
+
+    with pytest.raises(ValueError, match='not a node'):
+        table.query(b,t+1,csg,coc,h)
+
+def test_result_cache(tmp_path, monkeypatch):
+
+    """ This test checks the on-disk cache of WFT_Profile.py.
+
+        A second run with the same configuration must find the profiles and the files in the cache,
+        a different configuration or a change of the code drawing the figures must be recomputed, the
+        least recently used entries must be removed when the cache is too large and invalidate must
+        remove the entries.
+    """
+
+    import WFT_Profile as wp
+    import WFT_Cache as wc
+
+    cache = wc.ResultCache(str(tmp_path / 'cache'))
+
+    config = wp.read_configuration()
+    config['output_path'] = str(tmp_path) + '/'
+
+    profiles = wp.run(config, plots=False, output_format='both', cache=cache)
+    assert(cache.hits == 0 and cache.misses == 1)
+
+    (tmp_path / 'Cloudy_Sky.txt').unlink()
+    cached = wp.run(config, plots=False, output_format='both', cache=cache)
+    assert(cache.hits == 1)
+    assert np.array_equal(cached['cloudy_t'], profiles['cloudy_t'])
+    assert(cached['zt'] == profiles['zt'])
+    assert((tmp_path / 'Cloudy_Sky.txt').exists())
+
+    other = dict(config, coc=config['coc']+1)
+    assert(wp.cache_key(other) != wp.cache_key(config))
+
+    render = tmp_path / 'WFT_Render.py'
+    render.write_text(open(wp.WFT_Render.__file__).read() + '\n# changed\n')
+    key = wp.cache_key(config)
+    monkeypatch.setattr(wp.WFT_Render, '__file__', str(render))
+    assert(wp.cache_key(config) != key)
+    monkeypatch.undo()
+
+    wp.run(other, plots=False, cache=cache)
+    assert(cache.misses == 2 and len(cache.entries()) == 2)
+
+    #the least recently used entry (config) is removed first
+
+    cache.max_bytes = cache.entries()[-1][1]
+    cache.evict()
+    assert([e[0] for e in cache.entries()] == [wp.cache_key(other)])
+
+    cache.invalidate(wp.cache_key(other))
+    assert(cache.entries() == [])
+
+def test_stream(tmp_path):
+
+    """ This test computes the columns of a text and of a .npy file in chunks with WFT_Stream.py.
+
+        The stored parameters and profiles must be the ones of a single batched computation, also when
+        the number of columns is not a multiple of the chunk size.
+    """
+
+    import WFT_Stream as ws
+
+    columns = np.zeros(11, dtype=[(p, float) for p in ('b', 't', 'csg', 'coc', 'h')])
+    columns['b'] = np.linspace(1, 6, 11)
+    columns['t'] = columns['b'] + 2
+    columns['csg'] = np.linspace(0.01, 0.3, 11)
+    columns['coc'] = 2
+    columns['h'] = np.linspace(6, 8, 11)
+
+    np.save(tmp_path / 'columns.npy', columns)
+    np.savetxt(tmp_path / 'columns.csv', np.c_[tuple(columns[p] for p in ('h', 'coc', 'csg', 't', 'b'))],
+               delimiter=',', header='h,coc,csg,t,b', comments='', fmt='%.15g')
+
+    reference = fn.batch_profiles(fn.z_vector(0,0.05,50,50),0.05,columns['b'],columns['t'],
+                                  columns['csg'],columns['coc'],columns['h'])
+
+    for name in ('columns.npy', 'columns.csv'):
+        output = tmp_path / name.replace('.', '_')
+        stats = ws.run_stream(str(tmp_path / name), 0.05, str(output), chunk_size=4)
+
+        assert(stats['n_columns'] == 11)
+        assert np.allclose(np.load(output / 'parameters.npy')['b'], columns['b'])
+        assert np.allclose(np.load(output / 'cloudy_t.npy'), reference[1])
+        assert np.allclose(np.load(output / 'weight_clear.npy'), reference[2])
+
+def test_float32_precision():
+
+    """ This test runs the chain in float32 and compares it with float64.
+
+        Every array of the chain must keep the float32 type; transmittances must agree within 1e-5
+        and weighting functions, differences of transmittances close to 1, within a few float32
+        epsilons divided by dz (see the README).
+    """
+
+    tol_weights = 4*np.finfo(np.float32).eps/dz
+
+    rho_32 = fn.normalized_density_profile(z,h,np.float32)
+    lod_32, loc_32 = fn.optical_depth(z,dz,b,t,csg,coc,rho_32)
+    clear_32, cloudy_32 = fn.TOA_transmittances(lod_32, loc_32, z)
+    weights_32 = fn.weighting_function(clear_32, cloudy_32, z, dz)
+
+    for array in (rho_32, lod_32, loc_32, clear_32, cloudy_32) + weights_32:
+        assert(array.dtype == np.float32)
+
+    assert np.allclose(cloudy_32, cloudy_t, rtol=0, atol=1e-5)
+    assert np.allclose(weights_32[1], weight_cloudy, rtol=0, atol=tol_weights)
+
+    profiles_64 = fn.batch_profiles(z,dz,[1, b],[2, t],[0.02, csg],[0.5, coc],[6, h],[1, 0.5])
+    profiles_32 = fn.batch_profiles(z,dz,[1, b],[2, t],[0.02, csg],[0.5, coc],[6, h],[1, 0.5],
+                                    dtype=np.float32)
+
+    for p_64, p_32, tol in zip(profiles_64, profiles_32, (1e-5, 1e-5, tol_weights, tol_weights)):
+        assert(p_32.dtype == np.float32 and p_32.shape == p_64.shape)
+        assert np.allclose(p_32, p_64, rtol=0, atol=tol)
+
+def test_workspace():
+
+    """ This test checks the out= arrays of the chain and the Workspace.
+
+        The results written in preallocated arrays must be the same of the ones of the chain, and a
+        Workspace must not allocate new arrays after the first call.
+    """
+
+    import tracemalloc
+
+    #check the out= arrays, also for many viewing angles
+
+    lod_out, loc_out = np.empty(len(z)), np.empty(len(z))
+    assert(fn.optical_depth(z,dz,b,t,csg,coc,rho_n,out=(lod_out, loc_out))[1] is loc_out)
+    assert np.array_equal(loc_out, loc)
+
+    mu = np.array([1, 0.5])
+    transmittances = (np.empty((2, len(z))), np.empty((2, len(z))))
+    fn.TOA_transmittances(lod, loc, z, mu, out=transmittances)
+    assert np.allclose(transmittances[1], fn.TOA_transmittances(lod, loc, z, mu)[1], rtol=1e-14)
+
+    weights = (np.empty((2, len(z))), np.empty((2, len(z))))
+    fn.weighting_function(*transmittances, z, dz, out=weights)
+    assert np.array_equal(weights[1][0], weight_cloudy)
+
+    #check that only non-contiguous out= arrays are refused
+
+    strided = np.empty((2, 2*len(z)))[:, ::2]
+    with pytest.raises(ValueError, match='contiguous'):
+        fn.TOA_transmittances(lod, loc, z, mu, out=(strided, transmittances[1]))
+
+    empty = (np.empty((2, 0, len(z))), np.empty((2, 0, len(z))))
+    assert(fn.TOA_transmittances(np.empty((0, len(z))), np.empty((0, len(z))), z, mu, out=empty) == empty)
+
+    #check the workspace
+
+    workspace = fn.Workspace(z,dz)
+    profiles = workspace.profiles(b,t,csg,coc,h)
+
+    for p, r in zip(profiles, (clear_t, cloudy_t, weight_clear, weight_cloudy)):
+        assert np.allclose(p, r, rtol=1e-14)
+
+    tracemalloc.start()
+    for top in (t, t+1, t+2):
+        workspace.profiles(b,top,csg,coc,h)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert(peak < workspace.rho_n.nbytes/4)
+
+def test_render(tmp_path):
+
+    """ This test renders the figures of two scenes with WFT_Render.py in a pool of two processes.
+
+        The decimated profiles must keep the first and the last level and the smallest and the
+        largest value, with at most two levels for each row of pixels; every scene gives its three
+        figures and no pyplot figure is left open.
+    """
+
+    import sys
+    import WFT_Render as wr
+
+    values = np.sin(np.linspace(0, 30, 10000))
+    index = wr.decimate(values, 480)
+
+    assert(len(index) <= 2*480 + 2)
+    assert(index[0] == 0 and index[-1] == len(values)-1)
+    assert np.all(np.diff(index) > 0)
+    assert(values[index].min() == values.min() and values[index].max() == values.max())
+
+    z = fn.z_vector(0,0.05,50,50)
+    clear_t, cloudy_t, weight_clear, weight_cloudy = fn.batch_profiles(z,0.05,[1,3],[2,5],0.2,5,7)
+
+    scenes = [({'z' : z, 'zt' : 400, 'clear_t' : clear_t[i], 'cloudy_t' : cloudy_t[i],
+                'weight_clear' : weight_clear[i], 'weight_cloudy' : weight_cloudy[i]},
+               str(tmp_path), f'scene_{i}_') for i in range(2)]
+
+    files = wr.render_scenes(scenes, workers=2)
+
+    assert(len(files) == 6)
+    assert(sorted(files) == sorted(str(p) for p in tmp_path.iterdir()))
+    assert(all(name.startswith(str(tmp_path / 'scene_0_')) for name in files[:3]))
+
+    if 'matplotlib.pyplot' in sys.modules:
+        assert(sys.modules['matplotlib.pyplot'].get_fignums() == [])
+
+def test_service(tmp_path):
+
+    """ This test runs the local service of WFT_Service.py on a Unix socket and on a free port of localhost.
+
+        Concurrent requests must be computed in a single batch and give the profiles of
+        fn.batch_profiles; the answers over HTTP must be the same, an invalid request must give an
+        error without failing the others and the service must refuse a non-loopback address.
+    """
+
+    import asyncio
+    import WFT_Service as ws
+
+    z = fn.z_vector(0,0.05,50,50)
+    b = 1 + 0.5*np.arange(8)
+    t = b + 1
+    reference = fn.batch_profiles(z,0.05,b,t,0.2,5,7)
+
+    async def scenario():
+        service = ws.ProfileService()
+
+        with pytest.raises(ValueError):
+            await service.start(host='0.0.0.0', port=0)
+
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        socket_path = str(tmp_path / 'wft.sock')
+        await service.start(socket_path=socket_path)
+
+        #check the coalescing of concurrent requests (one column each)
+
+        results = await asyncio.gather(*(service.compute(0.05,b[i],t[i],0.2,5,7) for i in range(8)))
+
+        assert(service.stats['batches'] == 1 and service.stats['largest_batch'] == 8)
+        for i, profiles in enumerate(results):
+            for p, r in zip(profiles, reference):
+                assert np.allclose(p[0], r[i], rtol=1e-13, atol=0)
+
+        #check the answers over TCP and over the Unix socket
+
+        over_tcp = await asyncio.to_thread(ws.request_profiles,b,t,0.2,5,7,dz=0.05,port=port)
+        over_unix = await asyncio.to_thread(ws.request_profiles,b,t,0.2,5,7,dz=0.05,
+                                            socket_path=socket_path)
+
+        for p, q, r in zip(over_tcp, over_unix, reference):
+            assert(np.array_equal(p, q) and np.allclose(p, r, rtol=1e-13, atol=0))
+
+        with pytest.raises(ValueError):
+            await asyncio.to_thread(ws.request_profiles,3,2,0.2,5,7,dz=0.05,port=port)
+
+        good, bad = await asyncio.gather(service.compute(0.05,1,2,0.2,5,7),
+                                         service.compute(0.05,3,2,0.2,5,7), return_exceptions=True)
+
+        assert(isinstance(bad, ValueError) and np.allclose(good[1][0], reference[1][0]))
+        assert(service.stats['density_misses'] == 1)
+
+        #check that a wrong type is refused at once and that any error of a batch reaches its request
+
+        for dtype in ('U3', 'complex128', 'int64'):
+            with pytest.raises(ValueError, match='float32 or float64'):
+                await asyncio.wait_for(asyncio.to_thread(ws.request_profiles,1,2,0.2,5,7,dz=0.05,
+                                                         dtype=dtype,port=port,timeout=10), 20)
+
+        future = asyncio.get_running_loop().create_future()
+        columns = [np.array([v], dtype=float) for v in (1,2,0.2,5,7)]
+        await asyncio.to_thread(service._compute_group, (0.05,(1.0,),np.dtype('U3').str,0),
+                                [(None, columns, future)])
+
+        with pytest.raises(TypeError):
+            await asyncio.wait_for(future, 10)
+
+        assert np.allclose((await service.compute(0.05,1,2,0.2,5,7))[1][0], reference[1][0])
+
+        #check that an empty request gives empty profiles
+
+        empty = await asyncio.to_thread(ws.request_profiles,[],[],0.2,5,7,dz=0.05,port=port)
+        assert(all(p.shape == (0, len(z)) for p in empty))
+
+        #check that too large requests are refused before any computation and that the grids are
+        #evicted like the density profiles
+
+        service.max_values = 10**5
+        for request in (service.compute(1e-7,1,2,0.2,5,7), service.compute(0.05,b[:1].repeat(200),2,0.2,5,7)):
+            with pytest.raises(ValueError, match='too large'):
+                await request
+        with pytest.raises(ValueError, match='too large'):
+            await asyncio.to_thread(ws.request_profiles,1,2,0.2,5,7,dz=1e-7,port=port,timeout=10)
+        with pytest.raises(ValueError, match='too large'):
+            service.profiles(0.05,b[:1].repeat(200),2,0.2,5,7)
+
+        service.max_grids = 2
+        for dz in (0.05, 0.1, 0.2, 0.05):
+            service.grid(dz)
+        assert(list(service._grids) == [0.2, 0.05])
+
+        await service.close()
+
+    asyncio.run(scenario())
+
+def test_toa_radiance():
+
+    """ This test checks the TOA radiances and brightness temperatures of fn.TOA_radiance.
+
+        An isothermal atmosphere over a black surface at the same temperature must emit the Planck
+        radiance of that temperature for clear and cloudy sky; with the standard temperature
+        profile the radiances of many bands and columns must match a level by level evaluation of
+        the Schwarzschild's equation solution, and an opaque cloud must be seen at the temperature
+        of its levels.
+    """
+
+    dz = 0.05
+    z = fn.z_vector(0,dz,50,50)
+    temperature = fn.standard_temperature_profile(z)
+
+    assert(temperature[0] == 288.15 and np.isclose(temperature[220], 216.65))
+
+    with pytest.raises(ValueError):
+        fn.brightness_temperature(900, 0)
+
+    clear_t, cloudy_t, weight_clear, weight_cloudy = fn.batch_profiles(z,dz,[1,3],[2,5],0.2,5,7)
+
+    with pytest.raises(ValueError):
+        fn.TOA_radiance(weight_clear,weight_cloudy,dz,900,temperature[1:],288)
+
+    #check an isothermal atmosphere
+
+    for radiance in fn.TOA_radiance(weight_clear,weight_cloudy,dz,900,np.full(len(z),250.),250):
+        assert np.allclose(radiance, fn.planck(900,250), rtol=1e-12)
+        assert np.allclose(fn.brightness_temperature(900,radiance), 250, rtol=1e-12)
+
+    #check bands and columns against the solution of the README, level by level
+
+    wavenumber = np.array([667., 900., 1200.])
+    csg = np.array([5., 0.001, 0.3])
+    b = np.array([1., 3.])
+
+    columns = fn.batch_profiles(z,dz,np.tile(b,3),np.tile(b+1,3),np.repeat(csg,2),50,7)
+    columns = [p.reshape(3, 2, -1) for p in columns]
+
+    radiance_clear, radiance_cloudy = fn.TOA_radiance(columns[2],columns[3],dz,wavenumber[:, np.newaxis],
+                                                      temperature,temperature[0])
+    assert(radiance_cloudy.shape == (3, 2))
+
+    for i in range(3):
+        for j in range(2):
+            B = fn.planck(wavenumber[i], temperature)
+            for radiance, t in ((radiance_clear, columns[0]), (radiance_cloudy, columns[1])):
+                expected = B[0]*t[i,j,0] + np.sum(0.5*(B[1:]+B[:-1])*np.diff(t[i,j]))
+                assert np.isclose(radiance[i,j], expected, rtol=1e-12)
+
+    #check the opaque cloud in the window band
+
+    temperatures = fn.brightness_temperature(wavenumber[1], radiance_cloudy[1])
+    assert np.all(temperatures < 288.15 - 6.5*b) and np.all(temperatures > 288.15 - 6.5*(b+1) - 2)
+
+def test_soundings(tmp_path):
+
+    """ This test loads soundings with WFT_Soundings.py and interpolates them onto the z vector.
+
+        Soundings sampled every km from the analytic density profile must give back the profiles of
+        fn.batch_profiles (the logarithm of the density is linear in z), text and binary files must
+        give the same soundings, and the vectorized interpolation must be the one of np.interp
+        applied to every sounding.
+    """
+
+    import WFT_Soundings as wso
+
+    dz = 0.05
+    z = fn.z_vector(0,dz,50,50)
+
+    #check the analytic profiles, sampled up to 30 km in two soundings
+
+    levels = np.arange(0, 31.)
+    rho = fn.batch_normalized_density_profile(z, [6, 8])
+    density = rho[:, np.rint(levels/dz).astype(int)].ravel()
+    soundings = wso.Soundings(np.repeat(['north', 'south'], len(levels)), np.tile(levels, 2), density)
+
+    with pytest.raises(ValueError):
+        soundings.interpolate(z, scale_height=0)
+
+    reference = fn.batch_profiles(z,dz,[1,3],[2,5],0.2,5,[6,8])
+
+    for i, h in enumerate((6, 8)):
+        assert np.allclose(soundings.interpolate(z, scale_height=h)[i], rho[i], rtol=1e-10)
+
+        profiles = soundings.profiles(z,dz,[1,3],[2,5],0.2,5,scale_height=h)
+        for p, r in zip(profiles, reference):
+            assert np.allclose(p[i], r[i], rtol=1e-8, atol=1e-12)
+
+    #check the files
+
+    np.savetxt(tmp_path / 'soundings.csv', np.c_[np.tile(levels, 2), density, np.repeat([16080, 16245], len(levels))],
+               delimiter=',', header='z,density,sounding', comments='', fmt='%.17g')
+    np.savez(tmp_path / 'soundings.npz', z=np.stack((levels, levels)), density=density.reshape(2, -1))
+
+    for name in ('soundings.csv', 'soundings.npz'):
+        loaded = wso.load_soundings(str(tmp_path / name))
+        assert(len(loaded) == 2 and np.all(loaded.counts == len(levels)))
+        assert np.allclose(loaded.interpolate(z), soundings.interpolate(z), rtol=1e-12)
+
+    assert(wso.load_soundings(str(tmp_path / 'soundings.csv')).ids.tolist() == [16080, 16245])
+
+    #check the interpolation against np.interp, with unsorted points and different levels
+
+    rng = np.random.default_rng(0)
+    counts = rng.integers(5, 40, 30)
+    heights = np.concatenate([np.sort(rng.uniform(0.5, 35, c)) for c in counts])
+    density = np.exp(-heights/7)*(1 + 0.1*rng.random(len(heights)))
+    order = rng.permutation(len(heights))
+    soundings = wso.Soundings(np.repeat(np.arange(30), counts)[order], heights[order], density[order])
+
+    for log in (True, False):
+        rho = soundings.interpolate(z, log=log, chunk_size=7)
+
+        for i in range(30):
+            points = slice(soundings.starts[i], soundings.starts[i] + soundings.counts[i])
+            h, d = soundings.heights[points], soundings.density[points]
+            decrease = np.exp(-np.maximum(z - h[-1], 0)/7)
+            expected = np.exp(np.interp(z, h, np.log(d))) if log else np.interp(z, h, d)
+            assert np.allclose(rho[i], expected*decrease, rtol=1e-9)
+
+def test_validation():
+
+    """ This function tests the checks of WFT_Validation.py: the failing
+        columns of a batch are reported, the errors are still ValueErrors
+        with the former messages and nothing is checked in a trusted block
+    """
+
+    import WFT_Validation as wv
+
+    #check the failing columns of a batch
+
+    b = np.array([1., 1., 3., 1., 1., 4.])
+    t = np.array([2., 2., 2., 2., 2., 4.])
+
+    with pytest.raises(wv.ValidationError) as error:
+        fn.batch_profiles(z,dz,b,t,0.2,5,7)
+
+    assert(isinstance(error.value, ValueError))
+    assert(str(error.value) == 'The top of the cloud must be greater than the bottom (columns 2, 5)')
+    assert(error.value.columns.tolist() == [2, 5])
+
+    failures = wv.validate_columns(z, b=b, t=t, csg=[0.2, -1, 0.2, 0.2, 0.2, 0.2], coc=5, h=[7, 7, 7, np.nan, 7, 7])
+    assert(failures[wv.BASE_ABOVE_TOP].tolist() == [2, 5])
+    assert(failures[wv.CROSS_SECTION].tolist() == [1])
+    assert(failures[wv.NOT_FINITE].tolist() == [3])
+
+    assert(wv.validate_columns(z, b=1, t=b+2, csg=0.2, coc=5, h=7, mu=[0.5, 1]) == {})
+
+    #check the single column and the former messages
+
+    with pytest.raises(ValueError, match='The top of the cloud must be greater than the bottom'):
+        fn.optical_depth(z,dz,3,2,0.2,5,fn.normalized_density_profile(z,7))
+
+    with pytest.raises(ValueError, match='finite'):
+        fn.normalized_density_profile(z,np.nan)
+
+    with pytest.raises(ValueError, match='zenith angle'):
+        fn.TOA_transmittances(np.zeros(len(z)), np.zeros(len(z)), z, [0.5, 0])
+
+    #check the transmittances out of range
+
+    clear_t, cloudy_t = np.full((4, 10), 0.5), np.full((4, 10), 0.5)
+    cloudy_t[3, 7] = 1.5
+
+    wv.check_transmittances(clear_t[:3], cloudy_t[:3])
+
+    with pytest.raises(wv.ValidationError) as error:
+        wv.check_transmittances(clear_t, cloudy_t)
+
+    assert(error.value.columns.tolist() == [3])
+
+    #check the failing columns of the radiances and the failing soundings
+
+    import WFT_Soundings as ws
+
+    weights = np.full((3, len(z)), 1/len(z))
+    temperature = np.full(len(z), 250.)
+
+    with pytest.raises(wv.ValidationError) as error:
+        fn.TOA_radiance(weights,weights,dz,[700, -1, 700],temperature,[280, 280, 0])
+
+    assert(error.value.failures[wv.TEMPERATURE].tolist() == [2])
+    assert(error.value.failures[wv.WAVENUMBER].tolist() == [1])
+
+    with pytest.raises(wv.ValidationError) as error:
+        ws.Soundings([1, 1, 2, 2, 3], [0, 1, 0, np.nan, 0], [1, 1, 1, 1, 1])
+
+    assert(error.value.columns.tolist() == [1])
+
+    with pytest.raises(wv.ValidationError, match='at least two levels') as error:
+        ws.Soundings([1, 1, 2, 2, 3], [0, 1, 0, 1, 0], [1, 1, 1, 1, 1])
+
+    assert(error.value.columns.tolist() == [2])
+
+    #check the trusted block
+
+    with wv.trusted(), np.errstate(all='ignore'):
+        assert(wv.is_trusted())
+        wv.check_columns(z, b=b, t=t)
+        wv.check_transmittances(clear_t, cloudy_t)
+        wv.check_height_vector(np.array([1., 0., 2.]))
+        fn.brightness_temperature(700, -1)
+        fn.TOA_radiance(weights,weights,dz,[700, -1, 700],temperature,[280, 280, 0])
+        ws.Soundings([1, 1, 2, 2], [0, 1, 0, 1], [1, 1, 1, -1]).interpolate(z, log=False)
+
+    assert(not wv.is_trusted())
+
+    #check that the cloud base and top must still be levels of z in a trusted block
+
+    with wv.trusted():
+        for b, t in ((-3, 60), (1, 2.0001), (np.nan, 2)):
+            with pytest.raises(ValueError, match='not contained into the z vector'):
+                fn.batch_profiles(z,dz,b,t,0.2,5,7)
+
+            with pytest.raises(ValueError, match='not contained into the z vector'):
+                fn.optical_depth(z,dz,b,t,0.2,5,fn.normalized_density_profile(z,7))
+
+    with pytest.raises(RuntimeError):
+        with wv.trusted():
+            raise RuntimeError
+
+    assert(not wv.is_trusted())
@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+#----------------------------------------
+# Validation of the inputs and outputs of WFT_Functions
+#----------------------------------------
+#
+# The checks of the parameters of the model (cloud base and top, cross
+# sections, scale heights, viewing angles, grid) and of its outputs (the
+# transmittances) are made here on whole batches at once: every rule is a
+# vectorized comparison, and a failure reports the columns that broke each
+# rule. Inside a "with trusted()" block the checks are skipped, for tight
+# loops over parameters already validated: the only cost left is the check
+# of a global variable.
+#
+#        failures = validate_columns(z, b=b, t=t, csg=csg, coc=coc, h=h)
+#
+#        with trusted():
+#            for b, t, csg, coc, h in columns:
+#                workspace.profiles(b, t, csg, coc, h)
+#
+
+import math
+from contextlib import contextmanager
+
+import numpy as np
+
+# Messages of the rules on the parameters of the columns
+
+NOT_FINITE = 'The parameters must be finite numbers'
+BASE_BELOW_GROUND = 'The bottom of the cloud cannot be smaller than the bottom of atmosphere (0)'
+TOP_ABOVE_TOA = 'The top of the cloud cannot be greater than the top of atmosphere (50)'
+BASE_ABOVE_TOP = 'The top of the cloud must be greater than the bottom'
+CROSS_SECTION = 'The cross section must be positive'
+SCALE_HEIGHT = 'Vertical scale height h must be greater then 0!'
+ZENITH_ANGLE = 'The cosine of the zenith angle must be in (0, 1]'
+TRANSMITTANCE = 'Transmittance must be between 0 and 1'
+
+# Messages of the rules on the other inputs of the model
+
+TEMPERATURE = 'The temperature must be positive'
+WAVENUMBER = 'The wavenumber must be positive'
+EMISSIVITY = 'The emissivity must be in [0, 1]'
+RADIANCE = 'The radiance must be positive'
+GRID_STEP = 'dz is not correct!'
+GRID_BOTTOM = 'The starting quote must be 0!'
+GRID_TOP = 'The highest quote must be 50!'
+GRID_LEVELS = 'The height vector must have at least three levels'
+GRID_ORDER = 'The height vector must be strictly increasing'
+SOUNDING_POINTS = 'The soundings must have finite heights and densities'
+NEGATIVE_DENSITY = 'The density cannot be negative'
+LOG_DENSITY = 'The density must be positive to interpolate its logarithm'
+SOUNDING_LEVELS = 'Every sounding must have at least two levels'
+
+# Largest number of failing columns written in the message of an error
+
+MAX_REPORTED = 10
+
+# True inside a trusted() block: the checks are skipped
+
+_trusted = False
+
+class ValidationError(ValueError):
+
+    """ Error raised when some columns break the rules of the model.
+
+        ATTRIBUTES:
+
+            failures    : dictionary with the message of every broken rule
+                          and the indices of the columns breaking it (an
+                          empty tuple for a single column)
+
+            columns     : sorted indices of all the failing columns (empty
+                          for a single column)
+
+    """
+
+    def __init__(self, failures):
+
+        self.failures = failures
+
+        indices = [np.asarray(i).reshape(-1) for i in failures.values()]
+        self.columns = np.unique(np.concatenate(indices)) if indices else np.array([], dtype=int)
+
+        # The message of the first broken rule, with the failing columns of
+        # a batch
+
+        message, first = next(iter(failures.items()))
+
+        if np.size(first):
+            listed = ', '.join(str(c) for c in np.asarray(first).reshape(-1)[:MAX_REPORTED])
+            more = ', ...' if np.size(first) > MAX_REPORTED else ''
+            message = f'{message} (columns {listed}{more})'
+
+        if len(failures) > 1:
+            message = f'{message}; {len(failures)-1} more broken rule(s)'
+
+        super().__init__(message)
+
+@contextmanager
+def trusted():
+
+    """ Inside the with block the parameters and the outputs of the
+        functions of WFT_Functions are not checked: the caller guarantees
+        that they are valid (i.e. validated once with validate_columns).
+        The cloud base and top are still looked for in the height vector:
+        an altitude out of it or between two levels raises a ValueError.
+    """
+
+    global _trusted
+
+    previous = _trusted
+    _trusted = True
+
+    try:
+        yield
+    finally:
+        _trusted = previous
+
+def is_trusted():
+
+    """ True inside a trusted() block. """
+
+    return _trusted
+
+def _failing(failed, shape):
+
+    """ Indices of the failing columns of a rule (an empty tuple for a
+        single column), or None if the rule holds.
+    """
+
+    failed = np.broadcast_to(failed, shape)
+
+    if not failed.any():
+        return None
+
+    if failed.ndim == 0:
+        return ()
+
+    # With more leading axes (i.e. angles and columns) the columns are the
+    # last one
+
+    return np.flatnonzero(failed.any(axis=tuple(range(failed.ndim-1))))
+
+def check(rules, shape=()):
+
+    """ This function raises a ValidationError if a rule is broken. Rules
+        are (message, failed) pairs, failed being a boolean or an array of
+        booleans with one value for each column (broadcast to shape).
+        Nothing is checked inside a trusted() block.
+    """
+
+    if _trusted:
+        return
+
+    failures = {}
+
+    for message, failed in rules:
+        columns = _failing(failed, np.broadcast_shapes(shape, np.shape(failed)))
+        if columns is not None:
+            failures.setdefault(message, columns)
+
+    if failures:
+        raise ValidationError(failures)
+
+def validate_columns(z=None, b=None, t=None, csg=None, coc=None, h=None, mu=None):
+
+    """ This function checks the parameters of many columns at once, even
+        inside a trusted() block.
+
+
+         INPUT:
+
+             z           : altitude vector (needed to check b and t)
+
+             b, t        : cloud bases and tops
+
+             csg, coc    : cross sections of the gas and absorption
+                           coefficients of the clouds
+
+             h           : vertical scale heights
+
+             mu          : cosines of the viewing zenith angles (the failing
+                           angles are reported for them)
+
+             Every other parameter is a number or an array with one value for
+             each column; the parameters not given are not checked.
+
+
+         OUTPUT:
+
+             failures    : dictionary with the message of every broken rule
+                           and the indices of the columns breaking it (empty
+                           if all the columns are valid)
+
+    """
+
+    parameters = {name : np.asarray(value, dtype=float) for name, value in
+                  (('b', b), ('t', t), ('csg', csg), ('coc', coc), ('h', h))
+                  if value is not None}
+
+    shape = np.broadcast_shapes(*(p.shape for p in parameters.values()))
+    p = parameters
+
+    finite = np.ones(shape, dtype=bool)
+    for value in p.values():
+        finite &= np.isfinite(value)
+
+    rules = [(NOT_FINITE, ~finite)]
+
+    # Comparisons with NaN are False: the rules below only see finite values
+
+    if 'b' in p and z is not None:
+        rules.append((BASE_BELOW_GROUND, p['b'] < z[0]))
+    if 't' in p and z is not None:
+        rules.append((TOP_ABOVE_TOA, p['t'] > z[len(z)-1]))
+    if 'b' in p and 't' in p:
+        rules.append((BASE_ABOVE_TOP, p['b'] >= p['t']))
+    if 'csg' in p or 'coc' in p:
+        rules.append((CROSS_SECTION, np.logical_or(p.get('csg', 1) <= 0, p.get('coc', 1) <= 0)))
+    if 'h' in p:
+        rules.append((SCALE_HEIGHT, p['h'] <= 0))
+
+    failures = {}
+
+    for message, failed in rules:
+        columns = _failing(failed, shape)
+        if columns is not None:
+            failures[message] = columns
+
+    if mu is not None:
+        mu = np.asarray(mu, dtype=float)
+        angles = _failing(~((mu > 0) & (mu <= 1)), mu.shape)
+        if angles is not None:
+            failures[ZENITH_ANGLE] = angles
+
+    return failures
+
+def _valid_numbers(z, b, t, csg, coc, h, mu):
+
+    """ True if all the given parameters are numbers (not arrays) keeping
+        the rules, checked without numpy (the case of a single column).
+    """
+
+    values = [v for v in (b, t, csg, coc, h, mu) if v is not None]
+
+    try:
+        if not all(math.isfinite(v) for v in values):
+            return False
+    except TypeError:
+        return False
+
+    return ((b is None or z is None or b >= z[0]) and
+            (t is None or z is None or t <= z[len(z)-1]) and
+            (b is None or t is None or b < t) and
+            (csg is None or csg > 0) and (coc is None or coc > 0) and
+            (h is None or h > 0) and (mu is None or 0 < mu <= 1))
+
+def check_columns(z=None, b=None, t=None, csg=None, coc=None, h=None, mu=None):
+
+    """ This function raises a ValidationError, reporting the failing
+        columns, if the parameters break a rule (see validate_columns).
+        Nothing is checked inside a trusted() block.
+    """
+
+    if _trusted:
+        return
+
+    # A single valid column is checked without building arrays
+
+    if _valid_numbers(z, b, t, csg, coc, h, mu):
+        return
+
+    failures = validate_columns(z, b, t, csg, coc, h, mu)
+
+    if failures:
+        raise ValidationError(failures)
+
+def check_transmittances(clear_t, cloudy_t):
+
+    """ This function raises a ValidationError if a transmittance is not in
+        [0, 1], reporting the failing columns (the levels are on the last
+        axis). Nothing is checked inside a trusted() block.
+    """
+
+    if _trusted:
+        return
+
+    # Four reductions on the whole arrays; the columns are looked for only
+    # when a value is out of range
+
+    if (clear_t.min(initial=0) >= 0 and clear_t.max(initial=1) <= 1 and
+            cloudy_t.min(initial=0) >= 0 and cloudy_t.max(initial=1) <= 1):
+        return
+
+    failed = np.zeros(np.shape(clear_t)[:-1], dtype=bool)
+    for transmittance in (clear_t, cloudy_t):
+        failed |= np.any((transmittance < 0) | (transmittance > 1), axis=-1)
+
+    check([(TRANSMITTANCE, failed)], failed.shape)
+
+def check_grid(z1, dz, z2, top):
+
+    """ This function raises a ValidationError if the bounds and the step of
+        a height vector (see WFT_Functions.z_vector) are not valid. Nothing
+        is checked inside a trusted() block.
+    """
+
+    if _trusted:
+        return
+
+    check([(GRID_STEP, dz <= 0 or dz > 0.5*(z2-z1)),
+           (GRID_BOTTOM, z1 != 0),
+           (GRID_TOP, z2 != 50),
+           ('The top of the plotted atmosphere must be smaller than the top of the analyzed atmosphere',
+            top > z2)])
+
+def check_height_vector(z):
+
+    """ This function raises a ValidationError if a user-supplied height
+        vector (see WFT_Functions.custom_z_vector) is not valid. Nothing is
+        checked inside a trusted() block.
+    """
+
+    if _trusted:
+        return
+
+    # The levels are looked at only once the vector has at least three
+
+    check([(GRID_LEVELS, z.ndim != 1 or len(z) < 3)])
+
+    check([(GRID_BOTTOM, z[0] != 0),
+           (GRID_TOP, z[len(z)-1] > 50),
+           (GRID_ORDER, np.any(np.diff(z) <= 0))])
+
+def check_radiance_inputs(wavenumber, temperature, surface_temperature, emissivity, shape):
+
+    """ This function raises a ValidationError, reporting the failing
+        columns, if the inputs of WFT_Functions.TOA_radiance are not valid.
+        shape is the shape of the radiances (the weighting functions without
+        their last axis); the levels of the temperature profiles are on
+        their last axis. Nothing is checked inside a trusted() block.
+    """
+
+    if _trusted:
+        return
+
+    emissivity = np.asarray(emissivity)
+
+    check([(TEMPERATURE, np.logical_or(np.any(temperature <= 0, axis=-1), surface_temperature <= 0)),
+           (WAVENUMBER, wavenumber <= 0),
+           (EMISSIVITY, (emissivity < 0) | (emissivity > 1))], shape)
+
+def check_soundings(index, heights, density, n_soundings, log=False):
+
+    """ This function raises a ValidationError, reporting the failing
+        soundings, if a point has no finite height and density or a negative
+        density (not positive with log=True). index is the sounding of
+        every point. Nothing is checked inside a trusted() block.
+    """
+
+    if _trusted:
+        return
+
+    def soundings(failed):
+        return np.bincount(index, weights=failed, minlength=n_soundings) > 0
+
+    rules = [(SOUNDING_POINTS, soundings(~(np.isfinite(heights) & np.isfinite(density)))),
+             (NEGATIVE_DENSITY, soundings(density < 0))]
+
+    if log:
+        rules.append((LOG_DENSITY, soundings(density <= 0)))
+
+    check(rules, (n_soundings,))